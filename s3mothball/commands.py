@@ -1,37 +1,70 @@
 import argparse
+import json
 import sys
 from os.path import commonprefix
 from shutil import copyfileobj
 
 from smart_open import open
 
-from s3mothball.helpers import exists
-from s3mothball.s3mothball import write_tar, validate_tar, delete_files, open_archived_file
+from s3mothball.helpers import exists, write_dicts_to_csv
+from s3mothball.s3mothball import write_tar, validate_tar, delete_files, open_archived_file, extract_files, split_inventory, \
+    run_batch, restore_files, sample_tars, convert_manifest
+from s3mothball.settings import THREADS, PART_SIZE, UPLOAD_THREADS, MAX_THREADS, MEMORY_BUDGET, COMPRESS_THREADS, \
+    SAMPLE_CONFIDENCE, SAMPLE_DEFECT_RATE, MIN_PART_SIZE
+
+
+def positive_int(value):
+    """ argparse type for options that must be at least 1. """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return number
+
+
+def part_size_mb(value):
+    """ argparse type for --part-size-mb, which must be at least S3's minimum part size. """
+    size = int(value)
+    if size * 2 ** 20 < MIN_PART_SIZE:
+        raise argparse.ArgumentTypeError("must be at least %s MiB, the smallest part S3 accepts" % (MIN_PART_SIZE // 2 ** 20))
+    return size
 
 
 def do_validate(args):
         print("Validating %s against %s" % (args.tar_path, args.manifest_path))
-        validate_tar(args.manifest_path, args.tar_path, progress_bar=args.progress_bar)
+        validate_tar(args.manifest_path, args.tar_path, progress_bar=args.progress_bar, threads=args.validate_threads,
+                     headers_only=args.headers_only, quick=args.quick)
 
 
-def do_delete(args):
-    print("Deleting objects listed in %s" % args.manifest_path)
+def do_delete(args, manifest_paths=None):
+    manifest_paths = manifest_paths or [args.manifest_path]
+    if len(manifest_paths) == 1:
+        print("Deleting objects listed in %s" % manifest_paths[0])
+    else:
+        print("Deleting objects listed in %s manifests" % len(manifest_paths))
     if not args.force_delete:
-        buckets = delete_files(args.manifest_path, dry_run=True)
+        buckets = delete_files(manifest_paths, dry_run=True, threads=args.delete_threads, etag_check=args.etag_check)
         for bucket, keys in buckets.items():
-            print(" * To delete: %s items from s3://%s/%s" % (len(keys['keys']), bucket, commonprefix(keys['keys'])))
-            if keys['mismatched']:
-                print("   * WARNING: %s keys skipped because ETag doesn't match TarMD5" % len(keys['mismatched']))
-            if input("Delete objects? [y/N] ").lower() != 'y':
-                print("Canceled.")
-                return
-    buckets = delete_files(args.manifest_path, dry_run=False)
+            print(" * To delete: %s items from s3://%s/%s" % (
+                len(keys['keys']) - len(keys['changed']) - len(keys['missing']), bucket, commonprefix(keys['keys'])))
+            print_delete_warnings(keys)
+        if input("Delete objects? [y/N] ").lower() != 'y':
+            print("Canceled.")
+            return
+    buckets = delete_files(manifest_paths, dry_run=False, threads=args.delete_threads, etag_check=args.etag_check)
     for bucket, keys in buckets.items():
         print(" * Deleted %s items from s3://%s/%s" % (len(keys['deleted']), bucket, commonprefix(keys['keys'])))
-        if keys['mismatched']:
-            print("   * WARNING: %s keys skipped because ETag doesn't match TarMD5" % len(keys['mismatched']))
+        print_delete_warnings(keys)
         if keys['errors']:
-            print("   * WARNING: %s keys returned an error message (permissions issue or key not found)" % len(keys['errors']))
+            print("   * WARNING: %s keys returned an error message (e.g. permissions issue)" % len(keys['errors']))
+
+
+def print_delete_warnings(keys):
+    if keys['mismatched']:
+        print("   * WARNING: %s keys skipped because ETag doesn't match TarMD5" % len(keys['mismatched']))
+    if keys['changed']:
+        print("   * WARNING: %s keys skipped because they have changed since they were archived" % len(keys['changed']))
+    if keys['missing']:
+        print("   * %s keys skipped because they no longer exist" % len(keys['missing']))
 
 
 def archive_command(args, parser):
@@ -46,7 +79,13 @@ def archive_command(args, parser):
                     return
                 args.overwrite = True
 
-    write_tar(args.archive_url, args.manifest_path, args.tar_path, args.strip_prefix, progress_bar=args.progress_bar, overwrite=args.overwrite)
+    write_tar(args.archive_url, args.manifest_path, args.tar_path, args.strip_prefix, progress_bar=args.progress_bar, overwrite=args.overwrite, index=args.index,
+              checkpoint_path=args.checkpoint, part_size=args.part_size_mb * 2 ** 20, upload_threads=args.upload_threads,
+              max_threads=args.max_threads, memory_budget=args.memory_budget_mb * 2 ** 20, sha256=args.sha256,
+              inventory=args.inventory, list_threads=args.list_threads,
+              shard_size=args.shard_size_mb and args.shard_size_mb * 2 ** 20, shard_members=args.shard_members,
+              writer_threads=args.writer_threads, previous_manifests=args.previous_manifests, dedup=args.dedup,
+              ordered=args.ordered, compress_threads=args.compress_threads)
     if args.validate:
         do_validate(args)
     if args.delete:
@@ -58,15 +97,59 @@ def validate_command(args, parser):
 
 
 def delete_command(args, parser):
+    jobs = [(args.manifest_path, args.tar_path)] if args.manifest_path else []
+    if args.manifests_from:
+        with open(args.manifests_from) as f:
+            jobs.extend((line.split() + [None])[:2] for line in f if line.strip())
+    if not jobs:
+        parser.error("manifest_path or --manifests-from is required.")
     if args.validate:
-        if not args.tar_path:
-            parser.error("tar_path is required unless --no-validate is set.")
-        do_validate(args)
-    do_delete(args)
+        for manifest_path, tar_path in jobs:
+            if not tar_path:
+                parser.error("a tar_path is required for each manifest unless --no-validate is set.")
+            args.manifest_path, args.tar_path = manifest_path, tar_path
+            do_validate(args)
+    do_delete(args, [manifest_path for manifest_path, tar_path in jobs])
+
+
+def sample_command(args, parser):
+    jobs = [(args.manifest_path, args.tar_path)] if args.manifest_path else []
+    if args.manifests_from:
+        with open(args.manifests_from) as f:
+            jobs.extend(line.split()[:2] for line in f if line.strip())
+    if not jobs or not all(len(job) == 2 and job[1] for job in jobs):
+        parser.error("manifest_path and tar_path, or --manifests-from listing both for each archive, are required.")
+    reports = sample_tars(jobs, args.confidence, args.defect_rate, args.budget_mb and args.budget_mb * 2 ** 20,
+                          threads=args.threads, seed=args.seed, progress_bar=args.progress_bar)
+    failed = 0
+    for report in reports:
+        print("%s: checked %s of %s files, %s of %s bytes; %.4f confidence" % (
+            report['TarPath'], report['SampledFiles'], report['Files'], report['SampledBytes'], report['Bytes'],
+            report['Confidence']))
+        for key, error in report['Failures']:
+            print("   * FAILED: %s: %s" % (key, error))
+        failed += bool(report['Failures'])
+    if args.report:
+        write_dicts_to_csv(args.report, ({**report, 'Failures': json.dumps(report['Failures'])} for report in reports))
+    if failed:
+        parser.exit(1, "%s of %s archives failed validation.\n" % (failed, len(reports)))
 
 
 def extract_command(args, parser):
-    with open_archived_file(args.manifest_path, args.tar_path, args.file_path) as f:
+    file_paths = list(args.file_paths)
+    if args.files_from:
+        with open(args.files_from) as f:
+            file_paths.extend(line.strip() for line in f if line.strip())
+    if not file_paths and not args.prefix:
+        parser.error("at least one file_path, --files-from, or --prefix is required.")
+    if len(file_paths) != 1 or args.prefix or args.out_dir:
+        if not args.out_dir:
+            parser.error("--out-dir is required when extracting more than one file.")
+        paths = extract_files(args.manifest_path, args.tar_path, args.out_dir, file_paths, args.prefix,
+                              threads=args.threads, progress_bar=args.progress_bar)
+        print("Extracted %s files to %s" % (len(paths), args.out_dir))
+        return
+    with open_archived_file(args.manifest_path, args.tar_path, file_paths[0]) as f:
         if args.out:
             with open(args.out, 'wb') as out:
                 copyfileobj(f, out)
@@ -74,6 +157,51 @@ def extract_command(args, parser):
             copyfileobj(f, sys.stdout.buffer)
 
 
+def restore_command(args, parser):
+    file_paths = list(args.file_paths)
+    if args.files_from:
+        with open(args.files_from) as f:
+            file_paths.extend(line.strip() for line in f if line.strip())
+    if not file_paths and not args.prefix:
+        parser.error("at least one file_path, --files-from, or --prefix is required.")
+    results = restore_files(args.manifest_path, args.tar_path, file_paths, args.prefix, threads=args.threads,
+                            overwrite=args.overwrite, progress_bar=args.progress_bar)
+    print("Restored %s files" % len(results['restored']))
+    if results['existing']:
+        print(" * %s files skipped because they already exist; use --overwrite to replace them" % len(results['existing']))
+
+
+def split_inventory_command(args, parser):
+    archive_urls = list(args.archive_urls)
+    if args.urls_from:
+        with open(args.urls_from) as f:
+            archive_urls.extend(line.strip() for line in f if line.strip())
+    if not archive_urls:
+        parser.error("at least one archive_url or --urls-from is required.")
+    paths = split_inventory(args.inventory_path, archive_urls, args.out_dir)
+    for archive_url, path in paths.items():
+        print("%s: %s" % (archive_url, path))
+
+
+def convert_manifest_command(args, parser):
+    if not args.overwrite and exists(args.out_path):
+        if input("%s already exists. Overwrite? [y/N] " % args.out_path).lower() != 'y':
+            print("Canceled.")
+            return
+    convert_manifest(args.manifest_path, args.out_path, index=args.index)
+    print("Wrote %s" % args.out_path)
+
+
+def batch_command(args, parser):
+    print("Running jobs from %s, tracking progress in %s" % (args.jobs_path, args.state_path))
+    counts = run_batch(args.jobs_path, args.state_path, processes=args.processes, validate=args.validate, delete=args.delete,
+                       validate_threads=args.validate_threads, progress_bar=args.progress_bar, sha256=args.sha256,
+                       part_size=args.part_size_mb * 2 ** 20, upload_threads=args.upload_threads, max_threads=args.max_threads,
+                       memory_budget=args.memory_budget_mb * 2 ** 20, list_threads=args.list_threads)
+    for state, count in counts.items():
+        print(" * %s: %s jobs" % (state, count))
+
+
 def main(args=None):
     parser = argparse.ArgumentParser(description='Archive files on S3.')
     parser.add_argument('--no-progress', dest='progress_bar', action='store_false', help="Don't show progress bar when archiving and validating")
@@ -83,37 +211,124 @@ def main(args=None):
     # archive
     create_parser = subparsers.add_parser('archive', help='Create a new tar archive and manifest.')
     create_parser.add_argument('archive_url', help='S3 prefix to archive, e.g. s3://bucket/prefix/')
-    create_parser.add_argument('manifest_path', help='Path or S3 URL for output manifest file')
+    create_parser.add_argument('manifest_path', help='Path or S3 URL for output manifest file; written as Parquet if it ends in .parquet, otherwise as csv')
     create_parser.add_argument('tar_path', help='Path or S3 URL for output tar file')
     create_parser.add_argument('--strip-prefix', help='optional prefix to strip from inventory file when writing tar', default='')
     create_parser.add_argument('--no-validate', dest='validate', action='store_false', help="Don't validate tar against manifest after creating")
     create_parser.add_argument('--delete', dest='delete', action='store_true', help="Delete files from archive_url after archiving")
     create_parser.add_argument('--force-delete', dest='force_delete', action='store_true', help="Delete files from archive_url without asking")
     create_parser.add_argument('--overwrite', dest='overwrite', action='store_true', help="Overwrite existing manifest_path and tar_path without asking")
-    create_parser.set_defaults(func=archive_command, validate=True, delete=False, force_delete=False, overwrite=False)
+    create_parser.add_argument('--validate-threads', type=int, default=1, help="Validate segments of the tar concurrently with this many range requests")
+    create_parser.add_argument('--no-index', dest='index', action='store_false', help="Don't write a sparse index of the manifest for fast extract")
+    create_parser.add_argument('--checkpoint', help="Local path to save progress to; rerun with the same --checkpoint to resume an interrupted archive")
+    create_parser.add_argument('--part-size-mb', type=part_size_mb, default=PART_SIZE // 2 ** 20, help="Size of tar upload parts, and how often to save checkpoints, in MiB")
+    create_parser.add_argument('--upload-threads', type=int, default=UPLOAD_THREADS, help="Number of tar parts to upload to S3 at once")
+    create_parser.add_argument('--max-threads', type=int, default=MAX_THREADS, help="Most objects to fetch at once; concurrency adapts up to this limit")
+    create_parser.add_argument('--memory-budget-mb', type=int, default=MEMORY_BUDGET // 2 ** 20, help="Approximate cap on fetched object data held in RAM, in MiB")
+    create_parser.add_argument('--inventory', help="S3 Inventory manifest.json, or a csv written by split-inventory, to find objects in instead of listing archive_url")
+    create_parser.add_argument('--list-threads', type=int, default=THREADS, help="Number of concurrent requests when listing archive_url; 1 lists sequentially")
+    create_parser.add_argument('--shard-size-mb', type=int, help="Write a set of tar shards of at most about this many MiB each, named like <tar_path>.00000.tar, instead of one tar")
+    create_parser.add_argument('--shard-members', type=int, help="Write a set of tar shards of at most this many files each instead of one tar")
+    create_parser.add_argument('--writer-threads', type=int, default=1, help="Number of tar shards to write at once")
+    create_parser.add_argument('--sha256', action='store_true', help="Also record the SHA-256 of each file in the manifest's TarSHA256 column")
+    create_parser.add_argument('--previous-manifest', dest='previous_manifests', action='append', default=[],
+                               help="Only archive files that are new or changed since this manifest; repeat for a chain of manifests, oldest first. "
+                                    "Every file listed is held in memory, about 300MB per million files")
+    create_parser.add_argument('--dedup', action='store_true', help="Store identical files once, writing later copies as hard links to the first")
+    create_parser.add_argument('--compress-threads', type=int, default=COMPRESS_THREADS, help="Number of gzip frames to compress at once when tar_path ends in .gz")
+    create_parser.add_argument('--ordered', action='store_true', help="Write files to the tar in key order, matching the manifest, so files under a prefix are contiguous")
+    create_parser.set_defaults(func=archive_command, validate=True, delete=False, force_delete=False, overwrite=False, index=True, headers_only=False, quick=False,
+                               delete_threads=THREADS, etag_check='list')
 
     # validate
     create_parser = subparsers.add_parser('validate', help='Validate an existing tar archive and manifest.')
     create_parser.add_argument('manifest_path', help='Path or URL for manifest file')
     create_parser.add_argument('tar_path', help='Path or URL for tar file')
+    create_parser.add_argument('--threads', dest='validate_threads', type=int, default=1, help="Validate segments of the tar concurrently with this many range requests")
+    create_parser.add_argument('--headers-only', action='store_true', help="Only check the tar headers, end-of-archive marker, and tar size against the manifest, without reading file contents")
+    create_parser.add_argument('--quick', action='store_true', help="Only compare the tar's size and S3 ETag with the checksums recorded when it was written, without reading the manifest or tar")
     create_parser.set_defaults(func=validate_command)
 
     # delete
     create_parser = subparsers.add_parser('delete', help='Delete original files listed in manifest.')
-    create_parser.add_argument('manifest_path', help='Path or URL for manifest file')
+    create_parser.add_argument('manifest_path', nargs='?', help='Path or URL for manifest file')
     create_parser.add_argument('tar_path', nargs='?', help='Path or URL for tar file')
+    create_parser.add_argument('--manifests-from', help='Path or URL of a list of manifests to delete files from, one per line, each optionally followed by a space and its tar path')
     create_parser.add_argument('--no-validate', dest='validate', action='store_false', help="Don't validate tar against manifest before deleting")
     create_parser.add_argument('--force-delete', dest='force_delete', action='store_true', help="Delete without asking")
-    create_parser.set_defaults(func=delete_command, validate=True, force_delete=False)
+    create_parser.add_argument('--validate-threads', type=int, default=1, help="Validate segments of the tar concurrently with this many range requests")
+    create_parser.add_argument('--threads', dest='delete_threads', type=int, default=THREADS, help="Number of concurrent manifest reads, ETag checks, and delete batches")
+    create_parser.add_argument('--etag-check', choices=('list', 'head'), default='list', help="Check current ETags before deleting by listing each manifest's prefix, or with one HeadObject request per file")
+    create_parser.set_defaults(func=delete_command, validate=True, force_delete=False, headers_only=False, quick=False)
+
+    # split-inventory
+    create_parser = subparsers.add_parser('split-inventory', help='Split an S3 Inventory report into one object list per archive.')
+    create_parser.add_argument('inventory_path', help='Path or URL of S3 Inventory manifest.json')
+    create_parser.add_argument('out_dir', help='Local directory to write <out_dir>/<bucket>/<prefix>/inventory.csv for each archive_url')
+    create_parser.add_argument('archive_urls', nargs='*', metavar='archive_url', help='S3 prefix to be archived, e.g. s3://bucket/prefix/')
+    create_parser.add_argument('--urls-from', help='Path or URL of a list of S3 prefixes to be archived, one per line')
+    create_parser.set_defaults(func=split_inventory_command)
+
+    # convert-manifest
+    create_parser = subparsers.add_parser('convert-manifest', help='Convert a manifest between csv and Parquet formats.')
+    create_parser.add_argument('manifest_path', help='Path or URL for existing manifest file')
+    create_parser.add_argument('out_path', help='Path or URL for converted manifest file; written as Parquet if it ends in .parquet, otherwise as csv')
+    create_parser.add_argument('--no-index', dest='index', action='store_false', help="Don't write a sparse index of a csv manifest for fast extract")
+    create_parser.add_argument('--overwrite', action='store_true', help="Overwrite existing out_path without asking")
+    create_parser.set_defaults(func=convert_manifest_command)
+
+    # batch
+    create_parser = subparsers.add_parser('batch', help='Archive many prefixes, resuming where a previous run stopped.')
+    create_parser.add_argument('jobs_path', help='Path or URL of a csv of jobs with archive_url, manifest_path, and tar_path columns')
+    create_parser.add_argument('state_path', help='Local path of a SQLite database to track the progress of each job in')
+    create_parser.add_argument('--processes', type=int, default=4, help="Number of jobs to run at once, each in its own process")
+    create_parser.add_argument('--no-validate', dest='validate', action='store_false', help="Don't validate each tar against its manifest after creating")
+    create_parser.add_argument('--delete', dest='delete', action='store_true', help="Delete files from each archive_url, without asking, after validating")
+    create_parser.add_argument('--validate-threads', type=int, default=1, help="Validate segments of each tar concurrently with this many range requests")
+    create_parser.add_argument('--part-size-mb', type=part_size_mb, default=PART_SIZE // 2 ** 20, help="Size of tar upload parts, and how often to save checkpoints, in MiB")
+    create_parser.add_argument('--upload-threads', type=int, default=UPLOAD_THREADS, help="Number of tar parts to upload to S3 at once, per job")
+    create_parser.add_argument('--max-threads', type=int, default=MAX_THREADS, help="Most objects to fetch at once, per job")
+    create_parser.add_argument('--memory-budget-mb', type=int, default=MEMORY_BUDGET // 2 ** 20, help="Approximate cap on fetched object data held in RAM, per job, in MiB")
+    create_parser.add_argument('--list-threads', type=int, default=THREADS, help="Number of concurrent requests when listing each archive_url")
+    create_parser.add_argument('--sha256', action='store_true', help="Also record the SHA-256 of each file in the manifest's TarSHA256 column")
+    create_parser.set_defaults(func=batch_command, validate=True, delete=False)
+
+    # sample
+    create_parser = subparsers.add_parser('sample', help='Validate a random sample of files from one or more archives.')
+    create_parser.add_argument('manifest_path', nargs='?', help='Path or URL for manifest file')
+    create_parser.add_argument('tar_path', nargs='?', help='Path or URL for tar file')
+    create_parser.add_argument('--manifests-from', help='Path or URL of a list of archives to sample, one per line, each a manifest path followed by a space and its tar path')
+    create_parser.add_argument('--confidence', type=float, default=SAMPLE_CONFIDENCE, help="Sample enough files to catch --defect-rate corruption with this probability")
+    create_parser.add_argument('--defect-rate', type=float, default=SAMPLE_DEFECT_RATE, help="Fraction of corrupt files in an archive that the sample should catch")
+    create_parser.add_argument('--budget-mb', type=positive_int, help="Read at most this many MiB of file data from each archive")
+    create_parser.add_argument('--threads', type=int, default=THREADS, help="Number of concurrent manifest reads and range requests, across all archives")
+    create_parser.add_argument('--seed', type=int, help="Random seed, to repeat a sample")
+    create_parser.add_argument('--report', help="Path or URL to write a csv report to, one row per archive")
+    create_parser.set_defaults(func=sample_command)
 
     # extract
-    create_parser = subparsers.add_parser('extract', help='Extract a file from an archive.')
+    create_parser = subparsers.add_parser('extract', help='Extract files from an archive.')
     create_parser.add_argument('manifest_path', help='Path or URL for manifest file')
     create_parser.add_argument('tar_path', help='Path or URL for tar file')
-    create_parser.add_argument('file_path', help='URL of file to extract from manifest, e.g. s3://<Bucket>/<Key>')
-    create_parser.add_argument('--out', help='optional output path; default stdout')
+    create_parser.add_argument('file_paths', nargs='*', metavar='file_path', help='URL of file to extract from manifest, e.g. s3://<Bucket>/<Key>')
+    create_parser.add_argument('--out', help='optional output path for a single file; default stdout')
+    create_parser.add_argument('--files-from', help='Path or URL of a list of file URLs to extract, one per line')
+    create_parser.add_argument('--prefix', help='Extract all files under this URL prefix, e.g. s3://<Bucket>/<Key prefix>')
+    create_parser.add_argument('--out-dir', help='Path or URL to write files to as <out-dir>/<Key>; required for more than one file')
+    create_parser.add_argument('--threads', type=int, default=THREADS, help='Number of concurrent range requests when extracting more than one file')
     create_parser.set_defaults(func=extract_command)
 
+    # restore
+    create_parser = subparsers.add_parser('restore', help='Copy files from an archive on S3 back to their original locations.')
+    create_parser.add_argument('manifest_path', help='Path or URL for manifest file')
+    create_parser.add_argument('tar_path', help='S3 URL for tar file')
+    create_parser.add_argument('file_paths', nargs='*', metavar='file_path', help='URL of file to restore from manifest, e.g. s3://<Bucket>/<Key>')
+    create_parser.add_argument('--files-from', help='Path or URL of a list of file URLs to restore, one per line')
+    create_parser.add_argument('--prefix', help='Restore all files under this URL prefix, e.g. s3://<Bucket>/<Key prefix>')
+    create_parser.add_argument('--overwrite', action='store_true', help="Replace files that already exist instead of skipping them")
+    create_parser.add_argument('--threads', type=int, default=THREADS, help='Number of files to restore at once')
+    create_parser.set_defaults(func=restore_command)
+
     args = parser.parse_args(args)
     if hasattr(args, 'func'):
         args.func(args, parser)
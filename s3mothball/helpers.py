@@ -1,20 +1,45 @@
+import bisect
 import concurrent.futures
 import copy
 import csv
+import gzip
 import hashlib
+import heapq
+import io
 import itertools
+import json
+import math
+import os
+import queue
 import tarfile
-from io import BytesIO
+import threading
+from array import array
+from collections import OrderedDict, deque
+from io import BytesIO, StringIO
+from operator import itemgetter
 from pathlib import Path
-from shutil import copyfileobj
-from tempfile import SpooledTemporaryFile
-from time import sleep
+from tempfile import TemporaryDirectory
+from time import monotonic, sleep
+from urllib.parse import unquote_plus
 
 import boto3
+from botocore.config import Config
 from smart_open import open
 from smart_open.s3 import parse_uri
 
-from s3mothball.settings import SPOOLED_FILE_SIZE, THREADS
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# some pyarrow builds don't include ORC support
+try:
+    from pyarrow import orc as pyarrow_orc
+except ImportError:
+    pyarrow_orc = None
+
+from s3mothball.settings import SPOOLED_FILE_SIZE, THREADS, MAX_THREADS, MANIFEST_INDEX_BLOCK_SIZE, MANIFEST_SORT_CHUNK_SIZE, PART_SIZE, \
+    RANGED_GET_SIZE, RANGED_GET_THREADS, UPLOAD_THREADS, MANIFEST_ROW_GROUP_SIZE
 
 
 class HashingFile:
@@ -29,6 +54,11 @@ class HashingFile:
         self.update_hash(result)
         return result
 
+    def readinto(self, buffer):
+        length = self._source.readinto(buffer)
+        self.update_hash(memoryview(buffer)[:length])
+        return length
+
     def write(self, value, *args, **kwargs):
         self.update_hash(value)
         return self._source.write(value, *args, **kwargs)
@@ -43,10 +73,22 @@ class HashingFile:
     def __getattr__(self, attr):
         return getattr(self._source, attr)
 
+    def __enter__(self):
+        self._source.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._source.__exit__(*args)
+
 
 class LoggingTarFile(tarfile.TarFile):
-    """ TarFile subclass that sets tarinfo.offset and tarinfo.offset_data on records when written. """
+    """
+        TarFile subclass that sets tarinfo.offset and tarinfo.offset_data on records when written, and calls the
+        start_member() method of the file it writes to, if it has one, before each member (see GzipFrameWriter).
+    """
     def addfile(self, tarinfo, fileobj=None):
+        if hasattr(self.fileobj, 'start_member'):
+            self.fileobj.start_member()
         tarinfo = copy.copy(tarinfo)
         buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
         tarinfo.offset = self.offset
@@ -54,51 +96,151 @@ class LoggingTarFile(tarfile.TarFile):
         super().addfile(tarinfo, fileobj)
 
 
-class TeeFile:
+class TarMember:
+    """ Header of a tar member read by TarReader, with the TarInfo attributes validation needs. """
+    __slots__ = ('name', 'type', 'linkname', 'size', 'offset', 'offset_data')
+
+    def __init__(self, name, type, linkname, size, offset, offset_data):
+        self.name = name
+        self.type = type
+        self.linkname = linkname
+        self.size = size
+        self.offset = offset
+        self.offset_data = offset_data
+
+    def islnk(self):
+        return self.type == tarfile.LNKTYPE
+
+
+class TarReader:
     """
-        File wrapper that tees a file object so it can be read multiple times.
+        Streaming tar parser that reads file f once, through a single reused buffer of buffer_size bytes. Iterating
+        yields a TarMember for each member, with offsets relative to the start of f; read(member.size) then yields
+        the member's data as memoryviews into the buffer, which are only valid until the next read. Data that isn't
+        read is skipped. Supports ustar headers with PAX ('x', 'g') and GNU ('L', 'K') extensions, which covers the
+        formats tarfile writes. Unreadable input raises tarfile.ReadError. After iteration, end_marker is True if the
+        stream ended with an end-of-archive block rather than at a member boundary.
 
-        >>> source = BytesIO(b'12345678')
-        >>> f1, f2 = TeeFile.tee(source)
-        >>> assert f1.read(2) == f2.read(2) == b'12'
-        >>> assert f1.read(2) == f2.read(2) == b'34'
-        >>> assert f2.read(2) == f1.read(2) == b'56'
-        >>> assert f2.read(2) == f1.read(2) == b'78'
-        >>> assert f1.my_buffer is f2.your_buffer == []
-        >>> assert f2.my_buffer is f1.your_buffer == []
-    """
-    def __init__(self, source, my_buffer, your_buffer):
-        self.source = source
-        self.my_buffer = my_buffer
-        self.your_buffer = your_buffer
-        self.pos = 0
+        >>> data = BytesIO()
+        >>> with tarfile.open(fileobj=data, mode='w') as tar:
+        ...     for name, contents in (('a.txt', b'abc'), ('b' * 120, b'')):
+        ...         info = tarfile.TarInfo(name)
+        ...         info.size = len(contents)
+        ...         tar.addfile(info, BytesIO(contents))
+        >>> reader = TarReader(BytesIO(data.getvalue()), buffer_size=1024)
+        >>> [(m.name[:3], m.offset, m.offset_data, m.size, b''.join(reader.read(m.size))) for m in reader]
+        [('a.t', 0, 512, 3, b'abc'), ('bbb', 1024, 2560, 0, b'')]
+        >>> reader.end_marker
+        True
+    """
+    def __init__(self, f, buffer_size=SPOOLED_FILE_SIZE):
+        self.f = f
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = self.end = 0
+        self.offset = 0
+        self.end_marker = False
+
+    def fill(self):
+        """ Move unread bytes to the front of the buffer and read more. Return False at the end of f. """
+        remaining = self.end - self.start
+        self.buffer[:remaining] = self.view[self.start:self.end]
+        self.start, self.end = 0, remaining
+        length = read_into(self.f, self.view[remaining:])
+        self.end += length
+        return length > 0
 
     def read(self, size):
-        if size == 0:
-            return b''
-        out = b''
-        if self.my_buffer:
-            s = b''.join(self.my_buffer)
-            out, s = s[:size], s[size:]
-            self.my_buffer.clear()
-            if s:
-                self.my_buffer.append(s)
-            size -= len(out)
-        if size:
-            extra = self.source.read(size)
-            self.your_buffer.append(extra)
-            out += extra
-        self.pos += len(out)
-        return out
+        while size > 0:
+            if self.start == self.end and not self.fill():
+                raise tarfile.ReadError("Unexpected end of tar file at offset %s" % self.offset)
+            length = min(size, self.end - self.start)
+            chunk = self.view[self.start:self.start + length]
+            self.start += length
+            self.offset += length
+            size -= length
+            yield chunk
 
-    def tell(self):
-        return self.pos
+    def read_bytes(self, size):
+        return b''.join(bytes(chunk) for chunk in self.read(size))
 
-    @classmethod
-    def tee(cls, f):
-        b1 = []
-        b2 = []
-        return cls(f, b1, b2), cls(f, b2, b1)
+    def skip(self, size):
+        for _ in self.read(size):
+            pass
+
+    def __iter__(self):
+        pax_headers = {}
+        long_names = {}
+        header_offset = None
+        while True:
+            if self.start == self.end and not self.fill():
+                return  # end of stream at a member boundary
+            block_offset = self.offset
+            block = self.read_bytes(tarfile.BLOCKSIZE)
+            if block == tarfile.NUL * tarfile.BLOCKSIZE:
+                self.end_marker = True
+                return
+            try:
+                checksum = tarfile.nti(block[148:156])
+                size = tarfile.nti(block[124:136])
+            except tarfile.HeaderError:
+                raise tarfile.ReadError("Invalid tar header at offset %s" % block_offset)
+            if checksum not in tarfile.calc_chksums(block):
+                raise tarfile.ReadError("Invalid tar header checksum at offset %s" % block_offset)
+            if header_offset is None:
+                header_offset = block_offset
+            member_type = block[156:157]
+            if member_type in (tarfile.XHDTYPE, tarfile.XGLTYPE):
+                records = self.read_bytes(size)
+                self.skip(-size % tarfile.BLOCKSIZE)
+                if member_type == tarfile.XGLTYPE:
+                    header_offset = None  # global headers aren't part of the next member
+                else:
+                    pax_headers.update(parse_pax_records(records))
+                continue
+            if member_type in (tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK):
+                long_names[member_type] = tarfile.nts(self.read_bytes(size), 'utf-8', 'surrogateescape')
+                self.skip(-size % tarfile.BLOCKSIZE)
+                continue
+
+            name = tarfile.nts(block[0:100], 'utf-8', 'surrogateescape')
+            if block[257:263] == tarfile.POSIX_MAGIC:
+                prefix = tarfile.nts(block[345:500], 'utf-8', 'surrogateescape')
+                if prefix:
+                    name = prefix + '/' + name
+            name = pax_headers.get('path') or long_names.get(tarfile.GNUTYPE_LONGNAME) or name
+            linkname = pax_headers.get('linkpath') or long_names.get(tarfile.GNUTYPE_LONGLINK) or \
+                tarfile.nts(block[157:257], 'utf-8', 'surrogateescape')
+            if 'size' in pax_headers:
+                size = int(pax_headers['size'])
+            # like tarfile, only regular files and unknown types have data in the archive
+            if member_type not in tarfile.REGULAR_TYPES and member_type in tarfile.SUPPORTED_TYPES:
+                size = 0
+            member = TarMember(name, member_type, linkname, size, header_offset, self.offset)
+            data_end = self.offset + size
+            yield member
+            self.skip(data_end - self.offset + (-size % tarfile.BLOCKSIZE))
+            pax_headers = {}
+            long_names = {}
+            header_offset = None
+
+
+def parse_pax_records(records):
+    """
+        Parse PAX extended header records into a dict.
+
+        >>> parse_pax_records(b'16 path=foo/bar\\n11 size=42\\n')
+        {'path': 'foo/bar', 'size': '42'}
+    """
+    headers = {}
+    pos = 0
+    while pos < len(records) and records[pos:pos + 1] != tarfile.NUL:
+        length, _, rest = records[pos:].partition(b' ')
+        record = records[pos + len(length) + 1:pos + int(length) - 1]
+        keyword, _, value = record.partition(b'=')
+        headers[keyword.decode('utf-8')] = value.decode('utf-8', 'surrogateescape')
+        pos += int(length)
+    return headers
 
 
 class OffsetSizeFile:
@@ -127,6 +269,37 @@ class OffsetSizeFile:
         self.pos += len(out)
         return out
 
+    def close(self):
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+s3_connections = {}
+s3_connections_lock = threading.Lock()
+
+
+def s3_resource():
+    """
+        boto3 S3 resource shared by every thread in this process, so connections are reused across calls, and across
+        jobs run by the same `s3mothball batch` worker. Its connection pool is sized for MAX_THREADS concurrent
+        requests.
+    """
+    pid = os.getpid()  # don't share connections with forked processes
+    with s3_connections_lock:
+        if pid not in s3_connections:
+            s3_connections[pid] = boto3.resource('s3', config=Config(max_pool_connections=MAX_THREADS))
+        return s3_connections[pid]
+
+
+def s3_client():
+    """ boto3 S3 client shared by every thread in this process; see s3_resource(). """
+    return s3_resource().meta.client
+
 
 def make_parent_dir(path):
     if path.startswith('s3://'):
@@ -134,35 +307,381 @@ def make_parent_dir(path):
     Path(path).parent.mkdir(exist_ok=True, parents=True)
 
 
-def threaded_queue(func, items):
+class S3MultipartWriter:
+    """
+        Write-only file object that streams to an S3 URL with a multipart upload.
+
+        Once more than max_buffer_size bytes are buffered, part_size bytes are handed to a pool of `threads` upload
+        threads, so uploading doesn't block the thread writing the tar. At most `threads` parts are in flight at
+        once; further writes wait for an upload to finish, so memory use is bounded to about
+        (threads + 1) * max_buffer_size.
+
+        checkpoint() uploads everything buffered so far, waits for all uploads, and returns a json-serializable state
+        that can be passed back as resume_state to continue the same upload from that point in a new process.
+        If resumable is True, closing after an exception leaves the upload open so it can be resumed, once there is
+        a checkpoint (or resume_state) to resume it from; otherwise the upload is aborted.
+    """
+    def __init__(self, url, part_size=PART_SIZE, max_buffer_size=None, threads=UPLOAD_THREADS, resumable=False,
+                 resume_state=None, client=None):
+        parsed = parse_uri(url)
+        self.bucket = parsed['bucket_id']
+        self.key = parsed['key_id']
+        self.client = client or s3_client()
+        self.part_size = part_size
+        self.max_buffer_size = max(max_buffer_size or part_size, part_size)
+        self.threads = threads
+        self.resumable = resumable
+        self.checkpointed = bool(resume_state)
+        self.buffer = bytearray()
+        if resume_state:
+            self.upload_id = resume_state['UploadId']
+            self.parts = resume_state['Parts']
+            self.position = resume_state['Position']
+        else:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+            self.parts = []
+            self.position = 0
+        self.next_part_number = len(self.parts) + 1
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.futures = set()
+
+    @property
+    def buffered(self):
+        return len(self.buffer)
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.max_buffer_size:
+            self.upload_part(self.part_size)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def upload_part(self, size=None):
+        """ Queue the first `size` bytes of the buffer, or the whole buffer, for upload as the next part. """
+        if size is None or size >= len(self.buffer):
+            body, self.buffer = self.buffer, bytearray()
+        else:
+            body = self.buffer[:size]
+            del self.buffer[:size]
+        while len(self.futures) >= self.threads:
+            self.wait(concurrent.futures.FIRST_COMPLETED)
+        self.futures.add(self.executor.submit(self.send_part, self.next_part_number, body))
+        self.next_part_number += 1
+
+    def send_part(self, part_number, body):
+        body = bytes(body)
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body)
+        return {'PartNumber': part_number, 'ETag': response['ETag'], 'Size': len(body), 'MD5': hashlib.md5(body).hexdigest()}
+
+    def wait(self, return_when=concurrent.futures.ALL_COMPLETED):
+        """ Wait for part uploads to finish and record them, raising any upload error. """
+        done, self.futures = concurrent.futures.wait(self.futures, return_when=return_when)
+        for future in done:
+            self.parts.append(future.result())
+        self.parts.sort(key=itemgetter('PartNumber'))
+
+    def checkpoint(self):
+        if self.buffer:
+            self.upload_part()
+        self.wait()
+        self.checkpointed = True
+        return {'UploadId': self.upload_id, 'Parts': self.parts, 'Position': self.position}
+
+    def close(self):
+        if self.buffer or self.next_part_number == 1:
+            self.upload_part()
+        self.wait()
+        self.executor.shutdown()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': p['PartNumber'], 'ETag': p['ETag']} for p in self.parts]})
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        elif self.resumable and self.checkpointed:
+            self.executor.shutdown()
+        else:
+            self.abort()
+
+
+class LocalCheckpointWriter:
+    """
+        Local file counterpart to S3MultipartWriter: checkpoint() syncs the file to disk and returns its size, and
+        resume_state truncates the file back to that size and appends from there.
+    """
+    def __init__(self, path, resume_state=None):
+        if resume_state:
+            self.file = io.open(path, 'r+b')
+            self.file.truncate(resume_state['Position'])
+            self.file.seek(resume_state['Position'])
+        else:
+            self.file = io.open(path, 'wb')
+        self.checkpointed = self.file.tell()
+
+    @property
+    def buffered(self):
+        return self.file.tell() - self.checkpointed
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def tell(self):
+        return self.file.tell()
+
+    def checkpoint(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.checkpointed = self.file.tell()
+        return {'Position': self.checkpointed}
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class GzipFrameWriter:
+    """
+        Writer that gzips everything written to it as a series of independent gzip members ("frames"), written in
+        order to raw, another writer. The output is an ordinary .gz file, but each frame can also be decompressed on
+        its own, so parts of it can be read with range requests (see locate()).
+
+        A frame is cut when start_member() is called after at least frame_size bytes have been written to the
+        current frame, so tar members written by LoggingTarFile usually start a new frame, or within a write once
+        the frame reaches 2 * frame_size bytes. Frames are compressed by `threads` worker threads.
+
+        >>> import gzip
+        >>> raw = BytesIO()
+        >>> raw.close = lambda: None
+        >>> with GzipFrameWriter(raw, frame_size=4) as f:
+        ...     for member in (b'abc', b'defgh', b'ijklmnopqrst', b'u'):
+        ...         f.start_member()
+        ...         _ = f.write(member)
+        >>> gzip.decompress(raw.getvalue())
+        b'abcdefghijklmnopqrstu'
+        >>> list(f.frame_starts)
+        [0, 8, 20]
+        >>> frame_offset, offset, size = f.locate(10, 12)
+        >>> frame_offset, gzip.decompress(raw.getvalue()[offset:offset + size])
+        (8, b'ijklmnopqrst')
+    """
+    def __init__(self, raw, frame_size, threads=1, compresslevel=6):
+        self.raw = raw
+        self.frame_size = frame_size
+        self.compresslevel = compresslevel
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = threads * 2
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.position = 0
+        self.compressed_position = 0
+        self.frame_starts = array('q')
+        self.compressed_starts = array('q')
+
+    def start_member(self):
+        if len(self.buffer) >= self.frame_size:
+            self.cut_frame()
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        if len(self.buffer) >= 2 * self.frame_size:
+            self.cut_frame()
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def cut_frame(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        self.pending.append((self.position - len(data), self.executor.submit(gzip.compress, data, self.compresslevel, mtime=0)))
+        while len(self.pending) > self.max_pending:
+            self.write_frame()
+
+    def write_frame(self):
+        frame_start, future = self.pending.popleft()
+        frame = future.result()
+        self.raw.write(frame)
+        self.frame_starts.append(frame_start)
+        self.compressed_starts.append(self.compressed_position)
+        self.compressed_position += len(frame)
+
+    def locate(self, start, end):
+        """
+            Return (frame_offset, compressed_offset, compressed_size) for the run of frames holding uncompressed
+            bytes [start, end): decompressing compressed_size bytes from compressed_offset gives data starting
+            at uncompressed offset frame_offset.
+        """
+        first = bisect.bisect_right(self.frame_starts, start) - 1
+        last = bisect.bisect_right(self.frame_starts, max(start, end - 1))
+        compressed_end = self.compressed_starts[last] if last < len(self.compressed_starts) else self.compressed_position
+        return self.frame_starts[first], self.compressed_starts[first], compressed_end - self.compressed_starts[first]
+
+    def close(self):
+        try:
+            if self.buffer or not self.frame_starts and not self.pending:
+                self.cut_frame()
+            while self.pending:
+                self.write_frame()
+        finally:
+            self.executor.shutdown()
+            self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+            return
+        # don't flush a partial archive; let raw abort its upload
+        self.executor.shutdown(cancel_futures=True)
+        self.raw.__exit__(exc_type, *args)
+
+
+def open_tar_writer(path, part_size=PART_SIZE, upload_threads=UPLOAD_THREADS, resumable=False, resume_state=None):
+    """
+        Open path for writing a tar. S3 URLs are written with S3MultipartWriter, local paths with
+        LocalCheckpointWriter if resumable, and anything else with smart_open.
+        If resumable, the returned writer has a checkpoint() method and accepts resume_state (see S3MultipartWriter).
+    """
+    if path.startswith('s3://'):
+        # when resumable, parts are only cut at member boundaries by checkpoint() unless a member is very large
+        max_buffer_size = 4 * part_size if resumable else part_size
+        return S3MultipartWriter(path, part_size, max_buffer_size, upload_threads, resumable, resume_state)
+    if resumable:
+        return LocalCheckpointWriter(path, resume_state)
+    return open(path, 'wb', ignore_ext=True)
+
+
+def write_json_atomic(path, data):
+    """ Write data as json to the local path, replacing any existing file only once the new one is complete. """
+    temp_path = str(path) + '.tmp'
+    with io.open(temp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def threaded_queue(func, items, threads=THREADS, max_threads=None, byte_budget=None, item_size=None, ordered=False,
+                   held_bytes=None):
     """
         Create a thread pool to call func with each argument list in items, yielding each result as it is ready.
-        Implements backpressure: will not work on more than THREADS items at a time.
-        Return order is not guaranteed.
+        Implements backpressure: will not work on more than `threads` items at a time.
+        Return order is not guaranteed, unless ordered is True: then results are yielded in the order of items,
+        and results that finish early wait in a reorder window bounded by the same limits as items in flight.
+
+        >>> list(threaded_queue(lambda i: sleep(.01 * (3 - i)) or i, ((i,) for i in range(3)), ordered=True))
+        [0, 1, 2]
+
+        If max_threads is set, the number of items in flight adapts between 1 and max_threads, starting from
+        `threads`. Following Little's law, enough calls are kept in flight to cover func's average latency at the
+        rate the consumer takes results: slow calls with a fast consumer (like fetching small objects) raise
+        concurrency, and a slow consumer lowers it.
+
+        If byte_budget is set, item_size(*item) estimates the memory each item holds until the consumer is done with
+        it, and no new items are started while that would exceed byte_budget (one item is always allowed). If the
+        consumer hands results on to other threads, held_bytes() should return the memory still held by results it
+        has taken but not finished with, which is counted against byte_budget too.
     """
     items = iter(items)
-    futures = set()
-    with concurrent.futures.ThreadPoolExecutor(max_workers=THREADS) as executor:
-        def queue_item():
-            try:
-                item = next(items)
-            except StopIteration:
-                return
-            futures.add(executor.submit(func, *item))
-        for i in range(THREADS):
-            queue_item()
+    futures = {}
+    submitted = deque()
+    next_item = []
+    stats = {'latency': None, 'interval': None, 'target': threads, 'bytes': 0}
+
+    def timed_func(*args):
+        start = monotonic()
+        result = func(*args)
+        return monotonic() - start, result
+
+    def update_average(name, value, weight=.2):
+        stats[name] = value if stats[name] is None else stats[name] * (1 - weight) + value * weight
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads or threads) as executor:
+        def queue_items():
+            while len(futures) < stats['target']:
+                if not next_item:
+                    try:
+                        next_item.append(next(items))
+                    except StopIteration:
+                        return
+                size = item_size(*next_item[0]) if byte_budget else 0
+                if byte_budget and futures and stats['bytes'] + size + (held_bytes() if held_bytes else 0) > byte_budget:
+                    return
+                stats['bytes'] += size
+                future = executor.submit(timed_func, *next_item.pop())
+                futures[future] = size
+                if ordered:
+                    submitted.append(future)
+        queue_items()
         while futures:
-            future = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)[0].pop()
-            yield future.result()
-            futures.remove(future)
-            queue_item()
+            if ordered:
+                future = submitted.popleft()
+            else:
+                future = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)[0].pop()
+            latency, result = future.result()
+            yield_start = monotonic()
+            yield result
+            stats['bytes'] -= futures.pop(future)
+            if max_threads:
+                update_average('latency', latency)
+                update_average('interval', monotonic() - yield_start)
+                stats['target'] = max(1, min(max_threads, math.ceil(stats['latency'] / max(stats['interval'], 1e-6)) + 1))
+            queue_items()
 
 
-def write_dicts_to_csv(manifest_path, rows):
-    with open(manifest_path, 'w', newline='') as out:
-        writer = csv.DictWriter(out, fieldnames=list(rows[0].keys()))
-        writer.writeheader()
-        writer.writerows(rows)
+def write_dicts_to_csv(manifest_path, rows, index_path=None, index_block_size=MANIFEST_INDEX_BLOCK_SIZE):
+    """
+        Write rows to manifest_path as csv.
+
+        If index_path is set, also write a sparse index of manifest_path to index_path, listing the first Key and
+        the byte range of every block of index_block_size rows. If rows are sorted by Key, find_manifest_entry() can
+        then look up a single row with a couple of small range requests. manifest_path must not be compressed.
+    """
+    first_row, rows = peek(iter(rows))
+    line = StringIO()
+    writer = csv.DictWriter(line, fieldnames=list(first_row.keys()))
+
+    def write_line(write_func, *args):
+        line.seek(0)
+        line.truncate()
+        write_func(*args)
+        data = line.getvalue().encode('utf8')
+        out.write(data)
+        return len(data)
+
+    index = []
+    with open(manifest_path, 'wb') as out:
+        offset = write_line(writer.writeheader)
+        for i, row in enumerate(rows):
+            size = write_line(writer.writerow, row)
+            if index_path:
+                if i % index_block_size == 0:
+                    index.append(OrderedDict((('Key', row['Key']), ('Offset', offset), ('Size', 0))))
+                index[-1]['Size'] += size
+            offset += size
+
+    if index_path:
+        write_dicts_to_csv(index_path, index)
 
 
 def read_dicts_from_csv(manifest_path):
@@ -171,25 +690,904 @@ def read_dicts_from_csv(manifest_path):
             yield row
 
 
-def list_objects(s3_url):
+# manifest columns stored as integers in Parquet manifests
+MANIFEST_INT_COLUMNS = {'Size', 'TarOffset', 'TarDataOffset', 'TarSize', 'TarFrameOffset', 'TarCompressedOffset', 'TarCompressedSize'}
+
+
+def is_parquet(path):
+    """
+        True if path is a Parquet manifest, read and written with pyarrow instead of as csv.
+
+        >>> assert is_parquet('manifest.parquet') and not is_parquet('manifest.csv')
+    """
+    return path.endswith('.parquet')
+
+
+def require_pyarrow(path):
+    if pyarrow is None:
+        raise ImportError("Reading and writing Parquet manifests like %s requires pyarrow. Try pip install pyarrow." % path)
+
+
+def write_manifest(manifest_path, rows, index_path=None):
+    """
+        Write manifest rows to manifest_path, as Parquet if is_parquet(manifest_path) and otherwise as csv with an
+        optional sparse index (see write_dicts_to_csv()). Parquet manifests don't need a separate index.
+        A csv manifest written without an index replaces any index left at manifest_index_path() by an earlier
+        manifest at the same path, so lookups don't use its stale offsets.
+    """
+    if is_parquet(manifest_path):
+        write_dicts_to_parquet(manifest_path, rows)
+    else:
+        write_dicts_to_csv(manifest_path, rows, index_path)
+        if not index_path and exists(manifest_index_path(manifest_path)):
+            delete_path(manifest_index_path(manifest_path))
+
+
+def write_dicts_to_parquet(manifest_path, rows, row_group_size=MANIFEST_ROW_GROUP_SIZE):
+    """
+        Write rows to manifest_path as Parquet, row_group_size rows at a time. MANIFEST_INT_COLUMNS are stored as
+        64-bit integers, with '' as null, and other columns as strings. If rows are sorted by Key, the Key statistics
+        of each row group let find_parquet_manifest_entry() read a single row group to look up a row.
+    """
+    require_pyarrow(manifest_path)
+    first_row, rows = peek(iter(rows))
+    schema = pyarrow.schema([(name, pyarrow.int64() if name in MANIFEST_INT_COLUMNS else pyarrow.string()) for name in first_row])
+    with open(manifest_path, 'wb') as f, pyarrow.parquet.ParquetWriter(f, schema) as writer:
+        for chunk in chunks(rows, row_group_size):
+            writer.write_table(pyarrow.Table.from_pydict({
+                name: [None if row.get(name) in (None, '') else int(row[name]) for row in chunk] if name in MANIFEST_INT_COLUMNS
+                else ['' if row.get(name) is None else str(row[name]) for row in chunk]
+                for name in schema.names
+            }, schema=schema))
+
+
+def read_manifest_columns(manifest_path):
+    """
+        Load a Parquet manifest a column at a time, returning {column: values}. MANIFEST_INT_COLUMNS with no missing
+        values, such as TarOffset, TarDataOffset and TarSize, are array('q') typed arrays copied from the Parquet
+        data in one go. Other columns are lists, with missing ints as None.
+    """
+    require_pyarrow(manifest_path)
+    with open(manifest_path, 'rb') as f:
+        table = pyarrow.parquet.read_table(f)
+    columns = OrderedDict()
+    for name in table.column_names:
+        column = table.column(name)
+        if name in MANIFEST_INT_COLUMNS and column.null_count == 0:
+            values = array('q')
+            for chunk in column.chunks:
+                if len(chunk):
+                    # int64 data without nulls is a plain buffer of native 8-byte ints
+                    values.frombytes(memoryview(chunk.buffers()[1])[chunk.offset * 8:(chunk.offset + len(chunk)) * 8])
+            columns[name] = values
+        else:
+            columns[name] = column.to_pylist()
+    return columns
+
+
+def read_manifest_rows(manifest_path):
+    """
+        Yield the rows of a csv or Parquet manifest as dicts. Values from csv manifests are all strings; rows of
+        Parquet manifests are assembled from read_manifest_columns(), so offsets and sizes are already ints, and
+        missing ones are None.
+    """
+    if not is_parquet(manifest_path):
+        yield from read_dicts_from_csv(manifest_path)
+        return
+    columns = read_manifest_columns(manifest_path)
+    names = list(columns)
+    for values in zip(*columns.values()):
+        yield dict(zip(names, values))
+
+
+def find_parquet_manifest_entry(manifest_path, bucket, key):
+    """
+        Find the row for bucket and key in a key-sorted Parquet manifest_path, reading only the file footer and
+        the row group whose Key statistics could contain key. Return None if not found.
+    """
+    require_pyarrow(manifest_path)
+    with open(manifest_path, 'rb') as f:
+        parquet_file = pyarrow.parquet.ParquetFile(f)
+        key_column = parquet_file.schema_arrow.get_field_index('Key')
+        for i in range(parquet_file.num_row_groups):
+            stats = parquet_file.metadata.row_group(i).column(key_column).statistics
+            if stats is not None and stats.has_min_max and not stats.min <= key <= stats.max:
+                continue
+            for row in parquet_file.read_row_group(i).to_pylist():
+                if row['Bucket'] == bucket and row['Key'] == key:
+                    return row
+    return None
+
+
+def archived_versions(manifest_paths):
+    """
+        Return {(Bucket, Key): (ETag, VersionId)} for each object in manifest_paths. If an object is in more than
+        one manifest, the version from the last manifest listed wins, so manifests should be listed oldest first.
+        Memory use grows with the number of objects, at about 300 bytes each.
+    """
+    versions = {}
+    for manifest_path in manifest_paths:
+        for row in read_manifest_rows(manifest_path):
+            versions[(row['Bucket'], row['Key'])] = (row['ETag'], row.get('VersionId', ''))
+    return versions
+
+
+def changed_objects(objects, versions):
+    """
+        Filter ObjectSummary objects to those that are new or changed compared to versions from archived_versions().
+        Objects are compared by ETag, and also by VersionId if both sides know it: objects from inventory_objects()
+        have a VersionId if the inventory includes versions, but objects from list_objects() never do.
+
+        >>> from types import SimpleNamespace
+        >>> def obj(key, etag, version_id=None):
+        ...     return SimpleNamespace(bucket_name='b', key=key, e_tag='"%s"' % etag, meta=SimpleNamespace(data={'VersionId': version_id}))
+        >>> versions = {('b', 'same'): ('1', ''), ('b', 'changed'): ('1', ''), ('b', 'new_version'): ('1', 'v1')}
+        >>> objects = [obj('same', '1'), obj('changed', '2'), obj('new', '1'), obj('new_version', '1', 'v2')]
+        >>> [o.key for o in changed_objects(objects, versions)]
+        ['changed', 'new', 'new_version']
+    """
+    for obj in objects:
+        version = versions.get((obj.bucket_name, obj.key))
+        if version is None:
+            yield obj
+            continue
+        etag, version_id = version
+        current_version_id = (obj.meta.data or {}).get('VersionId')
+        if obj.e_tag.strip('"') != etag or (version_id and current_version_id and current_version_id != version_id):
+            yield obj
+
+
+class CsvSpillFile:
+    """
+        Append-only local csv file of dict rows, with fieldnames taken from the first row written.
+        Used to hold manifest rows on disk while archiving instead of in memory.
+        If resume_size is set, an existing file is truncated to that many bytes and appended to.
+    """
+    def __init__(self, path, resume_size=None):
+        self.path = str(path)
+        self.writer = None
+        if resume_size is None:
+            self.file = io.open(self.path, 'w', newline='')
+        else:
+            os.truncate(self.path, resume_size)
+            with io.open(self.path, newline='') as f:
+                fieldnames = next(csv.reader(f), None)
+            self.file = io.open(self.path, 'a', newline='')
+            if fieldnames:
+                self.writer = csv.DictWriter(self.file, fieldnames=fieldnames)
+
+    def write(self, row):
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.file, fieldnames=list(row.keys()))
+            self.writer.writeheader()
+        self.writer.writerow(row)
+
+    def flush(self):
+        """ Flush rows to disk and return the size of the file in bytes. """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return os.path.getsize(self.path)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def sorted_rows(rows, key, chunk_size=MANIFEST_SORT_CHUNK_SIZE):
+    """
+        Yield dict rows sorted by column `key`, spilling them to a temporary csv and sorting it with sort_csv(), so
+        memory use doesn't grow with the number of rows.
+
+        >>> [r['Key'] for r in sorted_rows(({'Key': k} for k in 'cab'), 'Key')]
+        ['a', 'b', 'c']
+    """
+    with TemporaryDirectory() as temp_dir:
+        with CsvSpillFile(Path(temp_dir, 'rows.csv')) as spill:
+            for row in rows:
+                spill.write(row)
+        yield from sort_csv(spill.path, key, temp_dir, chunk_size)
+
+
+def sort_csv(path, key, temp_dir, chunk_size=MANIFEST_SORT_CHUNK_SIZE):
+    """
+        Yield dict rows from the local csv file at path, sorted by column `key`, holding at most chunk_size rows in
+        memory: rows are sorted in chunks that are written back to temp_dir, and the sorted chunks are then merged.
+
+        >>> from tempfile import TemporaryDirectory
+        >>> with TemporaryDirectory() as temp_dir:
+        ...     with CsvSpillFile(temp_dir + '/rows.csv') as spill:
+        ...         for k in 'ecabd':
+        ...             spill.write({'Key': k})
+        ...     assert [r['Key'] for r in sort_csv(spill.path, 'Key', temp_dir, chunk_size=2)] == list('abcde')
+    """
+    runs = []
+    for chunk in chunks(read_dicts_from_csv(path), chunk_size):
+        chunk = sorted(chunk, key=itemgetter(key))
+        if not runs and len(chunk) < chunk_size:
+            # everything fit in memory
+            yield from chunk
+            return
+        with CsvSpillFile(Path(temp_dir, 'sort-run-%s.csv' % len(runs))) as run:
+            for row in chunk:
+                run.write(row)
+        runs.append(run.path)
+    yield from heapq.merge(*(read_dicts_from_csv(run) for run in runs), key=itemgetter(key))
+
+
+def manifest_index_path(manifest_path):
+    """
+        Path of the sparse index written alongside manifest_path.
+
+        >>> manifest_index_path('s3://bucket/manifest.csv')
+        's3://bucket/manifest.csv.index.csv'
+    """
+    return manifest_path + '.index.csv'
+
+
+def manifest_checksums_path(manifest_path):
+    """
+        Path of the whole-tar checksums written alongside manifest_path.
+
+        >>> manifest_checksums_path('s3://bucket/manifest.csv')
+        's3://bucket/manifest.csv.checksums.json'
+    """
+    return manifest_path + '.checksums.json'
+
+
+def multipart_etag(part_md5s):
+    """
+        The ETag S3 gives an object uploaded with multipart upload parts having these hex MD5s.
+
+        >>> multipart_etag([hashlib.md5(b'abc').hexdigest(), hashlib.md5(b'def').hexdigest()])
+        '"4c8e93283780e078db9e0c6b9b3f8043-2"'
+    """
+    return '"%s-%s"' % (hashlib.md5(b''.join(bytes.fromhex(md5) for md5 in part_md5s)).hexdigest(), len(part_md5s))
+
+
+def tar_shard_name(tar_path, number):
+    """
+        File name of shard `number` of a sharded tar_path.
+
+        >>> tar_shard_name('s3://bucket/files/archive.tar', 3)
+        'archive.00003.tar'
+        >>> tar_shard_name('archive', 12)
+        'archive.00012'
+    """
+    name = tar_path.rsplit('/', 1)[-1]
+    if name.endswith('.tar'):
+        return '%s.%05d.tar' % (name[:-len('.tar')], number)
+    return '%s.%05d' % (name, number)
+
+
+def member_tar_path(tar_path, entry):
+    """
+        Path of the tar holding manifest row `entry`: tar_path itself, or for sharded tars the shard named by the
+        row's TarShard column, in the same directory as tar_path.
+
+        >>> member_tar_path('s3://bucket/files/archive.tar', {'TarShard': 'archive.00003.tar'})
+        's3://bucket/files/archive.00003.tar'
+        >>> member_tar_path('archive.tar', {'TarShard': ''})
+        'archive.tar'
+    """
+    shard = entry.get('TarShard')
+    if not shard:
+        return tar_path
+    return tar_path.rsplit('/', 1)[0] + '/' + shard if '/' in tar_path else shard
+
+
+def is_compressed_entry(entry):
+    """
+        True if manifest row entry is for a file in a compressed tar, with TarCompressedOffset and related columns.
+
+        >>> assert is_compressed_entry({'TarCompressedOffset': 0}) and is_compressed_entry({'TarCompressedOffset': '0'})
+        >>> assert not is_compressed_entry({'TarCompressedOffset': ''}) and not is_compressed_entry({})
+    """
+    return entry.get('TarCompressedOffset') not in (None, '')
+
+
+def is_compressed(path):
+    """
+        True if smart_open will transparently compress or decompress path based on its extension.
+
+        >>> assert is_compressed('manifest.csv.gz') and not is_compressed('manifest.csv')
+    """
+    return path.endswith(('.gz', '.bz2'))
+
+
+def find_manifest_entry(manifest_path, index_path, bucket, key):
+    """
+        Find the row for bucket and key in a key-sorted manifest_path using its sparse index at index_path,
+        reading only the csv header and the one block of rows that could contain key. Return None if not found.
+        Raise IOError if the block read doesn't start with the row the index lists there and end at a row boundary,
+        as when the manifest was rewritten after the index.
+
+        >>> from tempfile import TemporaryDirectory
+        >>> with TemporaryDirectory() as temp_dir:
+        ...     manifest_path = temp_dir + '/manifest.csv'
+        ...     rows = [{'Bucket': 'b', 'Key': k, 'TarSize': i} for i, k in enumerate('abcde')]
+        ...     write_dicts_to_csv(manifest_path, rows, manifest_index_path(manifest_path), index_block_size=2)
+        ...     assert find_manifest_entry(manifest_path, manifest_index_path(manifest_path), 'b', 'd')['TarSize'] == '3'
+        ...     assert find_manifest_entry(manifest_path, manifest_index_path(manifest_path), 'b', 'f') is None
+        ...     assert find_manifest_entry(manifest_path, manifest_index_path(manifest_path), 'b', '0') is None
+        ...     write_dicts_to_csv(manifest_path, [{**row, 'TarSize': 10 * i} for i, row in enumerate(rows)])
+        ...     find_manifest_entry(manifest_path, manifest_index_path(manifest_path), 'b', 'd')
+        Traceback (most recent call last):
+        ...
+        OSError: Sparse index ... doesn't match .../manifest.csv
+    """
+    index = list(read_dicts_from_csv(index_path))
+    i = bisect.bisect_right([block['Key'] for block in index], key) - 1
+    if i < 0:
+        return None
+    client = s3_client() if manifest_path.startswith('s3://') else None
+    block_offset = int(index[i]['Offset'])
+    with open_range(manifest_path, 0, int(index[0]['Offset']), client) as f:
+        header = f.read()
+    with open_range(manifest_path, block_offset, block_offset + int(index[i]['Size']), client) as f:
+        block = f.read()
+    rows = csv.DictReader(StringIO((header + block).decode('utf8', 'replace'), newline=''))
+    first_row = next(rows, None)
+    if not header.endswith(b'\n') or not block.endswith(b'\n') or not first_row or first_row.get('Key') != index[i]['Key']:
+        raise IOError("Sparse index %s doesn't match %s" % (index_path, manifest_path))
+    if first_row['Bucket'] == bucket and first_row['Key'] == key:
+        return first_row
+    return next((r for r in rows if r['Bucket'] == bucket and r['Key'] == key), None)
+
+
+def parse_prefix(s3_url):
+    """
+        Return (bucket, key prefix) for an S3 URL to archive. Non-empty prefixes always end in '/'.
+
+        >>> parse_prefix('s3://bucket/folder')
+        ('bucket', 'folder/')
+        >>> parse_prefix('s3://bucket/')
+        ('bucket', '')
+    """
     source_path_parsed = parse_uri(s3_url)
-    bucket = boto3.resource('s3').Bucket(source_path_parsed['bucket_id'])
     key = source_path_parsed['key_id'].rstrip('/')
     if key:
         key += '/'
-    return bucket.objects.filter(Prefix=key)
+    return source_path_parsed['bucket_id'], key
+
+
+def list_objects(s3_url, threads=1, max_shards=None, page_size=1000):
+    """
+        Iterate over boto3 ObjectSummary objects under s3_url.
+
+        If threads is more than 1, the prefix is listed in shards, with up to `threads` pages fetched at once and
+        objects yielded as each page arrives, in no particular order. Shards are found by listing the prefix with
+        Delimiter='/': keys directly under the prefix are yielded from that listing, and the sub-prefixes on each
+        page are split into up to `threads` key ranges that are listed concurrently. A range holding a single
+        sub-prefix is itself split the same way, until there are max_shards shards (default threads * 4).
+        Sharded listings request page_size keys per page.
+    """
+    bucket, prefix = parse_prefix(s3_url)
+    s3 = s3_resource()
+    if threads <= 1:
+        return s3.Bucket(bucket).objects.filter(Prefix=prefix)
+    return list_objects_sharded(s3, bucket, prefix, threads, max_shards or threads * 4, page_size)
+
+
+def list_objects_sharded(s3, bucket, prefix, threads, max_shards, page_size):
+    """
+        Generator for list_objects() with threads > 1. Each pending listing is either ('split', prefix, marker), a
+        page of a delimiter listing of prefix, or ('range', prefix, start, end, marker), a page of a plain listing
+        of keys below sub-prefixes of prefix from start (inclusive) to end (exclusive).
+    """
+    client = s3.meta.client
+    stats = {'shards': 1}
+    seen_prefixes = set()
+    pending = deque([('split', prefix, None)])
+    futures = set()
+
+    def list_page(task):
+        kwargs = {'Bucket': bucket, 'Prefix': task[1], 'MaxKeys': page_size}
+        if task[0] == 'split':
+            kwargs['Delimiter'] = '/'
+        if task[-1]:
+            kwargs['Marker'] = task[-1]
+        return task, client.list_objects(**kwargs)
+
+    def split_page(task, response):
+        # some S3-compatible servers repeat CommonPrefixes on every page
+        sub_prefixes = [p['Prefix'] for p in response.get('CommonPrefixes', []) if p['Prefix'] not in seen_prefixes]
+        seen_prefixes.update(sub_prefixes)
+        group_size = max(1, math.ceil(len(sub_prefixes) / threads))
+        for i in range(0, len(sub_prefixes), group_size):
+            group = sub_prefixes[i:i + group_size]
+            if len(group) == 1 and stats['shards'] < max_shards:
+                pending.append(('split', group[0], None))
+            else:
+                # keys under the group's sub-prefixes sort from group[0] up to just after the last sub-prefix;
+                # start listing just before group[0] so a key equal to it isn't skipped
+                end = sub_prefixes[i + group_size] if i + group_size < len(sub_prefixes) else group[-1][:-1] + '0'
+                pending.append(('range', task[1], group[0], end, group[0][:-1]))
+            stats['shards'] += 1
+        return response.get('Contents', [])
 
+    def range_page(task, response):
+        _, range_prefix, start, end, _ = task
+        contents = response.get('Contents', [])
+        if contents and contents[-1]['Key'] >= end:
+            response['IsTruncated'] = False
+        # skip keys outside the range, and keys directly under the prefix, which the delimiter listing yields
+        return [c for c in contents if start <= c['Key'] < end and '/' in c['Key'][len(range_prefix):]]
 
-def load_object(obj, temp_dir):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        while pending or futures:
+            while pending and len(futures) < threads:
+                futures.add(executor.submit(list_page, pending.popleft()))
+            done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task, response = future.result()
+                contents = (split_page if task[0] == 'split' else range_page)(task, response)
+                if response.get('IsTruncated'):
+                    last_key = response.get('NextMarker') or response['Contents'][-1]['Key']
+                    pending.append(task[:-1] + (last_key,))
+                for data in contents:
+                    obj = s3.ObjectSummary(bucket, data['Key'])
+                    obj.meta.data = data
+                    yield obj
+
+
+def read_inventory(inventory_path):
     """
-        Load S3 object `obj` into SpooledTemporaryFile `body` stored in `temp_dir`.
-        Return (obj, response, body).
+        Yield dict rows, with the column names of a CSV S3 Inventory report, from an S3 Inventory report's
+        manifest.json, streaming its CSV, ORC or Parquet data files one at a time. ORC and Parquet reports require
+        pyarrow. If inventory_path is a csv file instead, such as those written by split_inventory(), yield its rows.
+
+        The data files of an S3 manifest.json are read from its destinationBucket. For a local copy of a report, data
+        file keys are looked up relative to each parent directory of manifest.json in turn, so a local sync of the
+        destination bucket (or of the report's prefix within it) can be read.
     """
-    response = obj.get()
-    body = SpooledTemporaryFile(SPOOLED_FILE_SIZE, dir=temp_dir)
-    copyfileobj(response['Body'], body)
-    body.seek(0)
-    return obj, response, body
+    if not inventory_path.endswith('.json'):
+        yield from read_dicts_from_csv(inventory_path)
+        return
+    with open(inventory_path) as f:
+        manifest = json.load(f)
+    file_format = manifest.get('fileFormat', 'CSV').upper()
+    for data_file in manifest['files']:
+        data_path = inventory_data_path(inventory_path, manifest, data_file['key'])
+        if file_format == 'CSV':
+            columns = [c.strip() for c in manifest['fileSchema'].split(',')]
+            with open(data_path, newline='') as f:
+                for values in csv.reader(f):
+                    row = dict(zip(columns, values))
+                    row['Key'] = unquote_plus(row['Key'])  # keys are url-encoded in CSV reports
+                    yield row
+        elif file_format in ('ORC', 'PARQUET'):
+            yield from read_columnar_inventory(data_path, file_format)
+        else:
+            raise ValueError("Unknown inventory file format %s" % manifest['fileFormat'])
+
+
+def inventory_data_path(inventory_path, manifest, key):
+    """ Path of inventory data file `key` listed in manifest, an S3 Inventory manifest.json at inventory_path. """
+    if inventory_path.startswith('s3://'):
+        return 's3://%s/%s' % (manifest['destinationBucket'].split(':::')[-1], key)
+    for parent in Path(inventory_path).resolve().parents:
+        if (parent / key).exists():
+            return str(parent / key)
+    raise FileNotFoundError("Inventory data file %s not found in any parent directory of %s" % (key, inventory_path))
+
+
+# column names of ORC and Parquet inventory reports, and their equivalents in CSV reports
+INVENTORY_COLUMNS = {
+    'bucket': 'Bucket',
+    'key': 'Key',
+    'version_id': 'VersionId',
+    'is_latest': 'IsLatest',
+    'is_delete_marker': 'IsDeleteMarker',
+    'size': 'Size',
+    'last_modified_date': 'LastModifiedDate',
+    'e_tag': 'ETag',
+    'storage_class': 'StorageClass',
+}
+
+
+def read_columnar_inventory(data_path, file_format):
+    """
+        Yield dict rows from an ORC or Parquet S3 Inventory data file one record batch at a time, with columns renamed
+        and values formatted as in CSV reports.
+    """
+    if pyarrow is None:
+        raise ImportError("Reading %s inventory reports requires pyarrow. Try pip install pyarrow." % file_format)
+    if file_format != 'PARQUET' and pyarrow_orc is None:
+        raise ImportError("Reading %s inventory reports requires a build of pyarrow with ORC support." % file_format)
+    with open(data_path, 'rb') as f:
+        if file_format == 'PARQUET':
+            batches = pyarrow.parquet.ParquetFile(f).iter_batches()
+        else:
+            orc_file = pyarrow_orc.ORCFile(f)
+            batches = (orc_file.read_stripe(i) for i in range(orc_file.nstripes))
+        for batch in batches:
+            for record in batch.to_pylist():
+                row = {}
+                for column, value in record.items():
+                    if isinstance(value, bool):
+                        value = 'true' if value else 'false'
+                    elif hasattr(value, 'isoformat'):
+                        value = value.isoformat()
+                    row[INVENTORY_COLUMNS.get(column, column)] = '' if value is None else str(value)
+                yield row
+
+
+def inventory_objects(rows, s3_url):
+    """
+        Yield boto3 ObjectSummary objects, like list_objects(s3_url), for the current objects under s3_url listed in
+        S3 Inventory rows from read_inventory(), without making any listing requests. Unlike listed objects, these
+        carry the VersionId from the inventory, if it has one, for changed_objects().
+
+        The inventory must include the optional Size and ETag fields. Objects deleted since the inventory was taken
+        are still yielded, and fail with NoSuchKey when fetched.
+    """
+    bucket, prefix = parse_prefix(s3_url)
+    s3 = s3_resource()
+    for row in rows:
+        if 'Size' not in row or 'ETag' not in row:
+            raise ValueError("S3 Inventory reports must include the Size and ETag fields; enable them in the inventory configuration.")
+        if row['Bucket'] != bucket or not row['Key'].startswith(prefix):
+            continue
+        if row.get('IsLatest', 'true') != 'true' or row.get('IsDeleteMarker', 'false') == 'true':
+            continue
+        obj = s3.ObjectSummary(bucket, row['Key'])
+        obj.meta.data = {
+            'Key': row['Key'],
+            'Size': int(row['Size']),
+            'ETag': '"%s"' % row['ETag'].strip('"'),
+            'StorageClass': row.get('StorageClass', 'STANDARD'),
+        }
+        if row.get('VersionId'):
+            obj.meta.data['VersionId'] = row['VersionId']
+        yield obj
+
+
+def open_range(path, start, end=None, client=None, decompress=False):
+    """
+        Open bytes [start, end) of a local path or S3 URL as a file-like object. For S3 this is a single range GET,
+        so concurrent readers can each fetch their own part of a large object. Leave end as None to read to the end.
+        If decompress is True, the range must hold whole gzip frames (see GzipFrameWriter), and is decompressed as
+        it is read.
+    """
+    if end is not None and end <= start:
+        return BytesIO()
+    if path.startswith('s3://'):
+        parsed = parse_uri(path)
+        client = client or s3_client()
+        byte_range = 'bytes=%s-%s' % (start, '' if end is None else end - 1)
+        f = client.get_object(Bucket=parsed['bucket_id'], Key=parsed['key_id'], Range=byte_range)['Body']
+    else:
+        f = open(path, 'rb', ignore_ext=True)
+        if end is None:
+            f.seek(start)
+        else:
+            f = OffsetSizeFile(f, start, end - start)
+    return GzipSourceFile(f) if decompress else f
+
+
+def file_size(path, client=None):
+    """ Return the size in bytes of a local path or S3 URL. """
+    if path.startswith('s3://'):
+        parsed = parse_uri(path)
+        return (client or s3_client()).head_object(Bucket=parsed['bucket_id'], Key=parsed['key_id'])['ContentLength']
+    return os.path.getsize(path)
+
+
+def delete_path(path, client=None):
+    """ Delete a local path or S3 URL. """
+    if path.startswith('s3://'):
+        parsed = parse_uri(path)
+        (client or s3_client()).delete_object(Bucket=parsed['bucket_id'], Key=parsed['key_id'])
+    else:
+        os.remove(path)
+
+
+class GzipSourceFile(gzip.GzipFile):
+    """ GzipFile that decompresses source as it is read, and closes source along with itself. """
+    def __init__(self, source):
+        super().__init__(fileobj=source, mode='rb')
+        self.source = source
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.source.close()
+
+
+class BufferPool:
+    """
+        Pool of reusable bytearrays of buffer_size bytes. Buffers are allocated as needed up to `count`, after which
+        acquire() waits for a buffer to be released.
+    """
+    def __init__(self, buffer_size, count):
+        self.buffer_size = buffer_size
+        self.count = count
+        self.allocated = 0
+        self.free = queue.LifoQueue()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.free.empty() and self.allocated < self.count:
+                self.allocated += 1
+                return bytearray(self.buffer_size)
+        return self.free.get()
+
+    def release(self, buffer):
+        self.free.put(buffer)
+
+
+class PooledBody:
+    """
+        Read-only file over the first `length` bytes of a buffer from `pool`. read() returns memoryviews of the
+        buffer rather than copies. close() returns the buffer to the pool.
+        The buffer is hashed on creation with each of hash_names; see hexdigests().
+
+        >>> pool = BufferPool(8, 1)
+        >>> buffer = pool.acquire()
+        >>> buffer[:4] = b'1234'
+        >>> body = PooledBody(pool, buffer, 4, ['md5'])
+        >>> assert body.read(3) == b'123' and body.read() == b'4' and body.read() == b''
+        >>> body.hexdigests()
+        OrderedDict([('md5', '81dc9bdb52d04dc20036dbd8313ed055')])
+        >>> body.close()
+        >>> assert pool.free.qsize() == 1
+    """
+    def __init__(self, pool, buffer, length, hash_names=()):
+        self.pool = pool
+        self.buffer = buffer
+        self.view = memoryview(buffer)[:length]
+        self.position = 0
+        self.hashes = OrderedDict((name, hashlib.new(name, self.view)) for name in hash_names)
+        self.hashed = length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.view) - self.position
+        out = self.view[self.position:self.position + size]
+        self.position += len(out)
+        return out
+
+    def hexdigests(self):
+        """ Return {hash_name: hexdigest} for the whole buffer. """
+        return OrderedDict((name, h.hexdigest()) for name, h in self.hashes.items())
+
+    def close(self):
+        if self.pool:
+            self.pool.release(self.buffer)
+            self.pool = None
+
+
+class RangeReader:
+    """
+        Read-only file over an object of `size` bytes fetched in order as range requests of part_size bytes, with up
+        to `threads` ranges fetched concurrently ahead of the reader. get_range(start, end) must return bytes
+        [start, end) of the object, and first_chunk holds bytes already fetched from the start of the object.
+        close() cancels any ranges not yet fetched.
+
+        Each range is also hashed with each of hash_names, in order, on a separate thread as soon as it is fetched,
+        so the reader only copies bytes; see hexdigests().
+
+        >>> data = bytes(range(100))
+        >>> reader = RangeReader(lambda start, end: data[start:end], data[:10], 100, part_size=7, threads=3,
+        ...                      hash_names=['md5'])
+        >>> assert reader.read(5) == data[:5] and reader.read(20) == data[5:25] and reader.read() == data[25:]
+        >>> assert reader.hexdigests()['md5'] == hashlib.md5(data).hexdigest() and reader.hashed == 100
+        >>> reader.close()
+    """
+    def __init__(self, get_range, first_chunk, size, part_size, threads, hash_names=()):
+        self.get_range = get_range
+        self.hashes = OrderedDict((name, hashlib.new(name, first_chunk)) for name in hash_names)
+        self.hashed = len(first_chunk)
+        self.hash_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.last_hash = None
+        self.size = size
+        self.part_size = part_size
+        self.threads = threads
+        self.position = 0
+        self.chunk = memoryview(first_chunk)
+        self.chunk_pos = 0
+        self.starts = iter(range(len(first_chunk), size, part_size))
+        self.pending = deque()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.read_ahead()
+
+    def read_ahead(self):
+        while len(self.pending) < self.threads:
+            start = next(self.starts, None)
+            if start is None:
+                return
+            future = self.executor.submit(self.get_range, start, min(start + self.part_size, self.size))
+            self.pending.append(future)
+            if self.hashes:
+                # a single hashing thread processes ranges in the order they were submitted
+                self.last_hash = self.hash_executor.submit(self.update_hashes, future)
+
+    def update_hashes(self, future):
+        data = future.result()
+        for h in self.hashes.values():
+            h.update(data)
+        self.hashed += len(data)
+
+    def hexdigests(self):
+        """ Return {hash_name: hexdigest} of the ranges fetched so far -- the whole object, once it has been read. """
+        if self.last_hash:
+            self.last_hash.result()
+        return OrderedDict((name, h.hexdigest()) for name, h in self.hashes.items())
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        pieces = []
+        while size > 0:
+            if self.chunk_pos >= len(self.chunk):
+                if not self.pending:
+                    break
+                self.chunk = memoryview(self.pending.popleft().result())
+                self.chunk_pos = 0
+                self.read_ahead()
+            piece = self.chunk[self.chunk_pos:self.chunk_pos + size]
+            self.chunk_pos += len(piece)
+            self.position += len(piece)
+            size -= len(piece)
+            pieces.append(piece)
+        # only reads that span two ranges need a copy
+        return pieces[0] if len(pieces) == 1 else b''.join(pieces)
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.hash_executor.shutdown(cancel_futures=True)
+
+
+def read_into(source, buffer, chunk_size=2 ** 16):
+    """
+        Read from source into buffer until buffer is full or source is exhausted. Return the number of bytes read.
+
+        >>> buffer = bytearray(4)
+        >>> assert read_into(BytesIO(b'12'), buffer) == 2 and buffer == bytearray(b'12\\0\\0')
+    """
+    view = memoryview(buffer)
+    pos = 0
+    while pos < len(view):
+        if hasattr(source, 'readinto'):
+            length = source.readinto(view[pos:pos + chunk_size])
+        else:
+            chunk = source.read(min(chunk_size, len(view) - pos))
+            length = len(chunk)
+            view[pos:pos + length] = chunk
+        if not length:
+            break
+        pos += length
+    return pos
+
+
+def load_object(obj, pool, hash_names=('md5',), ranged_get_size=RANGED_GET_SIZE, ranged_get_threads=RANGED_GET_THREADS):
+    """
+        Fetch S3 object `obj` for archiving, without writing it to disk. Return (obj, response, body), where body
+        is a file-like object that should be closed once read.
+
+        Objects that fit in a buffer from BufferPool `pool` are read into a pooled buffer (see PooledBody).
+        Larger objects are streamed by a RangeReader, which keeps up to ranged_get_threads range requests of
+        ranged_get_size bytes in flight ahead of the reader, pinned to the listed ETag (and the VersionId returned
+        by the first range, if any).
+
+        Contents are hashed with each of hash_names by the fetching threads rather than by the reader.
+        body.hexdigests() returns the digests of the bytes body.read() hands out, and body.hashed the number of
+        bytes hashed.
+    """
+    if obj.size <= pool.buffer_size:
+        response = obj.get()
+        if response['ContentLength'] > pool.buffer_size:
+            # object has grown since it was listed
+            data = response['Body'].read()
+            return obj, response, RangeReader(None, data, len(data), ranged_get_size, 1, hash_names)
+        buffer = pool.acquire()
+        try:
+            length = read_into(response['Body'], buffer)
+        except Exception:
+            pool.release(buffer)
+            raise
+        return obj, response, PooledBody(pool, buffer, length, hash_names)
+
+    # use the client directly, as resource actions like obj.get() clear the attributes loaded by listing
+    pinned = {'IfMatch': obj.e_tag}
+
+    def get_range(start, end):
+        return obj.meta.client.get_object(
+            Bucket=obj.bucket_name, Key=obj.key, Range='bytes=%s-%s' % (start, end - 1), **pinned)
+
+    def read_range(start, end):
+        return get_range(start, end)['Body'].read()
+
+    response = get_range(0, ranged_get_size)
+    first_chunk = response['Body'].read()
+    size = int(response['ContentRange'].rsplit('/', 1)[1])
+    if response.get('VersionId'):
+        pinned['VersionId'] = response['VersionId']
+    response['ContentLength'] = size
+    del response['ContentRange']
+    return obj, response, RangeReader(read_range, first_chunk, size, ranged_get_size, ranged_get_threads, hash_names)
+
+
+def copy_bytes(source, dest, size, buffer_size=SPOOLED_FILE_SIZE):
+    """
+        Copy exactly size bytes from source to dest, or discard them if dest is None.
+
+        >>> source, dest = BytesIO(b'12345678'), BytesIO()
+        >>> copy_bytes(source, None, 2)
+        >>> copy_bytes(source, dest, 4)
+        >>> assert dest.getvalue() == b'3456'
+        >>> copy_bytes(source, dest, 4)
+        Traceback (most recent call last):
+        ...
+        EOFError: unexpected end of data
+    """
+    while size > 0:
+        chunk = source.read(min(size, buffer_size))
+        if not chunk:
+            raise EOFError("unexpected end of data")
+        if dest is not None:
+            dest.write(chunk)
+        size -= len(chunk)
+
+
+def sample_size(population, confidence, defect_rate):
+    """
+        Number of items to sample at random from population items so that, if at least defect_rate of them are bad,
+        at least one bad item is sampled with probability confidence.
+
+        >>> sample_size(10 ** 6, .95, .01)
+        299
+        >>> sample_size(100, .99, .01)
+        100
+    """
+    if not 0 < defect_rate < 1:
+        raise ValueError("defect_rate must be between 0 and 1.")
+    if confidence >= 1:
+        return population
+    return min(population, math.ceil(math.log(1 - confidence) / math.log(1 - defect_rate)))
+
+
+def sample_confidence(sampled, population, defect_rate):
+    """
+        Probability that a random sample of `sampled` items out of population would include at least one bad item,
+        if at least defect_rate of the population is bad. The inverse of sample_size().
+
+        >>> round(sample_confidence(299, 10 ** 6, .01), 4)
+        0.9505
+        >>> sample_confidence(100, 100, .01)
+        1.0
+    """
+    if sampled >= population:
+        return 1.0
+    return 1 - (1 - defect_rate) ** sampled
+
+
+def coalesce_ranges(ranges, max_gap, max_size):
+    """
+        Merge (start, end, item) byte ranges, sorted by start, into (start, end, items) groups that can each be
+        fetched with one range request. Ranges are merged if the gap between them is at most max_gap bytes and
+        the merged range is at most max_size bytes.
+
+        >>> coalesce_ranges([(0, 10, 'a'), (12, 20, 'b'), (100, 110, 'c')], max_gap=5, max_size=1000)
+        [(0, 20, ['a', 'b']), (100, 110, ['c'])]
+        >>> coalesce_ranges([(0, 10, 'a'), (12, 20, 'b')], max_gap=5, max_size=15)
+        [(0, 10, ['a']), (12, 20, ['b'])]
+    """
+    groups = []
+    for start, end, item in ranges:
+        if groups and start - groups[-1][1] <= max_gap and max(end, groups[-1][1]) - groups[-1][0] <= max_size:
+            groups[-1][1] = max(end, groups[-1][1])
+            groups[-1][2].append(item)
+        else:
+            groups.append([start, end, [item]])
+    return [tuple(group) for group in groups]
 
 
 def chunks(iterable, size=1000):
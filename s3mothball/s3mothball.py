@@ -1,190 +1,1407 @@
+import concurrent.futures
+import csv
 import hashlib
+import io
+import itertools
+import json
+import os
+import queue
+import random
+import sqlite3
+import threading
 from collections import OrderedDict, defaultdict
 from contextlib import contextmanager
-from tarfile import TarFile, TarInfo
+from functools import partial
+from operator import itemgetter
+from pathlib import Path
+from tarfile import BLOCKSIZE, LNKTYPE, NUL, RECORDSIZE, TarInfo
 from tempfile import TemporaryDirectory
+from time import sleep
 
 from smart_open import open
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from smart_open.s3 import parse_uri
 from tqdm import tqdm
 
-from s3mothball.helpers import HashingFile, LoggingTarFile, make_parent_dir, TeeFile, threaded_queue, OffsetSizeFile, \
-    write_dicts_to_csv, read_dicts_from_csv, list_objects, load_object, chunks, exists, peek, retry_on_exception
-from s3mothball.settings import SPOOLED_FILE_SIZE
+from s3mothball.helpers import LoggingTarFile, make_parent_dir, TarReader, threaded_queue, OffsetSizeFile, \
+    read_dicts_from_csv, list_objects, load_object, exists, peek, retry_on_exception, \
+    open_range, manifest_index_path, is_compressed, find_manifest_entry, copy_bytes, coalesce_ranges, \
+    CsvSpillFile, sort_csv, open_tar_writer, write_json_atomic, BufferPool, parse_prefix, read_inventory, inventory_objects, \
+    tar_shard_name, member_tar_path, s3_client, archived_versions, changed_objects, sorted_rows, GzipFrameWriter, \
+    GzipSourceFile, file_size, sample_size, sample_confidence, HashingFile, manifest_checksums_path, multipart_etag, \
+    is_parquet, is_compressed_entry, write_manifest, read_manifest_rows, find_parquet_manifest_entry
+from s3mothball.settings import VALIDATE_SEGMENT_SIZE, THREADS, EXTRACT_MAX_GAP, EXTRACT_MAX_RANGE_SIZE, \
+    PART_SIZE, UPLOAD_THREADS, MAX_THREADS, MEMORY_BUDGET, FETCH_BUFFER_SIZE, RANGED_GET_SIZE, RANGED_GET_THREADS, \
+    COMPRESS_FRAME_SIZE, COMPRESS_THREADS, RESTORE_PART_SIZE, HEADERS_MAX_GAP, HEADERS_MAX_RANGE_SIZE, \
+    SAMPLE_CONFIDENCE, SAMPLE_DEFECT_RATE, SPOOLED_FILE_SIZE
 
 
-def write_tar(archive_url, manifest_path, tar_path, strip_prefix=None, progress_bar=False, overwrite=False):
+def write_tar(archive_url, manifest_path, tar_path, strip_prefix=None, progress_bar=False, overwrite=False, index=True,
+              checkpoint_path=None, part_size=PART_SIZE, upload_threads=UPLOAD_THREADS, max_threads=MAX_THREADS,
+              memory_budget=MEMORY_BUDGET, sha256=False, inventory=None, list_threads=THREADS, shard_size=None,
+              shard_members=None, writer_threads=1, previous_manifests=(), dedup=False, ordered=False,
+              compress_threads=COMPRESS_THREADS, frame_size=COMPRESS_FRAME_SIZE):
     """
         Write all objects from archive_url to tar_path.
-        Write list of objects to manifest_path.
+        If inventory is set, objects are found in that S3 Inventory report (see read_inventory()) instead of by
+        listing archive_url; if any of them have been deleted since the report was taken, write_tar fails with
+        NoSuchKey. Otherwise archive_url is listed in shards with up to list_threads concurrent requests
+        (see list_objects()), and objects are fetched as soon as they are listed.
+        Write list of objects to manifest_path, with the MD5 of each object in TarMD5, and its SHA-256 in TarSHA256
+        if sha256 is True.
+        If index is True and manifest_path is not compressed, also write a sparse index of the manifest for
+        open_archived_file() to manifest_index_path(manifest_path).
+        If manifest_path ends in .parquet, the manifest is written as Parquet instead of csv, with offsets and sizes
+        stored as integers so it loads quickly (see write_dicts_to_parquet()), and needs no separate index.
+        The size, SHA-256 and expected S3 ETag of the tar are written to manifest_checksums_path(manifest_path).
+
+        If previous_manifests is set, only objects that are new or changed since they were archived in those
+        manifests (see changed_objects()) are fetched and written, so tar_path and manifest_path hold just the
+        changes. List previous_manifests oldest first. Objects deleted since then are not recorded. Unlike the rest of
+        write_tar(), this holds every object in previous_manifests in memory (see archived_versions()).
+
+        If dedup is True, objects with the same ETag and contents as an earlier object in the same tar (or tar shard)
+        are stored as hard links to it instead of in full; see tar_object().
+
+        If ordered is True, objects are written to the tar in key order, the same order as the manifest, so the
+        manifest doesn't need to be sorted afterwards and objects under a common prefix are stored contiguously.
+        Fetched objects that arrive early wait in threaded_queue()'s reorder window. archive_url is then listed
+        sequentially rather than in shards, since listing is in key order, and inventory reports are sorted on disk
+        first. With writer_threads > 1, each shard is in key order but the shards interleave.
+
+        If checkpoint_path is set, progress is saved to that local json file, and manifest rows to
+        <checkpoint_path>.rows.csv, each time about part_size bytes of tar have been uploaded. If write_tar is
+        interrupted, calling it again with the same arguments continues the same upload from the last checkpoint
+        instead of starting over, skipping objects that were already archived. Checkpoint files are removed once the
+        archive is complete.
+
+        If shard_size or shard_members is set, objects are written to a set of tar shards next to tar_path instead,
+        named as in tar_shard_name(), each holding at most about shard_size bytes and/or shard_members members.
+        writer_threads shards are written at once, each by its own thread with its own upload, and the manifest's
+        TarShard column names the shard holding each object. Sharded output can't be checkpointed.
+
+        If tar_path ends in .gz, the tar is compressed as independent gzip frames of at least frame_size bytes,
+        compressed by compress_threads threads (see GzipFrameWriter), and the manifest records where each file's
+        frames are in its TarFrameOffset, TarCompressedOffset and TarCompressedSize columns (see frame_columns()),
+        so files can still be validated and extracted with range requests. Compressed output can't be sharded or
+        checkpointed.
+
+        S3 tar paths are uploaded in parts of part_size bytes, with up to upload_threads parts uploading at once.
+
+        Objects are fetched in background threads, adapting between 1 and max_threads fetches in flight depending
+        on fetch latency and how quickly the tar is written, and holding about memory_budget bytes at most.
+        See threaded_queue(). Objects are hashed by the fetching threads as they are downloaded, so the thread
+        writing the tar only copies bytes.
     """
+    sharded = bool(shard_size or shard_members)
+    if sharded and checkpoint_path:
+        raise ValueError("checkpoint_path can't be used with sharded tar output.")
+    compress = tar_path.endswith('.gz')
+    if is_compressed(tar_path) and not compress:
+        raise ValueError("Compressed tar output must be gzipped (.gz): %s" % tar_path)
+    if compress and (sharded or checkpoint_path):
+        raise ValueError("Compressed tar output can't be sharded or checkpointed.")
+
+    checkpoint = None
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with io.open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if [checkpoint['ArchiveUrl'], checkpoint['ManifestPath'], checkpoint['TarPath'], checkpoint.get('SHA256', False),
+                checkpoint.get('Dedup', False), checkpoint.get('Ordered', False)] != \
+                [archive_url, manifest_path, tar_path, sha256, dedup, ordered]:
+            raise ValueError("Checkpoint %s is for a different archive job." % checkpoint_path)
+
     if not overwrite:
-        if exists(tar_path):
-            raise IOError("%s already exists." % tar_path)
+        first_tar_path = member_tar_path(tar_path, {'TarShard': tar_shard_name(tar_path, 0)}) if sharded else tar_path
+        if exists(first_tar_path) and not checkpoint:
+            raise IOError("%s already exists." % first_tar_path)
         if exists(manifest_path):
             raise IOError("%s already exists." % manifest_path)
 
     # get iterator of items to tar, and check that it includes at least one item
-    objects = list_objects(archive_url)
+    if inventory:
+        rows = read_inventory(inventory)
+        objects = inventory_objects(sorted_rows(rows, 'Key') if ordered else rows, archive_url)
+    else:
+        objects = list_objects(archive_url, 1 if ordered else list_threads)
+    if previous_manifests:
+        objects = changed_objects(objects, archived_versions(previous_manifests))
     try:
         _, objects = peek(iter(objects))
     except StopIteration:
+        if previous_manifests:
+            raise IOError("No new or changed objects found at %s" % archive_url)
         raise IOError("No objects found at %s" % archive_url)
 
     # write tar
     make_parent_dir(tar_path)
-    files_written = []
-    with open(tar_path, 'wb', ignore_ext=True) as tar_out, \
-         LoggingTarFile.open(fileobj=tar_out, mode='w|') as tar, \
-         TemporaryDirectory() as temp_dir:
-
-        # load object contents in background threads
-        items = threaded_queue(load_object, ((obj, temp_dir) for obj in objects))
-
-        # tar each item
-        for obj, response, body in tqdm(items, disable=not progress_bar):
-            if obj.key.endswith('/'):
-                raise ValueError(
-                    "Invalid object key %s. s3mothball cannot handle object keys ending in /."
-                    "See https://github.com/harvard-lil/s3mothball/issues/5" % obj.key)
-            body = HashingFile(body)
-            tar_info = TarInfo()
-            tar_info.size = int(response['ContentLength'])
-            tar_info.mtime = response['LastModified'].timestamp()
-            tar_info.name = obj.key
-            if strip_prefix and tar_info.name.startswith(strip_prefix):
-                tar_info.name = tar_info.name[len(strip_prefix):]
-            tar.addfile(tar_info, body)
-            member = tar.members[-1]
-            files_written.append(OrderedDict((
-                # inventory fields
-                ('Bucket', obj.bucket_name),
-                ('Key', obj.key),
-                ('Size', response['ContentLength']),
-                ('LastModifiedDate', response['LastModified'].isoformat()),
-                ('ETag', response['ETag'].strip('"')),
-                ('StorageClass', response.get('StorageClass', 'STANDARD')),
-                ('VersionId', response.get('VersionId', '')),
-                # ('Owner', obj.owner['DisplayName'] if obj.owner else ''),
-                # tar fields
-                ('TarMD5', body.hexdigest()),
-                ('TarOffset', member.offset),
-                ('TarDataOffset', member.offset_data),
-                ('TarSize', member.size),
-            ) + ((
-                ('TarStrippedPrefix', strip_prefix),
-            ) if strip_prefix else tuple())))
-            if response['ContentLength'] != member.size:
-                raise ValueError("Object size mismatch: %s" % obj.key)
-
-    # write csv
-    make_parent_dir(manifest_path)
-    files_written.sort(key=lambda f: f['Key'])
-    write_dicts_to_csv(manifest_path, files_written)
-
-
-def validate_tar(manifest_path, tar_path, progress_bar=False, open_attempts=8):
+    with TemporaryDirectory() as temp_dir:
+        if checkpoint_path:
+            rows_path = checkpoint_path + '.rows.csv'
+            files_written = CsvSpillFile(rows_path, checkpoint and checkpoint['RowsSize'])
+            if checkpoint:
+                archived_keys = set(row['Key'] for row in read_dicts_from_csv(rows_path))
+                objects = (obj for obj in objects if obj.key not in archived_keys)
+                links = links_from_rows(read_dicts_from_csv(rows_path)) if dedup else None
+        else:
+            files_written = CsvSpillFile(Path(temp_dir, 'manifest.csv'))
+        if not checkpoint:
+            links = {} if dedup else None
+
+        # load object contents in background threads, into pooled buffers or streaming range reads
+        pool = BufferPool(FETCH_BUFFER_SIZE, max(1, memory_budget // FETCH_BUFFER_SIZE))
+        hash_names = ('md5', 'sha256') if sha256 else ('md5',)
+        # fetched objects waiting in tar shard queues still hold their memory
+        held = {'bytes': 0}
+        items = threaded_queue(load_object, ((obj, pool, hash_names) for obj in objects), THREADS, max_threads, memory_budget,
+                               item_size=fetch_memory, ordered=ordered, held_bytes=lambda: held['bytes'])
+        items = tqdm(items, disable=not progress_bar)
+
+        if sharded:
+            with files_written:
+                checksums = write_tar_shards(items, tar_path, files_written, shard_size, shard_members, writer_threads, part_size,
+                                 upload_threads, strip_prefix, sha256, dedup, held, partial(fetch_memory, pool=pool))
+        else:
+            tar_file = open_tar_writer(tar_path, part_size, upload_threads, bool(checkpoint_path), checkpoint and checkpoint['Writer'])
+            tar_out = tar_hash = HashingFile(tar_file, 'sha256')
+            tar_mode = 'w' if checkpoint_path or tar_path.startswith('s3://') else 'w|'
+            if compress:
+                # unbuffered, so the frame writer sees where each member starts
+                tar_out = GzipFrameWriter(tar_hash, frame_size, compress_threads)
+                tar_mode = 'w'
+
+            def save_checkpoint():
+                write_json_atomic(checkpoint_path, {
+                    'ArchiveUrl': archive_url,
+                    'ManifestPath': manifest_path,
+                    'TarPath': tar_path,
+                    'SHA256': sha256,
+                    'Dedup': dedup,
+                    'Ordered': ordered,
+                    'Writer': tar_out.checkpoint(),
+                    'RowsSize': files_written.flush(),
+                })
+
+            # s3mothball's own writers report their position with tell(), so the tar can be written without
+            # tarfile's stream buffering and the writer's position matches tar.offset at checkpoints
+            with files_written, tar_out, LoggingTarFile.open(fileobj=tar_out, mode=tar_mode) as tar:
+                for obj, response, body in items:
+                    files_written.write(tar_object(tar, obj, response, body, strip_prefix, sha256, links=links))
+                    if checkpoint_path and tar_out.buffered >= part_size:
+                        save_checkpoint()
+            checksums = {'': tar_checksums(tar_hash, tar_file, checkpoint and checkpoint['Writer'])}
+
+        # write csv, sorted by key on disk so memory use doesn't grow with the number of objects, unless rows were
+        # already written in key order
+        make_parent_dir(manifest_path)
+        index_path = manifest_index_path(manifest_path) if index and not is_compressed(manifest_path) and not is_parquet(manifest_path) else None
+        if ordered and not (sharded and writer_threads > 1):
+            rows = read_dicts_from_csv(files_written.path)
+        else:
+            rows = sort_csv(files_written.path, 'Key', temp_dir)
+        if compress:
+            rows = (frame_columns(row, tar_out) for row in rows)
+        write_manifest(manifest_path, rows, index_path)
+        with open(manifest_checksums_path(manifest_path), 'w') as f:
+            json.dump({'Tars': checksums}, f, indent=2)
+
+    if checkpoint_path:
+        for path in (checkpoint_path, rows_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def tar_object(tar, obj, response, body, strip_prefix=None, sha256=False, shard=None, links=None):
+    """
+        Add object contents from load_object() to LoggingTarFile tar, and return its manifest row.
+        shard is the TarShard column for sharded output.
+
+        If links is a dict, duplicates are stored once: an object with the same ETag, hashes and size as one already
+        recorded in links (see dedup_key()) is added as a hard link to the earlier member instead of with its
+        contents, and the manifest's TarLink column names the earlier member. The row's TarDataOffset and TarSize
+        point at the earlier member's data. Only objects that were fully hashed while fetching (see load_object())
+        can be linked, because the tar is written as a stream.
+    """
+    if obj.key.endswith('/'):
+        raise ValueError(
+            "Invalid object key %s. s3mothball cannot handle object keys ending in /."
+            "See https://github.com/harvard-lil/s3mothball/issues/5" % obj.key)
+    tar_info = TarInfo()
+    tar_info.size = int(response['ContentLength'])
+    tar_info.mtime = response['LastModified'].timestamp()
+    tar_info.name = obj.key
+    if strip_prefix and tar_info.name.startswith(strip_prefix):
+        tar_info.name = tar_info.name[len(strip_prefix):]
+    etag = response['ETag'].strip('"')
+    link = None
+    if links is not None and body.hashed == tar_info.size:
+        digests = body.hexdigests()
+        link = links.get(dedup_key(etag, digests, tar_info.size))
+    if link:
+        link_name, data_offset = link
+        body.close()
+        tar_info.type = LNKTYPE
+        tar_info.linkname = link_name
+        tar_info.size = 0
+        tar.addfile(tar_info)
+        member = tar.members.pop()
+        size = int(response['ContentLength'])
+    else:
+        tar.addfile(tar_info, body)
+        member = tar.members.pop()  # don't keep every TarInfo in memory
+        digests = body.hexdigests()
+        body.close()
+        # the digests cover exactly the bytes handed to the tar, so check that all of them were written
+        if not body.position == body.hashed == member.size:
+            raise ValueError("Hashed size mismatch: %s" % obj.key)
+        data_offset = member.offset_data
+        size = member.size
+        if links is not None:
+            links.setdefault(dedup_key(etag, digests, size), (member.name, data_offset))
+    if response['ContentLength'] != size:
+        raise ValueError("Object size mismatch: %s" % obj.key)
+    return OrderedDict((
+        # inventory fields
+        ('Bucket', obj.bucket_name),
+        ('Key', obj.key),
+        ('Size', response['ContentLength']),
+        ('LastModifiedDate', response['LastModified'].isoformat()),
+        ('ETag', etag),
+        ('StorageClass', response.get('StorageClass', 'STANDARD')),
+        ('VersionId', response.get('VersionId', '')),
+        # ('Owner', obj.owner['DisplayName'] if obj.owner else ''),
+        # tar fields
+        ('TarMD5', digests['md5']),
+    ) + ((
+        ('TarSHA256', digests['sha256']),
+    ) if sha256 else tuple()) + (
+        ('TarOffset', member.offset),
+        ('TarDataOffset', data_offset),
+        ('TarSize', size),
+    ) + ((
+        ('TarLink', link[0] if link else ''),
+    ) if links is not None else tuple()) + ((
+        ('TarShard', shard),
+    ) if shard else tuple()) + ((
+        ('TarStrippedPrefix', strip_prefix),
+    ) if strip_prefix else tuple()))
+
+
+def frame_columns(row, frames):
+    """
+        Add the TarFrameOffset, TarCompressedOffset and TarCompressedSize columns to manifest row from the frames of
+        GzipFrameWriter frames: decompressing TarCompressedSize bytes of the tar from TarCompressedOffset gives the
+        tar from uncompressed offset TarFrameOffset through the end of the file's data. The frames start at the
+        file's tar header, or at its data for a hard link (see tar_object()).
+    """
+    start = int(row['TarDataOffset'] if row.get('TarLink') else row['TarOffset'])
+    end = int(row['TarDataOffset']) + int(row['TarSize'])
+    row['TarFrameOffset'], row['TarCompressedOffset'], row['TarCompressedSize'] = frames.locate(start, end)
+    return row
+
+
+def dedup_key(etag, digests, size):
+    """
+        Return the key identifying duplicate objects for tar_object(), from an object's ETag, {hash name: hex digest}
+        and size.
+
+        >>> dedup_key('abc', {'md5': 'abc'}, 3) == dedup_key('abc', {'md5': 'abc'}, 3)
+        True
+    """
+    return (etag, tuple(sorted(digests.items())), size)
+
+
+def links_from_rows(rows):
+    """
+        Rebuild tar_object()'s links dict from manifest rows already written, when resuming from a checkpoint.
+
+        >>> rows = [{'Key': 'a', 'ETag': 'e', 'TarMD5': 'e', 'TarSize': '3', 'TarDataOffset': '512', 'TarLink': ''},
+        ...         {'Key': 'b', 'ETag': 'e', 'TarMD5': 'e', 'TarSize': '3', 'TarDataOffset': '512', 'TarLink': 'a'}]
+        >>> links_from_rows(rows)
+        {('e', (('md5', 'e'),), 3): ('a', 512)}
+    """
+    links = {}
+    for row in rows:
+        if row.get('TarLink'):
+            continue
+        digests = {name: row[column] for column, name in (('TarMD5', 'md5'), ('TarSHA256', 'sha256')) if row.get(column)}
+        name = row['Key'][len(row.get('TarStrippedPrefix', '')):]
+        links.setdefault(dedup_key(row['ETag'], digests, int(row['TarSize'])), (name, int(row['TarDataOffset'])))
+    return links
+
+
+def write_tar_shards(items, tar_path, files_written, shard_size, shard_members, writer_threads, part_size=PART_SIZE,
+                     upload_threads=UPLOAD_THREADS, strip_prefix=None, sha256=False, dedup=False, held=None,
+                     item_memory=None):
+    """
+        Write (obj, response, body) items from load_object() round-robin to writer_threads tar shards at once, each
+        written by its own thread. A shard is finished, and replaced by the next shard number, once adding the next
+        item would take it past shard_size bytes or shard_members members. Manifest rows are written to
+        CsvSpillFile files_written. If dedup is True, duplicates within each shard are stored as hard links.
+
+        If held is a dict, held['bytes'] is kept up to date with the item_memory(obj) of items handed to shard
+        writers and not yet written, for threaded_queue()'s held_bytes. If writing fails, every item taken from
+        `items` is closed, so pooled buffers are released for fetches still waiting on them.
+    """
+    lock = threading.Lock()
+    abort = threading.Event()
+    errors = []
+    shard_numbers = itertools.count()
+    open_shards = []
+    finished_shards = []
+
+    def release(item):
+        item[2].close()
+        if held is not None:
+            with lock:
+                held['bytes'] -= item_memory(item[0])
+
+    def write_shard(name, shard_queue):
+        path = member_tar_path(tar_path, {'TarShard': name})
+        links = {} if dedup else None
+        shard_items = iter(shard_queue.get, None)
+        item = None
+        try:
+            tar_file = open_tar_writer(path, part_size, upload_threads)
+            with HashingFile(tar_file, 'sha256') as tar_out, \
+                    LoggingTarFile.open(fileobj=tar_out, mode='w' if path.startswith('s3://') else 'w|') as tar:
+                for item in shard_items:
+                    if abort.is_set():
+                        raise IOError("Writing %s was aborted." % path)
+                    row = tar_object(tar, *item, strip_prefix=strip_prefix, sha256=sha256, shard=name, links=links)
+                    release(item)
+                    item = None
+                    with lock:
+                        files_written.write(row)
+                if abort.is_set():
+                    raise IOError("Writing %s was aborted." % path)
+            return tar_checksums(tar_out, tar_file)
+        except BaseException as e:
+            errors.append(e)
+            abort.set()
+            # keep closing items until the sentinel arrives, so write_tar_shards isn't left waiting on fetches
+            # that need their buffers
+            if item:
+                release(item)
+            for item in shard_items:
+                release(item)
+            raise
+
+    def put(shard, item):
+        if item and held is not None:
+            with lock:
+                held['bytes'] += item_memory(item[0])
+        while not abort.is_set():
+            try:
+                return shard['queue'].put(item, timeout=.1)
+            except queue.Full:
+                pass
+        if item:
+            release(item)
+        raise errors[0] if errors else IOError("Writing %s was aborted." % tar_path)
+
+    # finished shards may still be uploading while their replacements start, so allow twice as many threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=writer_threads * 2) as executor:
+        def start_shard():
+            name = tar_shard_name(tar_path, next(shard_numbers))
+            shard_queue = queue.Queue(maxsize=2)
+            return {'name': name, 'queue': shard_queue, 'future': executor.submit(write_shard, name, shard_queue), 'bytes': 0, 'members': 0}
+
+        try:
+            for i, item in enumerate(items):
+                slot = i % writer_threads
+                if slot == len(open_shards):
+                    open_shards.append(start_shard())
+                shard = open_shards[slot]
+                size = tar_member_size(int(item[1]['ContentLength']))
+                if shard['members'] and (shard_size and shard['bytes'] + size > shard_size or
+                                         shard_members and shard['members'] >= shard_members):
+                    put(shard, None)
+                    finished_shards.append(shard)
+                    shard = open_shards[slot] = start_shard()
+                put(shard, item)
+                shard['bytes'] += size
+                shard['members'] += 1
+            for shard in open_shards:
+                put(shard, None)
+        except BaseException:
+            abort.set()
+            # every writer closes the items left in its queue until it gets the sentinel
+            for shard in open_shards:
+                shard['queue'].put(None)
+            raise
+        return {shard['name']: shard['future'].result() for shard in sorted(finished_shards + open_shards, key=itemgetter('name'))}
+
+
+def tar_checksums(tar_hash, tar_file, resume_state=None):
+    """
+        Return whole-tar checksums for the manifest's checksums file (see manifest_checksums_path()), once the tar
+        has been written through tar_hash, a sha256 HashingFile wrapping tar_file, the writer from open_tar_writer():
+
+        {'Size': tar size, 'SHA256': hex digest, 'ETag': S3 ETag}
+
+        ETag is the multipart ETag expected for tars written to S3 (see multipart_etag()), and None otherwise.
+        SHA256 is None for tars resumed from resume_state, since only the resumed part of the tar was hashed.
+    """
+    parts = getattr(tar_file, 'parts', None)
+    return {
+        'Size': (resume_state['Position'] if resume_state else 0) + tar_hash.length,
+        'SHA256': None if resume_state else tar_hash.hexdigest(),
+        'ETag': multipart_etag([part['MD5'] for part in parts]) if parts and all('MD5' in part for part in parts) else None,
+    }
+
+
+def tar_member_size(size):
+    """
+        Approximate bytes taken in a tar written by write_tar by a member of `size` bytes: a pax header, a ustar
+        header, and the data padded to whole blocks.
+
+        >>> tar_member_size(1)
+        2048
+    """
+    return 3 * BLOCKSIZE + -(-size // BLOCKSIZE) * BLOCKSIZE
+
+
+def split_inventory(inventory_path, archive_urls, out_dir, buffer_rows=100000):
+    """
+        Read the S3 Inventory report at inventory_path once, and write the rows under each of archive_urls to
+        <out_dir>/<bucket>/<prefix>/inventory.csv, so that many write_tar(..., inventory=path) jobs can share one pass
+        over a large inventory. Return {archive_url: path}.
+
+        Up to buffer_rows rows are held in memory before being appended to their files, so only one file is open at a
+        time no matter how many archive_urls there are.
+    """
+    paths = {}
+    for archive_url in archive_urls:
+        bucket, prefix = parse_prefix(archive_url)
+        paths[(bucket, prefix)] = Path(out_dir, bucket, prefix, 'inventory.csv')
+    for path in paths.values():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'')
+
+    fieldnames = []
+    buffered = defaultdict(list)
+
+    def flush():
+        for path, rows in buffered.items():
+            with io.open(path, 'a', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=fieldnames)
+                if not f.tell():
+                    writer.writeheader()
+                writer.writerows(rows)
+        buffered.clear()
+
+    buffered_count = 0
+    for row in read_inventory(inventory_path):
+        if not fieldnames:
+            fieldnames.extend(row.keys())
+        # a row belongs to each archive_url whose prefix is the whole bucket or ends at one of the slashes in its key
+        key = row['Key']
+        end = 0
+        while end != -1:
+            path = paths.get((row['Bucket'], key[:end]))
+            if path:
+                buffered[path].append(row)
+                buffered_count += 1
+            end = key.find('/', end) + 1 or -1
+        if buffered_count >= buffer_rows:
+            flush()
+            buffered_count = 0
+    flush()
+    return {archive_url: str(paths[parse_prefix(archive_url)]) for archive_url in archive_urls}
+
+
+def fetch_memory(obj, pool, *args):
+    """
+        Approximate bytes of ram held while load_object(obj, pool, ...) is fetched and tarred: one pooled buffer for
+        small objects, or the range reads kept in flight for large ones.
+    """
+    if obj.size <= pool.buffer_size:
+        return pool.buffer_size
+    return min(obj.size, RANGED_GET_SIZE * (RANGED_GET_THREADS + 1))
+
+
+def validate_tar(manifest_path, tar_path, progress_bar=False, open_attempts=8, threads=1, segment_size=VALIDATE_SEGMENT_SIZE,
+                 headers_only=False, quick=False):
     """
         Verify that all items listed in manifest_path can be read from tar_path, and all items in tar_path are listed
-        in manifest_path, with matching hashes and file names.
+        in manifest_path, with matching hashes and file names. If the manifest has a TarShard column, each shard
+        named in it is validated against its rows (see member_tar_path()). Hard links written by write_tar(...,
+        dedup=True) are checked against the rows of the members they link to (see check_links()).
 
         Opening manifest and tar is attempted up to open_attempts times with exponential backoff,
         because files may not be found if they were just written to S3 by write_tar().
+
+        If threads is more than 1, the tar is split into segments of about segment_size bytes at the TarOffset
+        boundaries listed in the manifest, and segments are fetched and checked concurrently with range requests.
+        Segments cover the whole tar from byte 0 to the end-of-archive marker, so members missing from the manifest
+        are still detected. Compressed tars are split where a gzip frame starts (see write_tar()).
+
+        If headers_only is True, file contents and hashes aren't checked. Only the tar headers at each TarOffset, the
+        end-of-archive marker, and the size of the tar are read and checked, with `threads` concurrent small range
+        requests (see validate_tar_headers()).
+
+        If write_tar() recorded whole-tar checksums for the manifest (see manifest_checksums_path()), validating in a
+        single pass also checks the size and SHA-256 of the tar as it is read, and the other modes check its size
+        and S3 ETag (see validate_tar_checksums()). If quick is True, only that check is run, without reading the
+        manifest or tar at all.
     """
     def retry(func, *args, **kwargs):
         return retry_on_exception(func, args, kwargs, exception=IOError, attempts=open_attempts)
 
-    csv_entries = sorted(retry(read_dicts_from_csv, manifest_path), key=lambda r: int(r['TarOffset']))
+    checksums = read_checksums(manifest_path)
+    if quick:
+        if checksums is None:
+            raise FileNotFoundError("No tar checksums found for %s" % manifest_path)
+        validate_tar_checksums(tar_path, checksums)
+        return
+
+    csv_entries = list(retry(read_manifest_rows, manifest_path))
     if not csv_entries:
         raise ValueError("No entries found in manifest file.")
+    # manifests written with write_tar(..., ordered=True) are already in tar order
+    def tar_order(r):
+        return r.get('TarShard', ''), int(r['TarOffset'])
+    if any(tar_order(a) > tar_order(b) for a, b in zip(csv_entries, itertools.islice(csv_entries, 1, None))):
+        csv_entries.sort(key=tar_order)
+    shards = [(member_tar_path(tar_path, {'TarShard': shard}), list(entries))
+              for shard, entries in itertools.groupby(csv_entries, key=lambda r: r.get('TarShard', ''))]
+    for shard_path, shard_entries in shards:
+        check_links(shard_entries)
+
+    if headers_only:
+        with tqdm(total=len(csv_entries), disable=not progress_bar) as bar:
+            for shard_path, shard_entries in shards:
+                validate_tar_headers(shard_path, shard_entries, threads, open_attempts, bar)
+        if checksums:
+            validate_tar_checksums(tar_path, checksums, local_sha256=False)
+        return
+
+    if threads > 1:
+        client = s3_client() if tar_path.startswith('s3://') else None
+        with tqdm(total=len(csv_entries), disable=not progress_bar) as bar:
+            for count in threaded_queue(validate_tar_segment, (
+                    (shard_path, entries, start, end, open_attempts, client)
+                    for shard_path, shard_entries in shards
+                    for entries, start, end in tar_segments(shard_entries, segment_size)), threads):
+                bar.update(count)
+        if checksums:
+            validate_tar_checksums(tar_path, checksums, local_sha256=False, client=client)
+        return
+
+    with tqdm(total=len(csv_entries), disable=not progress_bar) as bar:
+        for shard_path, shard_entries in shards:
+            validate_tar_stream(shard_path, shard_entries, open_attempts, bar,
+                                checksums and checksums.get(shard_entries[0].get('TarShard', '')))
+
 
-    with retry(open, tar_path, 'rb', ignore_ext=True) as f:
-        tar_f, raw_f = TeeFile.tee(f)
-        tar = TarFile.open(fileobj=tar_f, mode='r|', bufsize=SPOOLED_FILE_SIZE)
-        raw_f.read(int(csv_entries[0]['TarOffset']))
-        for tarinfo in tqdm(tar, disable=not progress_bar):
-            if not csv_entries:
-                raise ValueError("Not enough files found in manifest. Looking for: %s" % tarinfo.name)
-            csv_entry = csv_entries.pop(0)
-            strip_prefix = csv_entry.get('TarStrippedPrefix', '')
-            if tarinfo.name != csv_entry['Key'][len(strip_prefix):]:
-                raise ValueError("Mismatched keys: tar has %s, manifest has %s" % (tarinfo.name, csv_entry['Key'][len(strip_prefix):]))
-            if tarinfo.offset != int(csv_entry['TarOffset']):
-                raise ValueError("Tar file offset mismatch: %s" % tarinfo.name)
-            if tarinfo.offset_data != int(csv_entry['TarDataOffset']):
-                raise ValueError("Tar file data offset mismatch: %s" % tarinfo.name)
-            if tarinfo.size != int(csv_entry['TarSize']):
-                raise ValueError("Tar file size mismatch: %s" % tarinfo.name)
-            tar_contents = tar.extractfile(tarinfo)
-            size = tarinfo.size
-            raw_f.read(int(csv_entry['TarDataOffset']) - raw_f.tell())
-            checksum = hashlib.md5()
-            while size > 0:
-                read_len = min(size, SPOOLED_FILE_SIZE)
-                chunk1 = tar_contents.read(read_len)
-                chunk2 = raw_f.read(read_len)
-                if chunk1 != chunk2:
-                    raise ValueError("File content mismatch: %s" % tarinfo.name)
-                checksum.update(chunk1)
-                size -= read_len
-            if checksum.hexdigest() != csv_entry['TarMD5']:
-                raise ValueError("File hash mismatch: %s" % tarinfo.name)
-
-    if csv_entries:
-        raise ValueError("Manifest files not found in tar: %s" % ", ".join(c['Key'] for c in csv_entries))
-
-
-def delete_files(manifest_path, dry_run=True):
-    """
-        Delete all files listed in manifest_path. File hashes are required to match the etag listed in the manifest.
+def read_checksums(manifest_path):
+    """
+        Return the whole-tar checksums write_tar() recorded for manifest_path, as {TarShard: tar_checksums()}, with
+        '' for an unsharded tar, or None if the manifest was written without them.
+    """
+    try:
+        with open(manifest_checksums_path(manifest_path)) as f:
+            return json.load(f)['Tars']
+    except IOError:
+        return None
+
+
+def validate_tar_checksums(tar_path, checksums, local_sha256=True, client=None):
+    """
+        Check each tar (or tar shard) of tar_path against its checksums from read_checksums() without downloading it:
+        the size and multipart ETag of tars on S3 are compared with one HeadObject request. Local tars are only
+        checked by size, and by SHA-256 if local_sha256 is True.
+    """
+    for shard, expected in checksums.items():
+        path = member_tar_path(tar_path, {'TarShard': shard})
+        etag = None
+        if path.startswith('s3://'):
+            parsed = parse_uri(path)
+            response = (client or s3_client()).head_object(Bucket=parsed['bucket_id'], Key=parsed['key_id'])
+            size, etag = response['ContentLength'], response['ETag']
+        else:
+            size = os.path.getsize(path)
+        if size != expected['Size']:
+            raise ValueError("Tar file size mismatch: %s is %s bytes, expected %s" % (path, size, expected['Size']))
+        if etag and expected.get('ETag') and etag != expected['ETag']:
+            raise ValueError("Tar file ETag mismatch: %s has %s, expected %s" % (path, etag, expected['ETag']))
+        if local_sha256 and not path.startswith('s3://') and expected.get('SHA256'):
+            with io.open(path, 'rb') as f:
+                hashed = HashingFile(f, 'sha256')
+                copy_bytes(hashed, None, size)
+            check_tar_checksums(path, hashed, expected)
+
+
+def check_tar_checksums(tar_path, hashed, checksums):
+    """ Raise ValueError if the size or SHA-256 of HashingFile hashed, read to its end, don't match checksums. """
+    if hashed.length != checksums['Size']:
+        raise ValueError("Tar file size mismatch: %s is %s bytes, expected %s" % (tar_path, hashed.length, checksums['Size']))
+    if checksums.get('SHA256') and hashed.hexdigest() != checksums['SHA256']:
+        raise ValueError("Tar file hash mismatch: %s" % tar_path)
+
+
+def validate_tar_headers(tar_path, csv_entries, threads=1, open_attempts=8, bar=None, max_gap=HEADERS_MAX_GAP,
+                         max_range_size=HEADERS_MAX_RANGE_SIZE):
+    """
+        Check the tar headers in tar_path against csv_entries, its manifest rows sorted by TarOffset, without reading
+        file contents: the manifest must describe members that follow each other from offset 0 with no gaps, the
+        header at each TarOffset must match its row, and the members must be followed by an end-of-archive marker
+        and padding to the end of the tar. Headers are fetched with range requests, nearby headers together (see
+        coalesce_ranges()), using up to `threads` concurrent requests.
+    """
+    if is_compressed_entry(csv_entries[0]):
+        raise ValueError("Headers of compressed tars can't be validated separately.")
+    client = s3_client() if tar_path.startswith('s3://') else None
+    size = retry_on_exception(file_size, [tar_path, client], exception=IOError, attempts=open_attempts)
+
+    # each header runs to its member's data, or for a hard link, which has no data, to the next member. the end
+    # of a final hard link's header isn't known from the manifest, so it is read through the end of the tar.
+    ranges = []
+    next_offset = 0
+    for i, csv_entry in enumerate(csv_entries):
+        offset = int(csv_entry['TarOffset'])
+        if offset != next_offset:
+            raise ValueError("Tar file offset mismatch: %s" % csv_entry['Key'])
+        if csv_entry.get('TarLink'):
+            header_end = next_offset = int(csv_entries[i + 1]['TarOffset']) if i + 1 < len(csv_entries) else None
+        else:
+            header_end = int(csv_entry['TarDataOffset'])
+            data_end = header_end + int(csv_entry['TarSize'])
+            next_offset = data_end + (-data_end % BLOCKSIZE)
+        ranges.append((offset, header_end or size, (offset, header_end, csv_entry)))
+
+    archive_end = next_offset
+    groups = coalesce_ranges(ranges, max_gap, max_range_size)
+    for header_ends in threaded_queue(validate_tar_header_range, (
+            (tar_path, start, end, group, open_attempts, client) for start, end, group in groups), threads):
+        if bar:
+            bar.update(len(header_ends))
+        if archive_end is None:
+            archive_end = header_ends.get(csv_entries[-1]['Key'])
+
+    # the end-of-archive marker is two zero blocks, and tarfile pads the tar with zeros to a multiple of RECORDSIZE
+    if not archive_end + 2 * BLOCKSIZE <= size <= archive_end + 2 * BLOCKSIZE + RECORDSIZE:
+        raise ValueError("Tar file size mismatch: expected end-of-archive marker at %s, tar is %s bytes" % (archive_end, size))
+    with retry_on_exception(open_range, [tar_path, archive_end, size, client], exception=IOError, attempts=open_attempts) as f:
+        if f.read().strip(NUL):
+            raise ValueError("Tar file is missing its end-of-archive marker.")
+
+
+def validate_tar_header_range(tar_path, start, end, ranges, open_attempts=8, client=None):
+    """
+        Fetch bytes [start, end) of tar_path with one range request, and check the header at the start of each
+        (offset, header end, manifest row) in ranges against the row, for validate_tar_headers(). Each header must
+        end at its header end, unless that is None. Returns {Key: end of header} for the rows checked.
+    """
+    with retry_on_exception(open_range, [tar_path, start, end, client], exception=IOError, attempts=open_attempts) as f:
+        data = f.read()
+    header_ends = {}
+    for offset, header_end, csv_entry in ranges:
+        header = data[offset - start:(header_end or end) - start]
+        reader = TarReader(io.BytesIO(header), buffer_size=max(BLOCKSIZE, len(header)))
+        member = next(iter(reader), None)
+        if member is None:
+            raise ValueError("Manifest files not found in tar: %s" % csv_entry['Key'])
+        check_tar_member(member, csv_entry, offset)
+        if header_end is not None and offset + member.offset_data != header_end:
+            raise ValueError("Tar file data offset mismatch: %s" % member.name)
+        header_ends[csv_entry['Key']] = offset + member.offset_data
+    return header_ends
+
+
+def validate_tar_stream(tar_path, csv_entries, open_attempts=8, bar=None, checksums=None):
+    """
+        Validate tar_path against csv_entries, its manifest rows sorted by TarOffset, in a single pass. If checksums
+        from read_checksums() are given, the size and SHA-256 of the tar are checked as it is read.
+    """
+    with retry_on_exception(open, [tar_path, 'rb'], {'ignore_ext': True}, exception=IOError, attempts=open_attempts) as raw:
+        hashed = HashingFile(raw, 'sha256') if checksums else raw
+        f = GzipSourceFile(hashed) if is_compressed_entry(csv_entries[0]) else hashed
+        check_tar_stream(f, csv_entries, bar=bar)
+        if checksums:
+            # hash the padding after the end-of-archive marker
+            for _ in iter(lambda: hashed.read(SPOOLED_FILE_SIZE), b''):
+                pass
+            check_tar_checksums(tar_path, hashed, checksums)
+
+
+def check_tar_stream(f, csv_entries, start=0, end_marker=True, bar=None):
+    """
+        Check the tar members read from file f, which starts at offset `start` in the tar, against csv_entries, the
+        manifest rows for those members sorted by TarOffset. Headers are parsed and data hashed in place in a single
+        pass with TarReader. If end_marker is True, f must end with the tar's end-of-archive marker; otherwise it may
+        also end at a member boundary. Returns the number of members checked.
+    """
+    reader = TarReader(f)
+    checked = 0
+    for member in reader:
+        if checked >= len(csv_entries):
+            raise ValueError("Not enough files found in manifest. Looking for: %s" % member.name)
+        csv_entry = csv_entries[checked]
+        check_tar_member(member, csv_entry, start)
+        checked += 1
+        if not member.islnk():
+            hashes = manifest_hashes(csv_entry)
+            for chunk in reader.read(member.size):
+                for h in hashes.values():
+                    h.update(chunk)
+            check_hashes(member.name, hashes, csv_entry)
+        if bar:
+            bar.update(1)
+    if checked < len(csv_entries):
+        raise ValueError("Manifest files not found in tar: %s" % ", ".join(c['Key'] for c in csv_entries[checked:]))
+    if end_marker and not reader.end_marker:
+        raise ValueError("Tar file is missing its end-of-archive marker.")
+    return checked
+
+
+def check_tar_member(tarinfo, csv_entry, start=0):
+    """
+        Raise ValueError if the name, offsets or size of tarinfo, a TarMember or TarInfo, don't match csv_entry.
+        `start` is the offset within the tar of the stream tarinfo was read from.
+    """
+    strip_prefix = csv_entry.get('TarStrippedPrefix', '')
+    if tarinfo.name != csv_entry['Key'][len(strip_prefix):]:
+        raise ValueError("Mismatched keys: tar has %s, manifest has %s" % (tarinfo.name, csv_entry['Key'][len(strip_prefix):]))
+    if start + tarinfo.offset != int(csv_entry['TarOffset']):
+        raise ValueError("Tar file offset mismatch: %s" % tarinfo.name)
+    if tarinfo.islnk() or csv_entry.get('TarLink'):
+        # the link's data offset and size were checked against its target by check_links()
+        if not tarinfo.islnk() or tarinfo.linkname != csv_entry.get('TarLink'):
+            raise ValueError("Tar file link mismatch: %s" % tarinfo.name)
+        return
+    if start + tarinfo.offset_data != int(csv_entry['TarDataOffset']):
+        raise ValueError("Tar file data offset mismatch: %s" % tarinfo.name)
+    if tarinfo.size != int(csv_entry['TarSize']):
+        raise ValueError("Tar file size mismatch: %s" % tarinfo.name)
+
+
+def check_links(csv_entries):
+    """
+        Raise ValueError unless each manifest row in csv_entries with a TarLink column names an earlier member of
+        the same tar with the same data offset, size, ETag and hashes. Rows must be sorted by TarOffset.
+
+        >>> rows = [{'Key': 'a', 'TarOffset': '0', 'TarDataOffset': '512', 'TarSize': '3', 'ETag': 'e', 'TarMD5': 'e', 'TarLink': ''},
+        ...         {'Key': 'b', 'TarOffset': '1024', 'TarDataOffset': '512', 'TarSize': '3', 'ETag': 'e', 'TarMD5': 'e', 'TarLink': 'a'}]
+        >>> check_links(rows)
+        >>> rows[1]['TarMD5'] = 'f'
+        >>> check_links(rows)
+        Traceback (most recent call last):
+        ...
+        ValueError: Tar file link mismatch: b
+    """
+    link_names = set(row['TarLink'] for row in csv_entries if row.get('TarLink'))
+    if not link_names:
+        return
+    targets = {}
+    for row in csv_entries:
+        if row.get('TarLink'):
+            target = targets.get(row['TarLink'])
+            if not target or any(row.get(column) != target.get(column) for column in ('TarDataOffset', 'TarSize', 'ETag', 'TarMD5', 'TarSHA256')):
+                raise ValueError("Tar file link mismatch: %s" % row['Key'])
+        else:
+            name = row['Key'][len(row.get('TarStrippedPrefix', '')):]
+            if name in link_names:
+                targets[name] = row
+
+
+def manifest_hashes(csv_entry):
+    """
+        Return {column: hash object} for each hash column recorded in manifest row csv_entry.
+
+        >>> list(manifest_hashes({'TarMD5': 'abc', 'TarSHA256': ''}))
+        ['TarMD5']
+    """
+    return OrderedDict((column, hashlib.new(name)) for column, name in (('TarMD5', 'md5'), ('TarSHA256', 'sha256'))
+                       if csv_entry.get(column))
+
+
+def check_hashes(name, hashes, csv_entry):
+    """ Raise ValueError if any of the hashes returned by manifest_hashes(csv_entry) don't match csv_entry. """
+    for column, h in hashes.items():
+        if h.hexdigest() != csv_entry[column]:
+            raise ValueError("File hash mismatch: %s" % name)
+
+
+def tar_segments(csv_entries, segment_size):
+    """
+        Split manifest rows, sorted by TarOffset, into (entries, start, end) segments of roughly segment_size bytes.
+        The first segment starts at 0 and the last has end None, so together they cover the entire tar.
+        For compressed tars, start and end are TarCompressedOffset values, and segments only start at files whose
+        tar header starts a gzip frame.
+
+        >>> rows = [{'TarOffset': str(o)} for o in (0, 1024, 2048, 3072)]
+        >>> [(len(e), start, end) for e, start, end in tar_segments(rows, 2000)]
+        [(2, 0, 2048), (2, 2048, None)]
+    """
+    segments = []
+    start = 0
+    entries = []
+    for csv_entry in csv_entries:
+        if is_compressed_entry(csv_entry):
+            if csv_entry['TarFrameOffset'] != csv_entry['TarOffset']:
+                entries.append(csv_entry)
+                continue
+            offset = int(csv_entry['TarCompressedOffset'])
+        else:
+            offset = int(csv_entry['TarOffset'])
+        if entries and offset - start >= segment_size:
+            segments.append((entries, start, offset))
+            start = offset
+            entries = []
+        entries.append(csv_entry)
+    segments.append((entries, start, None))
+    return segments
+
+
+def validate_tar_segment(tar_path, csv_entries, start, end, open_attempts=8, client=None):
+    """
+        Validate the members of tar_path between byte offsets start and end against csv_entries, the manifest rows
+        whose TarOffset falls in that range. Return the number of members checked.
+        For compressed tars, start and end are offsets in the compressed file (see tar_segments()).
+    """
+    compressed = is_compressed_entry(csv_entries[0])
+    tar_start = int(csv_entries[0]['TarOffset']) if compressed else start
+    with retry_on_exception(open_range, [tar_path, start, end, client, compressed], exception=IOError, attempts=open_attempts) as f:
+        return check_tar_stream(f, csv_entries, tar_start, end_marker=end is None)
+
+
+def sample_tars(jobs, confidence=SAMPLE_CONFIDENCE, defect_rate=SAMPLE_DEFECT_RATE, byte_budget=None, threads=THREADS,
+                seed=None, progress_bar=False, open_attempts=8):
+    """
+        Validate a random sample of the files in each of many archives, for audits where re-reading every tar with
+        validate_tar() is too expensive. jobs is a list of (manifest_path, tar_path) pairs.
+
+        Each archive's sample is sized by sample_size() so that, if at least defect_rate of its files are corrupt, at
+        least one corrupt file is sampled with probability confidence. If byte_budget is set, sampling also stops
+        at the first file that would take it past byte_budget bytes of file data read from the archive, so the
+        report's confidence may fall short of the target. Larger files aren't skipped in favour of smaller ones that
+        would still fit, so the sample stays uniform and its confidence holds for files of any size. Hard links
+        share their target's data and aren't sampled separately.
+
+        Manifests are read, and then the data of every sampled file across all archives fetched at its TarDataOffset
+        and checked against its manifest hashes (see manifest_hashes()), using up to `threads` concurrent requests.
+        Unlike validate_tar(), tar headers and files missing from the manifest aren't checked.
+
+        Returns a report for each job, in order, like:
+
+        {'ManifestPath': ..., 'TarPath': ..., 'Files': 1000, 'Bytes': 10000000, 'SampledFiles': 299,
+         'SampledBytes': 2990000, 'Confidence': 0.95, 'Failures': [(Key, error message), ...]}
+
+        Confidence is the probability that the sample would have caught defect_rate corruption (see
+        sample_confidence()); it is only meaningful if Failures is empty.
+    """
+    rng = random.Random(seed)
+    client = s3_client() if any(tar_path.startswith('s3://') for manifest_path, tar_path in jobs) else None
+    reports = [None] * len(jobs)
+    samples = [None] * len(jobs)
+    for i, report, sample in threaded_queue(sample_manifest, (
+            (i, manifest_path, tar_path, random.Random(rng.random()), confidence, defect_rate, byte_budget, open_attempts)
+            for i, (manifest_path, tar_path) in enumerate(jobs)), threads):
+        reports[i], samples[i] = report, sample
+
+    with tqdm(total=sum(len(sample) for sample in samples), disable=not progress_bar) as bar:
+        for i, entry, error in threaded_queue(check_sampled_file, (
+                (i, jobs[i][1], entry, open_attempts, client) for i, sample in enumerate(samples) for entry in sample), threads):
+            if error:
+                reports[i]['Failures'].append((entry['Key'], error))
+            bar.update(1)
+    return reports
+
+
+def sample_manifest(i, manifest_path, tar_path, rng, confidence, defect_rate, byte_budget=None, open_attempts=8):
+    """
+        Read manifest_path and choose the rows to check for sample_tars(). Returns (i, report, sampled rows).
+    """
+    rows = [row for row in retry_on_exception(read_manifest_rows, [manifest_path], exception=IOError, attempts=open_attempts)
+            if not row.get('TarLink')]
+    rng.shuffle(rows)
+    sample = []
+    sampled_bytes = 0
+    for row in itertools.islice(rows, sample_size(len(rows), confidence, defect_rate)):
+        size = int(row['TarSize'])
+        if byte_budget is not None and sampled_bytes + size > byte_budget:
+            break
+        sample.append(row)
+        sampled_bytes += size
+    return i, {
+        'ManifestPath': manifest_path,
+        'TarPath': tar_path,
+        'Files': len(rows),
+        'Bytes': sum(int(row['TarSize']) for row in rows),
+        'SampledFiles': len(sample),
+        'SampledBytes': sampled_bytes,
+        'Confidence': sample_confidence(len(sample), len(rows), defect_rate),
+        'Failures': [],
+    }, sample
+
+
+def check_sampled_file(i, tar_path, entry, open_attempts=8, client=None):
+    """
+        Fetch the data of manifest row entry from tar_path and check it against the row's hashes, for sample_tars().
+        Returns (i, entry, error message or None).
+    """
+    def read_hashes():
+        hashes = manifest_hashes(entry)
+        size = 0
+        with open_manifest_entry(tar_path, entry, client) as f:
+            for chunk in iter(lambda: f.read(SPOOLED_FILE_SIZE), b''):
+                size += len(chunk)
+                for h in hashes.values():
+                    h.update(chunk)
+        return size, hashes
+
+    try:
+        size, hashes = retry_on_exception(read_hashes, exception=IOError, attempts=open_attempts)
+        if size != int(entry['TarSize']):
+            raise ValueError("Tar file size mismatch: %s" % entry['Key'])
+        check_hashes(entry['Key'], hashes, entry)
+    except (IOError, ValueError, ClientError) as e:
+        return i, entry, str(e)
+    return i, entry, None
+
+
+def convert_manifest(manifest_path, out_path, index=True):
+    """
+        Copy the manifest at manifest_path to out_path, converting between csv and Parquet according to their
+        extensions (see write_manifest()), e.g. to export a Parquet manifest as csv. If index is True and out_path
+        is an uncompressed csv, also write its sparse index. Whole-tar checksums are copied along with the manifest.
+    """
+    index_path = manifest_index_path(out_path) if index and not is_compressed(out_path) and not is_parquet(out_path) else None
+    write_manifest(out_path, read_manifest_rows(manifest_path), index_path)
+    checksums = read_checksums(manifest_path)
+    if checksums is not None:
+        with open(manifest_checksums_path(out_path), 'w') as f:
+            json.dump({'Tars': checksums}, f, indent=2)
+
+
+def delete_files(manifest_paths, dry_run=True, threads=THREADS, etag_check='list', attempts=8):
+    """
+        Delete all files listed in manifest_paths (one path or a list of paths). File hashes are required to match
+        the etag listed in the manifest, and the current etag of each object is checked before it is deleted, so
+        objects that have changed since they were archived are never removed.
 
         Returns a dictionary of results by bucket, e.g.:
 
         {
-            'bucket': {'keys': [], 'deleted': [], 'errors': [], 'mismatched': []}
+            'bucket': {'keys': [], 'deleted': [], 'errors': [], 'mismatched': [], 'changed': [], 'missing': []}
         }
 
-        keys: all keys listed in manifest
+        keys: all keys listed in manifests whose 'ETag' column matches the 'TarMD5' column
         deleted: keys successfully deleted
-        errors: keys not deleted by S3 (e.g. permissions problem or key not found)
+        errors: keys not deleted by S3 (e.g. permissions problem)
         mismatched: keys whose 'ETag' column does not match the 'TarMD5' column
+        changed: keys whose current etag no longer matches the manifest, which are not deleted
+        missing: keys that no longer exist, which are not deleted
+
+        With dry_run, etags are still checked, but nothing is deleted: keys that would be deleted are those in
+        'keys' but not 'changed' or 'missing'.
+
+        If etag_check is 'list', current etags are found by listing the common prefix of each manifest's keys in each
+        bucket; if 'head', with one HeadObject request per key. Listing is much cheaper for manifests of whole
+        prefixes, and HeadObject for manifests of a few keys from a large prefix.
+
+        Manifests are read, etags checked, and batches of up to 1000 keys deleted with up to `threads` requests at
+        once. Throttled requests, and keys that DeleteObjects reports as throttled, are retried up to `attempts`
+        times with backoff.
 
         Limitations:
-        * etags of actual files deleted are not checked prior to deletion.
+        * an object changed after its etag is checked but before the delete batch is sent will still be deleted.
         * multipart-uploaded files will have mismatching hashes and will not be deleted.
     """
-    buckets = defaultdict(lambda: {'keys': [], 'deleted': [], 'errors': [], 'mismatched': []})
-    for entry in read_dicts_from_csv(manifest_path):
-        if entry['ETag'] != entry['TarMD5']:
-            buckets[entry['Bucket']]['mismatched'].append(entry['Key'])
-            continue
-        buckets[entry['Bucket']]['keys'].append(entry['Key'])
-    if not dry_run:
-        for bucket, keys in buckets.items():
-            for delete_batch in chunks(keys['keys'], 1000):
-                response = boto3.resource('s3').Bucket(bucket).delete_objects(
-                    Delete={
-                        'Objects': [{'Key': k} for k in delete_batch],
-                        'Quiet': False,
-                    }
-                )
-                if 'Deleted' in response:
-                    keys['deleted'].extend(o['Key'] for o in response['Deleted'])
-                if 'Errors' in response:
-                    keys['errors'].extend(o['Key'] for o in response['Errors'])
+    if etag_check not in ('list', 'head'):
+        raise ValueError("Unknown etag_check %s" % etag_check)
+    if isinstance(manifest_paths, (str, Path)):
+        manifest_paths = [manifest_paths]
+    client = boto3.client('s3', config=Config(retries={'max_attempts': attempts, 'mode': 'adaptive'}))
+    buckets = defaultdict(lambda: {'keys': [], 'deleted': [], 'errors': [], 'mismatched': [], 'changed': [], 'missing': []})
+
+    def check_tasks():
+        for manifest_path, entries in threaded_queue(read_manifest, ((p,) for p in manifest_paths), threads):
+            entries_by_bucket = defaultdict(list)
+            for entry in entries:
+                if entry['ETag'] != entry['TarMD5']:
+                    buckets[entry['Bucket']]['mismatched'].append(entry['Key'])
+                    continue
+                buckets[entry['Bucket']]['keys'].append(entry['Key'])
+                entries_by_bucket[entry['Bucket']].append(entry)
+            for bucket, bucket_entries in entries_by_bucket.items():
+                if etag_check == 'list':
+                    yield client, bucket, bucket_entries, etag_check
+                else:
+                    for entry in bucket_entries:
+                        yield client, bucket, [entry], etag_check
+
+    def delete_tasks():
+        pending = defaultdict(list)
+        for bucket, unchanged, changed, missing in threaded_queue(check_etags, check_tasks(), threads):
+            buckets[bucket]['changed'].extend(changed)
+            buckets[bucket]['missing'].extend(missing)
+            if dry_run:
+                continue
+            pending[bucket].extend(unchanged)
+            while len(pending[bucket]) >= 1000:
+                yield client, bucket, pending[bucket][:1000], attempts
+                del pending[bucket][:1000]
+        for bucket, keys in pending.items():
+            if keys:
+                yield client, bucket, keys, attempts
+
+    for bucket, deleted, errors in threaded_queue(delete_batch, delete_tasks(), threads):
+        buckets[bucket]['deleted'].extend(deleted)
+        buckets[bucket]['errors'].extend(errors)
     return buckets
 
 
+def read_manifest(manifest_path):
+    """ Return (manifest_path, list of manifest rows). """
+    return manifest_path, list(read_manifest_rows(manifest_path))
+
+
+def check_etags(client, bucket, entries, etag_check='list'):
+    """
+        Compare the ETags of manifest rows `entries` from `bucket` with their current ETags, found with a fresh
+        listing of the rows' common prefix if etag_check is 'list', or a HeadObject request per row if 'head'.
+        Return (bucket, unchanged keys, changed keys, missing keys).
+    """
+    etags = {entry['Key']: entry['ETag'] for entry in entries}
+    unchanged, changed = [], []
+    if etag_check == 'list':
+        current = ((obj['Key'], obj['ETag'])
+                   for page in client.get_paginator('list_objects').paginate(Bucket=bucket, Prefix=os.path.commonprefix(list(etags)))
+                   for obj in page.get('Contents', []))
+    else:
+        def head(key):
+            try:
+                return key, client.head_object(Bucket=bucket, Key=key)['ETag']
+            except ClientError as e:
+                if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                    return key, None
+                raise
+        current = (head(key) for key in list(etags))
+    for key, etag in current:
+        if etag is not None and key in etags:
+            (unchanged if etag.strip('"') == etags.pop(key) else changed).append(key)
+    return bucket, unchanged, changed, list(etags)
+
+
+def delete_batch(client, bucket, keys, attempts=8):
+    """
+        Delete up to 1000 keys from bucket with DeleteObjects, retrying keys that S3 reports as throttled or
+        failed with an internal error. Return (bucket, deleted keys, error keys).
+    """
+    deleted, errors = [], []
+    for attempt in range(attempts):
+        response = client.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': False})
+        deleted.extend(o['Key'] for o in response.get('Deleted', []))
+        keys = []
+        for o in response.get('Errors', []):
+            if o.get('Code') in ('SlowDown', 'InternalError', 'ServiceUnavailable') and attempt < attempts - 1:
+                keys.append(o['Key'])
+            else:
+                errors.append(o['Key'])
+        if not keys:
+            break
+        sleep(.1 * 2 ** attempt)
+    return bucket, deleted, errors
+
+
+# states of a job run by run_batch(), in order
+BATCH_STATES = ('pending', 'archived', 'validated', 'deleted')
+
+
+def run_batch(jobs_path, state_path, processes=4, validate=True, delete=False, validate_threads=1, progress_bar=False,
+              **write_tar_kwargs):
+    """
+        Run the archive jobs listed in jobs_path, a csv with archive_url, manifest_path and tar_path columns, across
+        a pool of `processes` worker processes (or in this process, if processes is 0). Each worker reuses one S3
+        connection pool for all of its jobs (see s3_resource()). Each job is archived with write_tar(...,
+        **write_tar_kwargs), then validated with validate_tar(..., threads=validate_threads) if
+        validate is True, then its original files are deleted if delete is
+        True. With validate False, files are deleted as soon as they are archived.
+
+        Each job's state (see BATCH_STATES) is tracked in the SQLite database at state_path, so running the batch again
+        skips steps that already completed. Unless output is sharded, archives are checkpointed to
+        <state_path>.checkpoints/, so interrupted archives resume where they stopped. Failed jobs are recorded with
+        their error, and retried on the next run. Returns {state: number of jobs}, plus 'failed'.
+    """
+    with sqlite3.connect(state_path) as db:
+        db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            archive_url TEXT, manifest_path TEXT, tar_path TEXT,
+            state TEXT DEFAULT 'pending', attempts INTEGER DEFAULT 0, error TEXT,
+            UNIQUE (archive_url, manifest_path, tar_path))""")
+        db.executemany("INSERT OR IGNORE INTO jobs (archive_url, manifest_path, tar_path) VALUES (?, ?, ?)",
+                       ((job['archive_url'], job['manifest_path'], job['tar_path']) for job in read_dicts_from_csv(jobs_path)))
+        target_state = 'deleted' if delete else 'validated' if validate else 'archived'
+        targets = BATCH_STATES[:BATCH_STATES.index(target_state)]
+        job_ids = [row[0] for row in db.execute(
+            "SELECT id FROM jobs WHERE state IN (%s) ORDER BY id" % ", ".join("?" * len(targets)), targets)]
+    db.close()
+
+    args = ((state_path, job_id, validate, delete, validate_threads, write_tar_kwargs) for job_id in job_ids)
+    with tqdm(total=len(job_ids), disable=not progress_bar) as bar:
+        if processes:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+                futures = [executor.submit(run_batch_job, *job_args) for job_args in args]
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+                    bar.update(1)
+        else:
+            for job_args in args:
+                run_batch_job(*job_args)
+                bar.update(1)
+
+    with sqlite3.connect(state_path) as db:
+        counts = dict.fromkeys(BATCH_STATES + ('failed',), 0)
+        counts.update(db.execute("SELECT state, count(*) FROM jobs GROUP BY state"))
+        counts['failed'] = db.execute("SELECT count(*) FROM jobs WHERE error IS NOT NULL").fetchone()[0]
+    db.close()
+    return counts
+
+
+def run_batch_job(state_path, job_id, validate, delete, validate_threads, write_tar_kwargs):
+    """
+        Run the remaining steps of job job_id from run_batch()'s database at state_path, recording each step in the
+        database as it completes, and any error.
+    """
+    def query(sql, *params):
+        with sqlite3.connect(state_path, timeout=600) as db:
+            result = db.execute(sql, params).fetchone()
+        db.close()
+        return result
+
+    archive_url, manifest_path, tar_path, state, attempts = query(
+        "SELECT archive_url, manifest_path, tar_path, state, attempts FROM jobs WHERE id = ?", job_id)
+    query("UPDATE jobs SET attempts = attempts + 1 WHERE id = ?", job_id)
+    try:
+        if state == 'pending':
+            checkpoint_path = None
+            if not (write_tar_kwargs.get('shard_size') or write_tar_kwargs.get('shard_members')):
+                checkpoint_dir = Path(state_path + '.checkpoints')
+                checkpoint_dir.mkdir(exist_ok=True)
+                checkpoint_path = str(checkpoint_dir / ('%s.json' % job_id))
+            # outputs left by an earlier, interrupted attempt can be overwritten
+            write_tar(archive_url, manifest_path, tar_path, overwrite=bool(attempts), checkpoint_path=checkpoint_path,
+                      **write_tar_kwargs)
+            state = 'archived'
+            query("UPDATE jobs SET state = ?, error = NULL WHERE id = ?", state, job_id)
+        if validate and state == 'archived':
+            validate_tar(manifest_path, tar_path, threads=validate_threads)
+            state = 'validated'
+            query("UPDATE jobs SET state = ?, error = NULL WHERE id = ?", state, job_id)
+        if delete and (state == 'validated' or not validate and state == 'archived'):
+            buckets = delete_files(manifest_path, dry_run=False)
+            errors = sum(len(keys['errors']) for keys in buckets.values())
+            if errors:
+                raise IOError("%s keys could not be deleted." % errors)
+            state = 'deleted'
+        query("UPDATE jobs SET state = ?, error = NULL WHERE id = ?", state, job_id)
+    except Exception as e:
+        query("UPDATE jobs SET error = ? WHERE id = ?", "%s: %s" % (type(e).__name__, e), job_id)
+
+
 @contextmanager
 def open_archived_file(manifest_path, tar_path, file_path):
     """
         Load a single file from the given tar_path, with offsets looked up from manifest_path, and original bucket and
         key for the file given by file_path.
+        If the manifest has a sparse index, only the block of the manifest that could contain file_path is read.
+        For Parquet manifests, only the row group that could contain file_path is read.
     """
     parsed = parse_uri(file_path)
-    entry = next((r for r in read_dicts_from_csv(manifest_path) if r['Bucket'] == parsed['bucket_id'] and r['Key'] == parsed['key_id']), None)
+
+    def scan_manifest():
+        return next((r for r in read_manifest_rows(manifest_path) if r['Bucket'] == parsed['bucket_id'] and r['Key'] == parsed['key_id']), None)
+
+    if is_parquet(manifest_path):
+        entry = find_parquet_manifest_entry(manifest_path, parsed['bucket_id'], parsed['key_id'])
+    elif is_compressed(manifest_path):
+        entry = scan_manifest()
+    else:
+        try:
+            entry = find_manifest_entry(manifest_path, manifest_index_path(manifest_path), parsed['bucket_id'], parsed['key_id'])
+        except IOError:  # manifest was written without an index
+            entry = scan_manifest()
     if not entry:
         raise FileNotFoundError
-    with open(tar_path, 'rb') as f:
-        yield OffsetSizeFile(f, int(entry['TarDataOffset']), int(entry['TarSize']))
+    with open_manifest_entry(tar_path, entry) as f:
+        yield f
+
+
+@contextmanager
+def open_manifest_entry(tar_path, entry, client=None):
+    """
+        Open the data of the file described by manifest row entry in tar_path (or its tar shard) as a file-like
+        object, with one range request.
+    """
+    data_offset = int(entry['TarDataOffset'])
+    if is_compressed_entry(entry):
+        # decompress the file's frames, skipping to its data
+        compressed_offset = int(entry['TarCompressedOffset'])
+        with open_range(member_tar_path(tar_path, entry), compressed_offset, compressed_offset + int(entry['TarCompressedSize']),
+                        client, decompress=True) as f:
+            yield OffsetSizeFile(f, data_offset - int(entry['TarFrameOffset']), int(entry['TarSize']))
+        return
+    with open_range(member_tar_path(tar_path, entry), data_offset, data_offset + int(entry['TarSize']), client) as f:
+        yield f
+
+
+def extract_files(manifest_path, tar_path, out_dir, file_paths=(), prefix=None, threads=THREADS, progress_bar=False,
+                  max_gap=EXTRACT_MAX_GAP, max_range_size=EXTRACT_MAX_RANGE_SIZE):
+    """
+        Extract many files from tar_path to out_dir/<Key>, with offsets looked up in a single pass over manifest_path.
+
+        Files are selected by file_paths, a list of URLs like s3://<Bucket>/<Key>, and/or by prefix, a URL prefix
+        like s3://<Bucket>/<Key prefix>. Selected files are sorted by TarDataOffset and nearby files in the same tar
+        (or tar shard) are fetched together with one range request per group (see coalesce_ranges()), using up to
+        `threads` concurrent requests. For compressed tars, groups are runs of gzip frames, decompressed as they
+        are fetched.
+
+        Returns a list of paths written.
+    """
+    entries = select_manifest_entries(manifest_path, file_paths, prefix)
+    for entry in entries:
+        if '..' in entry['Key'].split('/'):
+            raise ValueError("Refusing to extract %s outside of %s" % (entry['Key'], out_dir))
+
+    # coalesce ranges within each tar shard
+    entries_by_shard = defaultdict(list)
+    for entry in entries:
+        entries_by_shard[member_tar_path(tar_path, entry)].append(entry)
+    groups = []
+    for shard_path, shard_entries in entries_by_shard.items():
+        if is_compressed_entry(shard_entries[0]):
+            ranges = sorted(((int(e['TarCompressedOffset']), int(e['TarCompressedOffset']) + int(e['TarCompressedSize']), e) for e in shard_entries),
+                            key=lambda r: (r[0], int(r[2]['TarDataOffset'])))
+        else:
+            ranges = sorted(((int(e['TarDataOffset']), int(e['TarDataOffset']) + int(e['TarSize']), e) for e in shard_entries), key=lambda r: r[:2])
+        groups.extend((shard_path,) + group for group in coalesce_ranges(ranges, max_gap, max_range_size))
+    client = s3_client() if tar_path.startswith('s3://') else None
+    paths = []
+    with tqdm(total=len(entries), disable=not progress_bar) as bar:
+        for group_paths in threaded_queue(extract_range, ((shard_path, start, end, group, out_dir, client) for shard_path, start, end, group in groups), threads):
+            paths.extend(group_paths)
+            bar.update(len(group_paths))
+    return paths
+
+
+def select_manifest_entries(manifest_path, file_paths=(), prefix=None):
+    """
+        Return the rows of manifest_path selected by file_paths, a list of URLs like s3://<Bucket>/<Key>, and/or by
+        prefix, a URL prefix like s3://<Bucket>/<Key prefix>, in a single pass over the manifest. Raises
+        FileNotFoundError if any of file_paths aren't in the manifest.
+    """
+    wanted = set()
+    for file_path in file_paths:
+        parsed = parse_uri(file_path)
+        wanted.add((parsed['bucket_id'], parsed['key_id']))
+    if prefix:
+        parsed_prefix = parse_uri(prefix)
+    entries = []
+    for entry in read_manifest_rows(manifest_path):
+        key = (entry['Bucket'], entry['Key'])
+        if key in wanted:
+            wanted.remove(key)
+        elif not (prefix and entry['Bucket'] == parsed_prefix['bucket_id'] and entry['Key'].startswith(parsed_prefix['key_id'])):
+            continue
+        entries.append(entry)
+    if wanted:
+        raise FileNotFoundError("Files not found in manifest: %s" % ", ".join("s3://%s/%s" % k for k in sorted(wanted)))
+    return entries
+
+
+def extract_range(tar_path, start, end, entries, out_dir, client=None):
+    """
+        Fetch bytes [start, end) of tar_path with one range request, and write each manifest row in entries, sorted by
+        TarDataOffset, to out_dir/<Key>. Entries sharing the same data, such as hard links, are copied from the
+        first file written. Returns a list of paths written.
+        For compressed tars, start and end are offsets of gzip frames, and are decompressed as they are read.
+    """
+    paths = []
+    compressed = is_compressed_entry(entries[0])
+    with open_range(tar_path, start, end, client, compressed) as f:
+        pos = int(entries[0]['TarFrameOffset']) if compressed else start
+        for entry in entries:
+            data_offset = int(entry['TarDataOffset'])
+            size = int(entry['TarSize'])
+            out_path = out_dir.rstrip('/') + '/' + entry['Key']
+            make_parent_dir(out_path)
+            with open(out_path, 'wb', ignore_ext=True) as out:
+                if data_offset < pos:
+                    with open(paths[-1], 'rb', ignore_ext=True) as previous:
+                        copy_bytes(previous, out, size)
+                    paths.append(out_path)
+                    continue
+                copy_bytes(f, None, data_offset - pos)
+                copy_bytes(f, out, size)
+            pos = data_offset + size
+            paths.append(out_path)
+    return paths
+
+
+def restore_files(manifest_path, tar_path, file_paths=(), prefix=None, threads=THREADS, overwrite=False,
+                  progress_bar=False, part_size=RESTORE_PART_SIZE, attempts=8):
+    """
+        Restore files from tar_path on S3 to their original Bucket and Key, selected as in extract_files(). Each file
+        is copied server-side from its TarDataOffset and TarSize in the tar with multipart UploadPartCopy requests
+        of at most part_size bytes, so no file data passes through this machine. `threads` files are restored at
+        once, with requests throttled by S3 retried up to `attempts` times with adaptive backoff.
+
+        Unless overwrite is True, files whose Key already exists are skipped. Returns a dictionary of file URLs:
+
+        {'restored': [], 'existing': []}
+    """
+    if not tar_path.startswith('s3://'):
+        raise ValueError("Files can only be restored from a tar on S3.")
+    entries = select_manifest_entries(manifest_path, file_paths, prefix)
+    if any(is_compressed_entry(entry) for entry in entries):
+        raise ValueError("Files can't be restored server-side from a compressed tar. Use extract instead.")
+    client = boto3.client('s3', config=Config(retries={'max_attempts': attempts, 'mode': 'adaptive'}, max_pool_connections=max(threads, 10)))
+    results = {'restored': [], 'existing': []}
+    with tqdm(total=len(entries), disable=not progress_bar) as bar:
+        for result, url in threaded_queue(restore_file, ((client, tar_path, entry, overwrite, part_size) for entry in entries), threads):
+            results[result].append(url)
+            bar.update(1)
+    return results
+
+
+def restore_file(client, tar_path, entry, overwrite=False, part_size=RESTORE_PART_SIZE):
+    """
+        Copy the file for manifest row entry from tar_path to its original Bucket and Key, server-side, for
+        restore_files(). Returns ('restored' or 'existing', file URL).
+    """
+    bucket, key = entry['Bucket'], entry['Key']
+    url = 's3://%s/%s' % (bucket, key)
+    if not overwrite:
+        try:
+            client.head_object(Bucket=bucket, Key=key)
+            return 'existing', url
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+    size = int(entry['TarSize'])
+    if not size:
+        client.put_object(Bucket=bucket, Key=key, Body=b'')
+        return 'restored', url
+
+    parsed = parse_uri(member_tar_path(tar_path, entry))
+    copy_source = {'Bucket': parsed['bucket_id'], 'Key': parsed['key_id']}
+    data_offset = int(entry['TarDataOffset'])
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+    try:
+        parts = []
+        for part_number, start in enumerate(range(0, size, part_size), 1):
+            end = min(start + part_size, size)
+            response = client.upload_part_copy(
+                Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, CopySource=copy_source,
+                CopySourceRange='bytes=%s-%s' % (data_offset + start, data_offset + end - 1))
+            parts.append({'PartNumber': part_number, 'ETag': response['CopyPartResult']['ETag']})
+        client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+    except Exception:
+        client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    return 'restored', url
@@ -1,8 +1,83 @@
-# how much of a source file should we store in ram before spooling to disk?
-# ram usage will include this number of bytes * THREADS
+# how much of the tar to read at once when validating and extracting
 SPOOLED_FILE_SIZE = 10 * 2 ** 20
 
 # how many worker threads to fetch files in the background for archiving?
 # just has to be enough to load items from S3 faster than a single thread can tar them.
-# 8 seems to be enough
-THREADS = 8
\ No newline at end of file
+# this is the starting point; the number of fetches in flight then adapts between 1 and MAX_THREADS based on
+# fetch latency and how quickly the tar is being written.
+THREADS = 8
+
+# most fetches to run at once when archiving. prefixes of small objects, where request latency dominates, need many.
+MAX_THREADS = 64
+
+# approximate cap on the bytes of fetched objects held in ram at once when archiving
+MEMORY_BUDGET = 256 * 2 ** 20
+
+# objects up to this size are fetched for archiving into reusable in-memory buffers of this size;
+# larger objects are streamed into the tar as they are fetched. nothing is written to local disk.
+FETCH_BUFFER_SIZE = 2 ** 20
+
+# how many bytes of the tar should each range request cover when validating with multiple threads?
+VALIDATE_SEGMENT_SIZE = 256 * 2 ** 20
+
+# when validating headers only, tar headers closer together than this are fetched with one range request,
+# and the file data between them discarded
+HEADERS_MAX_GAP = 64 * 2 ** 10
+
+# largest byte range to fetch with one request when validating headers only
+HEADERS_MAX_RANGE_SIZE = 2 ** 20
+
+# when validating a random sample of each archive's files, how likely should the sample be to catch corruption?
+SAMPLE_CONFIDENCE = 0.95
+
+# when validating a random sample of each archive's files, the sample is sized to catch, with SAMPLE_CONFIDENCE
+# probability, an archive with at least this fraction of its files corrupt
+SAMPLE_DEFECT_RATE = 0.01
+
+# how many manifest rows should each entry in the manifest's sparse index cover?
+# extract reads one block of this many rows to find a file.
+MANIFEST_INDEX_BLOCK_SIZE = 1000
+
+# how many manifest rows to write to each row group of Parquet manifests?
+# extract reads one row group to find a file.
+MANIFEST_ROW_GROUP_SIZE = 100000
+
+# when extracting many files, byte ranges in the tar closer together than this are fetched with one range request,
+# and the skipped bytes between them discarded
+EXTRACT_MAX_GAP = 2 * 2 ** 20
+
+# largest byte range to fetch with one request when extracting many files
+EXTRACT_MAX_RANGE_SIZE = 256 * 2 ** 20
+
+# how many manifest rows to sort in memory at once when archiving?
+# larger archives are sorted in chunks of this many rows on disk and then merged.
+MANIFEST_SORT_CHUNK_SIZE = 100000
+
+# size of each part when uploading the tar with s3mothball's own multipart writer.
+# S3 allows 10,000 parts per upload, so this also caps tar size at about 10,000 * PART_SIZE.
+PART_SIZE = 64 * 2 ** 20
+
+# S3 rejects multipart uploads with parts smaller than this, other than the last,
+# but only when the upload is completed, after the whole tar has been sent
+MIN_PART_SIZE = 5 * 2 ** 20
+
+# how many tar parts to upload at once. RAM usage includes about (UPLOAD_THREADS + 1) * PART_SIZE bytes.
+UPLOAD_THREADS = 4
+
+# objects larger than FETCH_BUFFER_SIZE are fetched for archiving with concurrent range requests of this size,
+# so one large object doesn't stall the tar on a single connection
+RANGED_GET_SIZE = 16 * 2 ** 20
+
+# how many range requests to run at once for each large object
+RANGED_GET_THREADS = 8
+
+# when restoring files to S3, each file is copied out of the tar server-side in parts of at most this many bytes.
+# S3 allows copy parts from 5MB to 5GB.
+RESTORE_PART_SIZE = 2 ** 30
+
+# compressed (.tar.gz) archives are written as independent gzip frames of at least this many uncompressed bytes,
+# cut where a new tar member starts. extracting a file decompresses only the frames that hold it.
+COMPRESS_FRAME_SIZE = 2 ** 20
+
+# how many gzip frames to compress at once when writing compressed archives
+COMPRESS_THREADS = 4
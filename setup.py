@@ -18,12 +18,16 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3',
+    python_requires='>=3.9',
     install_requires=[
         "boto3",
         "smart-open>=1.10.0",
         "tqdm",
     ],
+    extras_require={
+        'inventory': ["pyarrow"],
+        'parquet': ["pyarrow"],
+    },
     tests_require=[
         "pytest",
         "moto",
@@ -1,4 +1,8 @@
+import csv
+import gzip
+import json
 from datetime import timezone
+from urllib.parse import quote_plus
 
 from moto.core.utils import str_to_rfc_1123_datetime
 
@@ -13,4 +17,23 @@ def write_file(s3, bucket, key, contents):
         'etag': headers['etag'].strip('"'),
         'modified': str_to_rfc_1123_datetime(headers['last-modified']).replace(tzinfo=timezone.utc),
         'size': headers['content-length'],
-    }
\ No newline at end of file
+    }
+
+def write_inventory(inventory_dir, rows, fieldnames=('Bucket', 'Key', 'VersionId', 'IsLatest', 'IsDeleteMarker', 'Size', 'ETag')):
+    """ Write rows as a local CSV S3 Inventory report under inventory_dir, and return the path of its manifest.json. """
+    data_path = inventory_dir / 'source' / 'all' / 'data' / 'part-0.csv.gz'
+    data_path.parent.mkdir(parents=True)
+    with gzip.open(data_path, 'wt', newline='') as f:
+        writer = csv.writer(f)
+        for row in rows:
+            writer.writerow([quote_plus(row[c]) if c == 'Key' else row[c] for c in fieldnames])
+    manifest_path = inventory_dir / 'source' / 'all' / '2020-01-01T00-00Z' / 'manifest.json'
+    manifest_path.parent.mkdir(parents=True)
+    manifest_path.write_text(json.dumps({
+        'sourceBucket': 'source',
+        'destinationBucket': 'arn:aws:s3:::inventory',
+        'fileFormat': 'CSV',
+        'fileSchema': ', '.join(fieldnames),
+        'files': [{'key': 'source/all/data/part-0.csv.gz'}],
+    }))
+    return str(manifest_path)
@@ -1,11 +1,48 @@
 import csv
+import hashlib
+import io
+import json
+import os
 import tarfile
+import threading
+from time import sleep
 
 import pytest
+from botocore.exceptions import ClientError
 from smart_open import open
 
-from s3mothball.helpers import write_dicts_to_csv, read_dicts_from_csv, list_objects
-from tests.helpers import write_file
+from smart_open.s3 import parse_uri
+
+from s3mothball.helpers import write_dicts_to_csv, read_dicts_from_csv, list_objects, manifest_index_path, exists
+from tests.helpers import write_file, write_inventory
+
+
+def test_threaded_queue_adaptive():
+    from s3mothball.helpers import threaded_queue
+
+    running = []
+    max_running = []
+    lock = threading.Lock()
+    def slow_func(i):
+        with lock:
+            running.append(i)
+            max_running.append(len(running))
+        sleep(.01)
+        with lock:
+            running.remove(i)
+        return i
+
+    # slow calls and a fast consumer: concurrency rises above the starting point, up to max_threads
+    results = list(threaded_queue(slow_func, ((i,) for i in range(200)), threads=2, max_threads=16))
+    assert sorted(results) == list(range(200))
+    assert 2 < max(max_running) <= 16
+
+    # items held at once are capped by byte budget, counting items the consumer is holding
+    max_running.clear()
+    held = []
+    for i in threaded_queue(slow_func, ((i,) for i in range(20)), threads=8, byte_budget=25, item_size=lambda i: 10):
+        held.append(len(running) + 1)
+    assert max(held) <= 2 and max(max_running) <= 2
 
 
 def test_write_tar(s3, files, source_bucket, archive_url, manifest_path, tar_path, boto_calls):
@@ -17,11 +54,11 @@ def test_write_tar(s3, files, source_bucket, archive_url, manifest_path, tar_pat
 
     # no unnecessary boto calls
     assert boto_calls == {
-        'CompleteMultipartUpload': 2,
-        'CreateMultipartUpload': 2,
+        'CompleteMultipartUpload': 4,
+        'CreateMultipartUpload': 4,
         'GetObject': 4,
         'ListObjects': 1,
-        'UploadPart': 2
+        'UploadPart': 4
     }
 
     # check tar file
@@ -75,6 +112,559 @@ def test_write_tar_overwrite(s3, files, source_bucket, archive_url, manifest_pat
         write_tar(archive_url, manifest_path, tar_path, overwrite=True)
 
 
+def test_write_tar_sha256(s3, files, source_bucket, archive_url, manifest_path, tar_path, boto_calls):
+    from s3mothball.s3mothball import write_tar, validate_tar  # ensure mock is in place before importing functions to test
+
+    write_tar(archive_url, manifest_path, tar_path, sha256=True)
+    manifest = list(read_dicts_from_csv(manifest_path))
+    files_by_key = {f['key']: f for f in files}
+    assert [m['TarSHA256'] for m in manifest] == [hashlib.sha256(files_by_key[m['Key']]['contents']).hexdigest() for m in manifest]
+    validate_tar(manifest_path, tar_path)
+
+    # the SHA-256 is checked as well as the MD5
+    write_dicts_to_csv(manifest_path, [{**m, 'TarSHA256': 'foo'} for m in manifest])
+    with pytest.raises(ValueError, match=r"File hash mismatch"):
+        validate_tar(manifest_path, tar_path)
+
+
+def inventory_rows(files, source_bucket):
+    rows = [{'Bucket': source_bucket, 'Key': f['key'], 'VersionId': '', 'IsLatest': 'true', 'IsDeleteMarker': 'false',
+             'Size': str(f['size']), 'ETag': f['etag']} for f in files]
+    return rows + [
+        {**rows[0], 'Key': 'other_folder/file.txt'},
+        {**rows[0], 'Key': 'folders/some_folder/old version.txt', 'IsLatest': 'false'},
+        {**rows[0], 'Key': 'folders/some_folder/deleted.txt', 'IsDeleteMarker': 'true'},
+    ]
+
+
+def test_write_tar_incremental(s3, files, source_bucket, dest_bucket, archive_url, manifest_path, tar_path, monkeypatch):
+    from s3mothball import s3mothball
+    from s3mothball.s3mothball import write_tar, validate_tar  # ensure mock is in place before importing functions to test
+
+    write_tar(archive_url, manifest_path, tar_path)
+    real_load_object = s3mothball.load_object
+    loaded_keys = []
+    def logging_load_object(obj, *args):
+        loaded_keys.append(obj.key)
+        return real_load_object(obj, *args)
+    monkeypatch.setattr(s3mothball, 'load_object', logging_load_object)
+
+    # only new and changed objects are fetched and archived
+    write_file(s3, source_bucket, files[1]['key'], 'changed contents')
+    write_file(s3, source_bucket, 'folders/some_folder/file3.txt', 'contents3')
+    delta_manifest_path = 's3://%s/manifests/folders/some_folder.2.tar.csv' % dest_bucket
+    delta_tar_path = 's3://%s/files/folders/some_folder.2.tar' % dest_bucket
+    write_tar(archive_url, delta_manifest_path, delta_tar_path, previous_manifests=[manifest_path])
+    assert sorted(loaded_keys) == [files[1]['key'], 'folders/some_folder/file3.txt']
+    assert [row['Key'] for row in read_dicts_from_csv(delta_manifest_path)] == [files[1]['key'], 'folders/some_folder/file3.txt']
+    validate_tar(delta_manifest_path, delta_tar_path)
+
+    # nothing has changed since the chain of manifests
+    with pytest.raises(IOError, match=r'No new or changed objects'):
+        write_tar(archive_url, 's3://%s/empty.tar.csv' % dest_bucket, 's3://%s/empty.tar' % dest_bucket,
+                  previous_manifests=[manifest_path, delta_manifest_path])
+
+
+def test_write_tar_dedup(s3, files, source_bucket, archive_url, manifest_path, tar_path, tmp_path):
+    from s3mothball.s3mothball import write_tar, validate_tar, open_archived_file, extract_files  # ensure mock is in place before importing functions to test
+
+    files += [write_file(s3, source_bucket, 'folders/some_folder/file3.txt', 'contents1')]
+    write_tar(archive_url, manifest_path, tar_path, dedup=True)
+    rows = {row['Key']: row for row in read_dicts_from_csv(manifest_path)}
+    # whichever copy was fetched first is stored in full
+    link_row, target_row = sorted((rows[files[0]['key']], rows[files[2]['key']]), key=lambda row: not row['TarLink'])
+    assert link_row['TarLink'] == target_row['Key'] and not target_row['TarLink'] and not rows[files[1]['key']]['TarLink']
+    assert link_row['TarDataOffset'] == target_row['TarDataOffset'] and link_row['TarSize'] == target_row['TarSize']
+    with open(tar_path, 'rb') as f:
+        tar = tarfile.open(fileobj=f, mode='r|')
+        members = {member.name: member for member in tar}
+    link = members[link_row['Key']]
+    assert link.islnk() and link.linkname == target_row['Key'] and link.offset == int(link_row['TarOffset'])
+
+    for threads in (1, 2):
+        validate_tar(manifest_path, tar_path, threads=threads, segment_size=1)
+    with open_archived_file(manifest_path, tar_path, 's3://%s/%s' % (source_bucket, files[2]['key'])) as f:
+        assert f.read() == b'contents1'
+    extract_files(manifest_path, tar_path, str(tmp_path), prefix=archive_url)
+    for f in files:
+        assert (tmp_path / f['key']).read_bytes() == f['contents']
+
+    # a link whose target doesn't match is invalid
+    link_row['TarMD5'] = rows[files[1]['key']]['TarMD5']
+    write_dicts_to_csv(manifest_path, rows.values())
+    with pytest.raises(ValueError, match=r'link mismatch'):
+        validate_tar(manifest_path, tar_path)
+
+
+def test_write_tar_ordered(s3, files, source_bucket, archive_url, manifest_path, tar_path, monkeypatch):
+    from s3mothball import s3mothball
+    from s3mothball.s3mothball import write_tar, validate_tar  # ensure mock is in place before importing functions to test
+
+    # later keys are fetched faster than earlier ones
+    files += [write_file(s3, source_bucket, 'folders/some_folder/file%s.txt' % i, 'contents%s' % i) for i in range(3, 9)]
+    real_load_object = s3mothball.load_object
+    def slow_load_object(obj, *args):
+        sleep(.05 if obj.key.endswith('file.txt') else 0)
+        return real_load_object(obj, *args)
+    monkeypatch.setattr(s3mothball, 'load_object', slow_load_object)
+    monkeypatch.setattr(s3mothball, 'sort_csv', None)  # manifest is written without sorting
+
+    write_tar(archive_url, manifest_path, tar_path, ordered=True)
+    rows = list(read_dicts_from_csv(manifest_path))
+    assert [row['Key'] for row in rows] == sorted(f['key'] for f in files)
+    assert [int(row['TarOffset']) for row in rows] == sorted(int(row['TarOffset']) for row in rows)
+    validate_tar(manifest_path, tar_path)
+
+
+def test_write_tar_compressed(s3, files, source_bucket, dest_bucket, archive_url, tmp_path):
+    import gzip
+    from s3mothball.s3mothball import write_tar, validate_tar, open_archived_file, extract_files  # ensure mock is in place before importing functions to test
+
+    files += [write_file(s3, source_bucket, 'folders/some_folder/file%s.txt' % i, 'contents%s' % i * 200) for i in range(3, 9)]
+    files += [write_file(s3, source_bucket, 'folders/some_folder/file9.txt', 'contents3' * 200)]  # stored as a hard link
+    manifest_path = 's3://%s/manifests/some_folder.tar.csv' % dest_bucket
+    tar_path = 's3://%s/files/some_folder.tar.gz' % dest_bucket
+    write_tar(archive_url, manifest_path, tar_path, frame_size=2048, compress_threads=2, dedup=True)
+
+    # the archive is an ordinary .tar.gz made of several gzip frames
+    with open(tar_path, 'rb', ignore_ext=True) as f:
+        compressed = f.read()
+    with tarfile.open(fileobj=gzip.GzipFile(fileobj=io.BytesIO(compressed)), mode='r|') as tar:
+        assert sorted(member.name for member in tar) == sorted(f['key'] for f in files)
+    rows = list(read_dicts_from_csv(manifest_path))
+    assert len(set(row['TarCompressedOffset'] for row in rows)) > 1 and any(row['TarLink'] for row in rows)
+    assert sum(int(row['TarSize']) for row in rows) > len(compressed)
+
+    for threads in (1, 2):
+        validate_tar(manifest_path, tar_path, threads=threads, segment_size=1)
+    for f in files:
+        with open_archived_file(manifest_path, tar_path, 's3://%s/%s' % (source_bucket, f['key'])) as archived:
+            assert archived.read() == f['contents']
+    extract_files(manifest_path, tar_path, str(tmp_path), prefix=archive_url, max_gap=0)
+    for f in files:
+        assert (tmp_path / f['key']).read_bytes() == f['contents']
+
+
+def test_parquet_manifest(tmp_path):
+    pytest.importorskip('pyarrow')
+    from array import array
+    from s3mothball.helpers import write_manifest, write_dicts_to_parquet, read_manifest_columns, read_manifest_rows, \
+        find_parquet_manifest_entry
+
+    manifest_path = str(tmp_path / 'manifest.parquet')
+    write_manifest(manifest_path, [{'Key': 'a', 'TarOffset': '0', 'TarFrameOffset': ''}, {'Key': 'b', 'TarOffset': '1024', 'TarFrameOffset': ''}])
+    columns = read_manifest_columns(manifest_path)
+    assert columns == {'Key': ['a', 'b'], 'TarOffset': array('q', [0, 1024]), 'TarFrameOffset': [None, None]}
+    assert list(read_manifest_rows(manifest_path)) == [
+        {'Key': 'a', 'TarOffset': 0, 'TarFrameOffset': None}, {'Key': 'b', 'TarOffset': 1024, 'TarFrameOffset': None}]
+
+    # typed columns span row groups
+    write_dicts_to_parquet(manifest_path, [{'Bucket': 'b', 'Key': k, 'TarSize': i} for i, k in enumerate('abcde')], row_group_size=2)
+    assert read_manifest_columns(manifest_path)['TarSize'] == array('q', range(5))
+    assert find_parquet_manifest_entry(manifest_path, 'b', 'd')['TarSize'] == 3
+    assert find_parquet_manifest_entry(manifest_path, 'b', 'f') is None
+
+
+def test_write_tar_parquet(s3, files, source_bucket, dest_bucket, archive_url, tar_path, tmp_path):
+    pytest.importorskip('pyarrow')
+    from s3mothball.s3mothball import write_tar, validate_tar, open_archived_file, extract_files, delete_files, \
+        convert_manifest, sample_tars  # ensure mock is in place before importing functions to test
+    from s3mothball.helpers import read_manifest_rows
+
+    files += [write_file(s3, source_bucket, 'folders/some_folder/file%s.txt' % i, 'contents%s' % i * 200) for i in range(3, 9)]
+    files += [write_file(s3, source_bucket, 'folders/some_folder/file9.txt', 'contents3' * 200)]  # stored as a hard link
+    manifest_path = 's3://%s/manifests/folders/some_folder.tar.parquet' % dest_bucket
+    write_tar(archive_url, manifest_path, tar_path, dedup=True)
+    assert not exists(manifest_path + '.index.csv')
+
+    # offsets and sizes are loaded as ints
+    rows = list(read_manifest_rows(manifest_path))
+    assert [row['Key'] for row in rows] == sorted(f['key'] for f in files)
+    assert all(isinstance(row['TarOffset'], int) and isinstance(row['TarSize'], int) for row in rows)
+    assert any(row['TarLink'] for row in rows)
+
+    # validate, extract, sample and delete read Parquet manifests
+    for threads in (1, 2):
+        validate_tar(manifest_path, tar_path, threads=threads)
+    validate_tar(manifest_path, tar_path, headers_only=True)
+    validate_tar(manifest_path, tar_path, quick=True)
+    for f in files:
+        with open_archived_file(manifest_path, tar_path, 's3://%s/%s' % (source_bucket, f['key'])) as archived:
+            assert archived.read() == f['contents']
+    extract_files(manifest_path, tar_path, str(tmp_path / 'out'), prefix=archive_url)
+    for f in files:
+        assert (tmp_path / 'out' / f['key']).read_bytes() == f['contents']
+    report, = sample_tars([(manifest_path, tar_path)], confidence=1)
+    assert report['SampledFiles'] == len(files) - 1 and not report['Failures']
+    buckets = delete_files([manifest_path], dry_run=True)
+    assert sorted(buckets[source_bucket]['keys']) == sorted(f['key'] for f in files)
+
+    # export as csv, with the tar checksums
+    csv_path = str(tmp_path / 'some_folder.tar.csv')
+    convert_manifest(manifest_path, csv_path)
+    assert list(read_dicts_from_csv(csv_path)) == [{k: '' if v is None else str(v) for k, v in row.items()} for row in rows]
+    assert exists(csv_path + '.index.csv')
+    validate_tar(csv_path, tar_path, quick=True)
+    validate_tar(csv_path, tar_path)
+
+    # compressed tars, whose first file is at TarCompressedOffset 0
+    gz_manifest_path = 's3://%s/manifests/some_folder.tar.gz.parquet' % dest_bucket
+    gz_tar_path = 's3://%s/files/some_folder.tar.gz' % dest_bucket
+    write_tar(archive_url, gz_manifest_path, gz_tar_path, frame_size=2048, dedup=True)
+    for threads in (1, 2):
+        validate_tar(gz_manifest_path, gz_tar_path, threads=threads, segment_size=1)
+    extract_files(gz_manifest_path, gz_tar_path, str(tmp_path / 'gz_out'), prefix=archive_url, max_gap=0)
+    for f in files:
+        assert (tmp_path / 'gz_out' / f['key']).read_bytes() == f['contents']
+
+
+def test_write_tar_inventory(s3, files, source_bucket, archive_url, manifest_path, tar_path, boto_calls, tmp_path):
+    from s3mothball.s3mothball import write_tar, validate_tar  # ensure mock is in place before importing functions to test
+
+    files.append(write_file(s3, source_bucket, 'folders/some_folder/with space+plus.txt', 'contents3'))
+    inventory_path = write_inventory(tmp_path, inventory_rows(files, source_bucket))
+    boto_calls.clear()
+    write_tar(archive_url, manifest_path, tar_path, inventory=inventory_path)
+
+    # objects are found in the inventory without listing
+    assert 'ListObjects' not in boto_calls
+    assert [m['Key'] for m in read_dicts_from_csv(manifest_path)] == sorted(f['key'] for f in files)
+    validate_tar(manifest_path, tar_path)
+
+
+def test_write_tar_inventory_errors(s3, files, source_bucket, archive_url, manifest_path, tar_path, tmp_path):
+    from s3mothball.s3mothball import write_tar  # ensure mock is in place before importing functions to test
+
+    # reports without the optional Size and ETag fields can't be archived from
+    inventory_path = write_inventory(tmp_path / 'no_size', inventory_rows(files, source_bucket), fieldnames=('Bucket', 'Key', 'ETag'))
+    with pytest.raises(ValueError, match=r"must include the Size and ETag fields"):
+        write_tar(archive_url, manifest_path, tar_path, inventory=inventory_path)
+
+    # an object deleted since the report was taken fails the archive, and nothing is written
+    inventory_path = write_inventory(tmp_path / 'stale', inventory_rows(files, source_bucket))
+    s3.delete_object(Bucket=source_bucket, Key=files[0]['key'])
+    with pytest.raises(ClientError, match=r"NoSuchKey"):
+        write_tar(archive_url, manifest_path, tar_path, inventory=inventory_path)
+    assert not exists(manifest_path) and not exists(tar_path)
+
+
+def test_write_tar_inventory_incremental(s3, files, source_bucket, dest_bucket, archive_url, manifest_path, tar_path, tmp_path):
+    from s3mothball.s3mothball import write_tar  # ensure mock is in place before importing functions to test
+
+    s3.put_bucket_versioning(Bucket=source_bucket, VersioningConfiguration={'Status': 'Enabled'})
+    files = [write_file(s3, source_bucket, f['key'], f['contents'].decode()) for f in files]
+    write_tar(archive_url, manifest_path, tar_path)
+    versions = {row['Key']: row['VersionId'] for row in read_dicts_from_csv(manifest_path)}
+    assert all(versions.values())
+
+    # rewriting the same contents keeps the ETag but makes a new version, which the inventory records
+    rewritten = write_file(s3, source_bucket, files[0]['key'], files[0]['contents'].decode())
+    assert rewritten['etag'] == files[0]['etag']
+    rows = inventory_rows(files, source_bucket)
+    rows[0]['VersionId'] = s3.head_object(Bucket=source_bucket, Key=files[0]['key'])['VersionId']
+    rows[1]['VersionId'] = versions[files[1]['key']]
+    assert rows[0]['VersionId'] != versions[files[0]['key']]
+    inventory_path = write_inventory(tmp_path, rows)
+    delta_manifest_path = 's3://%s/manifests/folders/some_folder.2.tar.csv' % dest_bucket
+    write_tar(archive_url, delta_manifest_path, 's3://%s/files/folders/some_folder.2.tar' % dest_bucket,
+              inventory=inventory_path, previous_manifests=[manifest_path])
+    assert [row['Key'] for row in read_dicts_from_csv(delta_manifest_path)] == [files[0]['key']]
+
+
+def test_write_tar_inventory_parquet(s3, files, source_bucket, archive_url, manifest_path, tar_path, tmp_path, monkeypatch):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    from s3mothball import helpers
+    from s3mothball.s3mothball import write_tar  # ensure mock is in place before importing functions to test
+
+    monkeypatch.setattr(helpers, 'pyarrow_orc', None)  # Parquet reports don't need ORC support
+
+    columns = {'bucket': 'Bucket', 'key': 'Key', 'size': 'Size', 'e_tag': 'ETag', 'is_latest': 'IsLatest'}
+    rows = inventory_rows(files, source_bucket)[:3]
+    table = pa.table({name: [r[column] for r in rows] for name, column in columns.items()})
+    table = table.set_column(2, 'size', pa.array([int(r['Size']) for r in rows]))
+    table = table.set_column(4, 'is_latest', pa.array([r['IsLatest'] == 'true' for r in rows]))
+    (tmp_path / 'data').mkdir()
+    pyarrow.parquet.write_table(table, str(tmp_path / 'data' / 'part-0.parquet'))
+    (tmp_path / 'manifest.json').write_text(json.dumps({
+        'fileFormat': 'Parquet',
+        'fileSchema': 'message s3.inventory {}',
+        'files': [{'key': 'data/part-0.parquet'}],
+    }))
+
+    write_tar(archive_url, manifest_path, tar_path, inventory=str(tmp_path / 'manifest.json'))
+    assert [m['Key'] for m in read_dicts_from_csv(manifest_path)] == sorted(f['key'] for f in files)
+
+
+def test_split_inventory(s3, files, source_bucket, tmp_path):
+    from s3mothball.s3mothball import split_inventory  # ensure mock is in place before importing functions to test
+
+    inventory_path = write_inventory(tmp_path / 'inventory', inventory_rows(files, source_bucket))
+    urls = ['s3://source/folders/some_folder/', 's3://source/other_folder', 's3://source/', 's3://source/missing/']
+    paths = split_inventory(inventory_path, urls, str(tmp_path / 'out'), buffer_rows=2)
+    assert paths == {
+        's3://source/folders/some_folder/': str(tmp_path / 'out/source/folders/some_folder/inventory.csv'),
+        's3://source/other_folder': str(tmp_path / 'out/source/other_folder/inventory.csv'),
+        's3://source/': str(tmp_path / 'out/source/inventory.csv'),
+        's3://source/missing/': str(tmp_path / 'out/source/missing/inventory.csv'),
+    }
+    keys = lambda url: [row['Key'] for row in read_dicts_from_csv(paths[url])]
+    assert keys('s3://source/folders/some_folder/') == [f['key'] for f in files] + [
+        'folders/some_folder/old version.txt', 'folders/some_folder/deleted.txt']
+    assert keys('s3://source/other_folder') == ['other_folder/file.txt']
+    assert len(keys('s3://source/')) == len(files) + 3
+    assert keys('s3://source/missing/') == []
+
+
+@pytest.mark.parametrize('shard_options', [{'shard_members': 1}, {'shard_size': 1, 'writer_threads': 2}])
+def test_write_tar_sharded(s3, files, source_bucket, archive_url, manifest_path, tar_path, boto_calls, tmp_path, shard_options):
+    from s3mothball.s3mothball import write_tar, validate_tar, open_archived_file, extract_files  # ensure mock is in place before importing functions to test
+
+    files.append(write_file(s3, source_bucket, 'folders/some_folder/file3.txt', 'contents3'))
+    write_tar(archive_url, manifest_path, tar_path, **shard_options)
+
+    # one member per shard, named in the manifest
+    manifest = list(read_dicts_from_csv(manifest_path))
+    shard_names = ['some_folder.%05d.tar' % i for i in range(3)]
+    assert sorted(m['TarShard'] for m in manifest) == shard_names
+    assert not exists(tar_path)
+    for entry in manifest:
+        with open(tar_path.rsplit('/', 1)[0] + '/' + entry['TarShard'], 'rb', ignore_ext=True) as f:
+            assert [m.name for m in tarfile.TarFile.open(fileobj=f, mode='r|')] == [entry['Key']]
+
+    # validate and extract read the shard set
+    validate_tar(manifest_path, tar_path)
+    validate_tar(manifest_path, tar_path, threads=4)
+    for f in files:
+        with open_archived_file(manifest_path, tar_path, 's3://%s/%s' % (source_bucket, f['key'])) as archived:
+            assert archived.read() == f['contents']
+    out_dir = str(tmp_path / 'out')
+    assert len(extract_files(manifest_path, tar_path, out_dir, prefix='s3://%s/folders/' % source_bucket)) == 3
+
+    # a member missing from one shard's manifest rows is detected
+    write_dicts_to_csv(manifest_path, [m for m in manifest if m['TarShard'] != shard_names[1]] +
+                       [{**m, 'TarShard': shard_names[0]} for m in manifest if m['TarShard'] == shard_names[1]])
+    with pytest.raises(ValueError):
+        validate_tar(manifest_path, tar_path)
+
+
+def test_write_tar_sharded_writer_error(s3, files, source_bucket, archive_url, manifest_path, tar_path, monkeypatch):
+    from s3mothball import s3mothball  # ensure mock is in place before importing functions to test
+
+    def failing_tar_object(*args, **kwargs):
+        raise IOError("Simulated write error")
+    monkeypatch.setattr(s3mothball, 'tar_object', failing_tar_object)
+    with pytest.raises(IOError, match=r"Simulated write error"):
+        s3mothball.write_tar(archive_url, manifest_path, tar_path, shard_members=1, writer_threads=2)
+    assert not exists(manifest_path)
+
+
+def test_write_tar_sharded_small_budget(s3, files, source_bucket, archive_url, manifest_path, tar_path, monkeypatch):
+    from s3mothball import s3mothball  # ensure mock is in place before importing functions to test
+
+    # more objects than the two pooled buffers a 2MB budget allows
+    files += [write_file(s3, source_bucket, 'folders/some_folder/file%s.txt' % i, 'contents%s' % i) for i in range(3, 12)]
+    options = dict(shard_members=1, writer_threads=2, memory_budget=2 * 2 ** 20)
+    s3mothball.write_tar(archive_url, manifest_path, tar_path, **options)
+    assert len(list(read_dicts_from_csv(manifest_path))) == len(files)
+
+    # a failing writer releases the buffers of queued objects, so fetches waiting on them finish and write_tar raises
+    def failing_tar_object(*args, **kwargs):
+        raise IOError("Simulated write error")
+    monkeypatch.setattr(s3mothball, 'tar_object', failing_tar_object)
+    with pytest.raises(IOError, match=r"Simulated write error"):
+        s3mothball.write_tar(archive_url, manifest_path, tar_path, overwrite=True, **options)
+
+
+def test_write_tar_compressed_error(s3, files, source_bucket, dest_bucket, archive_url, manifest_path, monkeypatch):
+    from s3mothball import s3mothball  # ensure mock is in place before importing functions to test
+
+    real_tar_object = s3mothball.tar_object
+    written = []
+    def failing_tar_object(*args, **kwargs):
+        if written:
+            raise IOError("Simulated write error")
+        written.append(real_tar_object(*args, **kwargs))
+        return written[-1]
+    monkeypatch.setattr(s3mothball, 'tar_object', failing_tar_object)
+    tar_path = 's3://%s/files/some_folder.tar.gz' % dest_bucket
+    with pytest.raises(IOError, match=r"Simulated write error"):
+        s3mothball.write_tar(archive_url, manifest_path, tar_path, frame_size=1)
+    assert written
+    assert not exists(tar_path) and not exists(manifest_path)
+    assert not s3.list_multipart_uploads(Bucket=dest_bucket).get('Uploads')
+
+
+def test_write_tar_resume(s3, files, source_bucket, archive_url, manifest_path, tar_path, boto_calls, tmp_path, monkeypatch):
+    import moto.s3.models
+    from s3mothball import s3mothball
+    from s3mothball.s3mothball import write_tar, validate_tar  # ensure mock is in place before importing functions to test
+
+    monkeypatch.setattr(moto.s3.models, 'UPLOAD_PART_MIN_SIZE', 1)  # allow one small part per member
+    files += [write_file(s3, source_bucket, 'folders/some_folder/file%s.txt' % i, 'contents%s' % i) for i in range(3, 6)]
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    rows_path = checkpoint_path + '.rows.csv'
+
+    # crash when saving the second checkpoint
+    real_write_json_atomic = s3mothball.write_json_atomic
+    archived_keys = set()
+    def crashing_write_json_atomic(path, data):
+        if os.path.exists(path):
+            raise IOError("Simulated crash")
+        real_write_json_atomic(path, data)
+        archived_keys.update(row['Key'] for row in read_dicts_from_csv(rows_path))
+    monkeypatch.setattr(s3mothball, 'write_json_atomic', crashing_write_json_atomic)
+    with pytest.raises(IOError, match=r"Simulated crash"):
+        write_tar(archive_url, manifest_path, tar_path, checkpoint_path=checkpoint_path, part_size=1024)
+    assert len(archived_keys) == 1
+    assert not exists(manifest_path)
+
+    # resume, continuing the same upload and only fetching objects not yet archived
+    monkeypatch.setattr(s3mothball, 'write_json_atomic', real_write_json_atomic)
+    real_load_object = s3mothball.load_object
+    loaded_keys = []
+    def logging_load_object(obj, *args):
+        loaded_keys.append(obj.key)
+        return real_load_object(obj, *args)
+    monkeypatch.setattr(s3mothball, 'load_object', logging_load_object)
+    boto_calls.clear()
+    write_tar(archive_url, manifest_path, tar_path, checkpoint_path=checkpoint_path, part_size=1024)
+    assert set(loaded_keys) == set(f['key'] for f in files) - archived_keys
+    assert boto_calls['CreateMultipartUpload'] == 3  # manifest, index, and checksums only
+    assert not os.path.exists(checkpoint_path) and not os.path.exists(rows_path)
+
+    validate_tar(manifest_path, tar_path)
+    assert [row['Key'] for row in read_dicts_from_csv(manifest_path)] == sorted(f['key'] for f in files)
+
+
+def test_run_batch(s3, files, source_bucket, dest_bucket, archive_url, manifest_path, tar_path, tmp_path, monkeypatch):
+    from s3mothball import s3mothball  # ensure mock is in place before importing functions to test
+
+    jobs_path = str(tmp_path / 'jobs.csv')
+    state_path = str(tmp_path / 'state.db')
+    empty_url = 's3://%s/folders/empty_folder/' % source_bucket
+    write_dicts_to_csv(jobs_path, [
+        {'archive_url': archive_url, 'manifest_path': manifest_path, 'tar_path': tar_path},
+        {'archive_url': empty_url, 'manifest_path': 's3://%s/empty.tar.csv' % dest_bucket, 'tar_path': 's3://%s/empty.tar' % dest_bucket},
+    ])
+    real_write_tar = s3mothball.write_tar
+    archived_urls = []
+    def logging_write_tar(archive_url, *args, **kwargs):
+        archived_urls.append(archive_url)
+        return real_write_tar(archive_url, *args, **kwargs)
+    monkeypatch.setattr(s3mothball, 'write_tar', logging_write_tar)
+
+    # the empty prefix fails, and is recorded for retry
+    counts = s3mothball.run_batch(jobs_path, state_path, processes=0, delete=True)
+    assert counts == {'pending': 1, 'archived': 0, 'validated': 0, 'deleted': 1, 'failed': 1}
+    assert not list(list_objects(archive_url))
+
+    # rerunning only retries the failed job
+    write_file(s3, source_bucket, 'folders/empty_folder/file.txt', 'contents')
+    archived_urls.clear()
+    counts = s3mothball.run_batch(jobs_path, state_path, processes=0, delete=True)
+    assert counts == {'pending': 0, 'archived': 0, 'validated': 0, 'deleted': 2, 'failed': 0}
+    assert archived_urls == [empty_url]
+
+
+def test_run_batch_delete_without_validate(s3, files, source_bucket, archive_url, manifest_path, tar_path, tmp_path):
+    from s3mothball.s3mothball import run_batch  # ensure mock is in place before importing functions to test
+
+    jobs_path = str(tmp_path / 'jobs.csv')
+    write_dicts_to_csv(jobs_path, [{'archive_url': archive_url, 'manifest_path': manifest_path, 'tar_path': tar_path}])
+    counts = run_batch(jobs_path, str(tmp_path / 'state.db'), processes=0, validate=False, delete=True)
+    assert counts == {'pending': 0, 'archived': 0, 'validated': 0, 'deleted': 1, 'failed': 0}
+    assert not list(list_objects(archive_url))
+
+
+def test_list_objects_sharded(s3, source_bucket, boto_calls):
+    keys = ['a/direct%s.txt' % i for i in range(3)] + ['a/b%s/c/%s.txt' % (i, j) for i in range(5) for j in range(3)] + \
+           ['a/only/deeper/x%s.txt' % i for i in range(4)] + ['a/b2.txt', 'a/b2/', 'other/z.txt']
+    for key in keys:
+        write_file(s3, source_bucket, key, 'contents')
+    expected = sorted(k for k in keys if k.startswith('a/'))
+
+    for threads, max_shards in ((2, None), (4, 2), (8, 100)):
+        boto_calls.clear()
+        listed = [o.key for o in list_objects('s3://%s/a/' % source_bucket, threads, max_shards, page_size=2)]
+        assert sorted(listed) == expected
+        assert list(boto_calls) == ['ListObjects']
+
+
+def test_load_object(s3, source_bucket, boto_calls):
+    from s3mothball.helpers import load_object, BufferPool  # ensure mock is in place before importing functions to test
+
+    contents = ''.join(str(i % 10) for i in range(100))
+    write_file(s3, source_bucket, 'big.txt', contents)
+    obj = next(iter(list_objects('s3://%s/' % source_bucket)))
+
+    # small objects are read into a pooled buffer, which is returned to the pool on close
+    pool = BufferPool(100, 1)
+    boto_calls.clear()
+    _, response, body = load_object(obj, pool)
+    assert body.read(60) == contents[:60].encode('utf8')
+    assert body.read() == contents[60:].encode('utf8')
+    body.close()
+    assert pool.allocated == 1 and pool.free.qsize() == 1
+    assert boto_calls == {'GetObject': 1}
+
+    # large objects are streamed with concurrent range requests
+    obj = next(iter(list_objects('s3://%s/' % source_bucket)))
+    boto_calls.clear()
+    _, response, body = load_object(obj, BufferPool(10, 1), ranged_get_size=30)
+    assert body.read(45) + body.read() == contents.encode('utf8')
+    body.close()
+    assert response['ContentLength'] == 100
+    assert boto_calls == {'GetObject': 4}
+
+
+def test_s3_multipart_writer(s3, dest_bucket, tar_path, boto_calls, monkeypatch):
+    import moto.s3.models
+    from s3mothball.helpers import S3MultipartWriter  # ensure mock is in place before importing functions to test
+
+    monkeypatch.setattr(moto.s3.models, 'UPLOAD_PART_MIN_SIZE', 1)  # allow small parts
+    contents = bytes(range(95))
+
+    # parts are uploaded concurrently and assembled in order
+    with S3MultipartWriter(tar_path, part_size=10, threads=4) as f:
+        for i in range(0, len(contents), 7):
+            f.write(contents[i:i+7])
+        assert f.tell() == len(contents)
+    assert boto_calls['UploadPart'] == 10
+    with open(tar_path, 'rb', ignore_ext=True) as f:
+        assert f.read() == contents
+
+    # failed writes abort the upload
+    with pytest.raises(ValueError):
+        with S3MultipartWriter(tar_path + '.failed', part_size=10, threads=4) as f:
+            f.write(contents)
+            raise ValueError
+    assert not exists(tar_path + '.failed')
+    assert not s3.list_multipart_uploads(Bucket=dest_bucket).get('Uploads')
+
+    # resumable uploads are only left open once there is a checkpoint to resume them from
+    with pytest.raises(ValueError):
+        with S3MultipartWriter(tar_path + '.failed', part_size=10, resumable=True) as f:
+            f.write(contents)
+            raise ValueError
+    assert not s3.list_multipart_uploads(Bucket=dest_bucket).get('Uploads')
+    with pytest.raises(ValueError):
+        with S3MultipartWriter(tar_path + '.failed', part_size=10, resumable=True) as f:
+            state = f.checkpoint()
+            f.write(contents)
+            raise ValueError
+    assert [u['UploadId'] for u in s3.list_multipart_uploads(Bucket=dest_bucket)['Uploads']] == [state['UploadId']]
+
+
+def test_part_size_minimum(archive_url, manifest_path, tar_path, capsys):
+    from s3mothball.commands import main
+
+    # parts below S3's 5 MiB minimum are rejected before anything is uploaded
+    with pytest.raises(SystemExit):
+        main(['archive', archive_url, manifest_path, tar_path, '--part-size-mb', '4'])
+    assert 'at least 5 MiB' in capsys.readouterr().err
+
+
 def test_write_tar_no_files(s3, source_bucket, archive_url, manifest_path, tar_path, boto_calls):
     from s3mothball.s3mothball import write_tar  # ensure mock is in place before importing functions to test
 
@@ -82,8 +672,13 @@ def test_write_tar_no_files(s3, source_bucket, archive_url, manifest_path, tar_p
         write_tar(archive_url, manifest_path, tar_path)
 
 
-def test_validate_tar(s3, files, source_bucket, archive_url, manifest_path, tar_path, boto_calls):
-    from s3mothball.s3mothball import write_tar, validate_tar  # ensure mock is in place before importing functions to test
+@pytest.mark.parametrize("threads", [1, 4])
+def test_validate_tar(s3, files, source_bucket, archive_url, manifest_path, tar_path, boto_calls, threads):
+    from s3mothball.s3mothball import write_tar, validate_tar as _validate_tar  # ensure mock is in place before importing functions to test
+
+    # one segment per member when validating in parallel
+    def validate_tar(manifest_path, tar_path):
+        return _validate_tar(manifest_path, tar_path, threads=threads, segment_size=1)
 
     # write tar
     strip_prefix = 'folders/'
@@ -95,8 +690,9 @@ def test_validate_tar(s3, files, source_bucket, archive_url, manifest_path, tar_
     validate_tar(manifest_path, tar_path)
 
     # no unnecessary boto calls
-    # this should be only 2 calls -- see https://github.com/RaRe-Technologies/smart_open/issues/494
-    assert boto_calls == {'GetObject': 4}
+    if threads == 1:
+        # this should be only 2 calls -- see https://github.com/RaRe-Technologies/smart_open/issues/494
+        assert boto_calls == {'GetObject': 4}
 
     # load contents
     manifest = list(read_dicts_from_csv(manifest_path))
@@ -129,8 +725,170 @@ def test_validate_tar(s3, files, source_bucket, archive_url, manifest_path, tar_
     with pytest.raises(tarfile.ReadError):
         validate_tar(manifest_path, tar_path)
 
+    # detect garbled header fields, even with a valid header checksum
+    write_dicts_to_csv(manifest_path, manifest)
+    header = bytearray(tar_contents[:tarfile.BLOCKSIZE])
+    header[124:136] = b'garbled size'
+    header[148:156] = b'%06o\0 ' % tarfile.calc_chksums(bytes(header[:148]) + b' ' * 8 + bytes(header[156:]))[0]
+    with open(tar_path, 'wb', ignore_ext=True) as f:
+        f.write(header + tar_contents[tarfile.BLOCKSIZE:])
+    with pytest.raises(tarfile.ReadError, match=r"Invalid tar header at offset 0"):
+        validate_tar(manifest_path, tar_path)
+
+
+def test_validate_tar_extended_headers(s3, source_bucket, archive_url, manifest_path, tar_path):
+    from s3mothball.s3mothball import write_tar, validate_tar  # ensure mock is in place before importing functions to test
+
+    # names that need PAX headers
+    write_file(s3, source_bucket, 'folders/some_folder/' + 'long' * 40 + '.txt', 'contents1')
+    write_file(s3, source_bucket, 'folders/some_folder/ünïcödé.txt', 'contents2')
+    write_tar(archive_url, manifest_path, tar_path)
+    for threads in (1, 2):
+        validate_tar(manifest_path, tar_path, threads=threads, segment_size=1)
+
+    # a truncated tar is missing its end-of-archive marker
+    with open(tar_path, 'rb', ignore_ext=True) as f:
+        tar_contents = f.read()
+    end = max(int(row['TarDataOffset']) + int(row['TarSize']) for row in read_dicts_from_csv(manifest_path))
+    with open(tar_path, 'wb', ignore_ext=True) as f:
+        f.write(tar_contents[:end + (-end % tarfile.BLOCKSIZE)])
+    with pytest.raises(ValueError, match=r"end-of-archive"):
+        validate_tar(manifest_path, tar_path)
+
+
+def test_validate_tar_quick(s3, files, source_bucket, archive_url, manifest_path, tar_path, boto_calls, tmp_path):
+    from s3mothball.s3mothball import write_tar, validate_tar  # ensure mock is in place before importing functions to test
+
+    write_tar(archive_url, manifest_path, tar_path)
+    with open(tar_path, 'rb', ignore_ext=True) as f:
+        tar_contents = f.read()
+    with open(manifest_path + '.checksums.json') as f:
+        checksums = json.load(f)
+    bucket, key = parse_uri(tar_path)['bucket_id'], parse_uri(tar_path)['key_id']
+    assert checksums == {'Tars': {'': {
+        'Size': len(tar_contents),
+        'SHA256': hashlib.sha256(tar_contents).hexdigest(),
+        'ETag': s3.head_object(Bucket=bucket, Key=key)['ETag'],
+    }}}
+
+    # a quick check is a single HeadObject for the tar
+    boto_calls.clear()
+    validate_tar(manifest_path, tar_path, quick=True)
+    assert boto_calls['HeadObject'] == 1 and set(boto_calls) == {'GetObject', 'HeadObject'}
+
+    # a changed byte in the padding after the end-of-archive marker is caught by the ETag, or by the stream hash
+    with open(tar_path, 'wb', ignore_ext=True) as f:
+        f.write(tar_contents[:-1] + b'x')
+    with pytest.raises(ValueError, match=r"ETag mismatch"):
+        validate_tar(manifest_path, tar_path, quick=True)
+    with pytest.raises(ValueError, match=r"Tar file hash mismatch"):
+        validate_tar(manifest_path, tar_path)
+    with pytest.raises(ValueError, match=r"ETag mismatch"):
+        validate_tar(manifest_path, tar_path, threads=2)
+
+    # local tars are hashed
+    local_manifest_path, local_tar_path = str(tmp_path / 'some_folder.tar.csv'), str(tmp_path / 'some_folder.tar')
+    write_tar(archive_url, local_manifest_path, local_tar_path)
+    validate_tar(local_manifest_path, local_tar_path, quick=True)
+    with io.open(local_tar_path, 'r+b') as f:
+        f.seek(-1, 2)
+        f.write(b'x')
+    with pytest.raises(ValueError, match=r"Tar file hash mismatch"):
+        validate_tar(local_manifest_path, local_tar_path, quick=True)
+
+    # manifests written without checksums can't be checked quickly
+    os.remove(local_manifest_path + '.checksums.json')
+    with pytest.raises(FileNotFoundError):
+        validate_tar(local_manifest_path, local_tar_path, quick=True)
+
+
+def test_validate_tar_headers_only(s3, files, source_bucket, archive_url, manifest_path, tar_path):
+    from s3mothball.s3mothball import write_tar, validate_tar  # ensure mock is in place before importing functions to test
+
+    files += [write_file(s3, source_bucket, 'folders/some_folder/' + 'long' * 40 + '.txt', 'contents1')]  # PAX header and a hard link
+    write_tar(archive_url, manifest_path, tar_path, dedup=True, ordered=True)  # ordered, so members are in a known order
+    manifest = list(read_dicts_from_csv(manifest_path))
+    for threads in (1, 4):
+        validate_tar(manifest_path, tar_path, threads=threads, headers_only=True)
+
+    # contents aren't checked
+    write_dicts_to_csv(manifest_path, [{**m, 'TarMD5': 'foo'} for m in manifest])
+    validate_tar(manifest_path, tar_path, headers_only=True)
+
+    # manifest missing a member
+    assert [m['Key'] for m in manifest] == ['folders/some_folder/file.txt', 'folders/some_folder/file2.txt', files[-1]['key']]
+    assert manifest[-1]['TarLink'] == 'folders/some_folder/file.txt'
+    write_dicts_to_csv(manifest_path, [manifest[0], manifest[2]])
+    with pytest.raises(ValueError, match=r"offset mismatch"):
+        validate_tar(manifest_path, tar_path, headers_only=True)
+
+    # manifest with wrong names
+    write_dicts_to_csv(manifest_path, [manifest[0], {**manifest[1], 'Key': manifest[1]['Key'] + 'abc'}, manifest[2]])
+    with pytest.raises(ValueError, match=r"Mismatched keys"):
+        validate_tar(manifest_path, tar_path, headers_only=True)
+
+    # tar with data after the end-of-archive marker
+    write_dicts_to_csv(manifest_path, manifest)
+    with open(tar_path, 'rb', ignore_ext=True) as f:
+        tar_contents = f.read()
+    with open(tar_path, 'wb', ignore_ext=True) as f:
+        f.write(tar_contents[:-1] + b'x')
+    with pytest.raises(ValueError, match=r"end-of-archive"):
+        validate_tar(manifest_path, tar_path, headers_only=True)
+
+    # truncated tar
+    with open(tar_path, 'wb', ignore_ext=True) as f:
+        f.write(tar_contents[:-len(tar_contents) // 2])
+    with pytest.raises((ValueError, tarfile.ReadError)):
+        validate_tar(manifest_path, tar_path, headers_only=True)
+
+
+def test_sample_tars(s3, files, source_bucket, dest_bucket, archive_url, manifest_path, tar_path):
+    from s3mothball.commands import main
+    from s3mothball.s3mothball import write_tar, sample_tars  # ensure mock is in place before importing functions to test
+
+    files += [write_file(s3, source_bucket, 'folders/some_folder/file%s.txt' % i, 'contents%s' % i * 100) for i in range(3, 9)]
+    write_tar(archive_url, manifest_path, tar_path)
+    compressed_manifest_path = 's3://%s/manifests/some_folder.tar.gz.csv' % dest_bucket
+    compressed_tar_path = 's3://%s/files/some_folder.tar.gz' % dest_bucket
+    write_tar(archive_url, compressed_manifest_path, compressed_tar_path, frame_size=1024)
+    jobs = [(manifest_path, tar_path), (compressed_manifest_path, compressed_tar_path)]
+
+    # with full confidence, every file is checked
+    reports = sample_tars(jobs, confidence=1, threads=4)
+    for (job_manifest_path, job_tar_path), report in zip(jobs, reports):
+        assert report == {
+            'ManifestPath': job_manifest_path, 'TarPath': job_tar_path, 'Files': len(files),
+            'Bytes': sum(len(f['contents']) for f in files), 'SampledFiles': len(files),
+            'SampledBytes': sum(len(f['contents']) for f in files), 'Confidence': 1.0, 'Failures': []}
 
-def test_delete_files(s3, files, source_bucket, archive_url, manifest_path, tar_path, boto_calls):
+    # otherwise the sample is sized by confidence and defect rate, and capped by the byte budget
+    report, = sample_tars(jobs[:1], confidence=.5, defect_rate=.5, seed=1)
+    assert report['SampledFiles'] == 1 and report['Confidence'] == .5
+    for seed in range(5):
+        report, = sample_tars(jobs[:1], confidence=1, byte_budget=1000, seed=seed)
+        assert 0 < report['SampledBytes'] <= 1000 and report['SampledFiles'] < len(files) and report['Confidence'] < 1
+    # sampling stops at the first file over budget, rather than skipping large files to fit both 9-byte files
+    assert 0 in {sample_tars(jobs[:1], confidence=1, byte_budget=20, seed=seed)[0]['SampledFiles'] for seed in range(5)}
+
+    # corrupted file data is reported as a failure
+    rows = list(read_dicts_from_csv(manifest_path))
+    with open(tar_path, 'rb', ignore_ext=True) as f:
+        tar_contents = bytearray(f.read())
+    tar_contents[int(rows[0]['TarDataOffset'])] ^= 1
+    with open(tar_path, 'wb', ignore_ext=True) as f:
+        f.write(tar_contents)
+    reports = sample_tars(jobs, confidence=1, threads=4)
+    assert reports[0]['Failures'] == [(rows[0]['Key'], 'File hash mismatch: %s' % rows[0]['Key'])]
+    assert reports[1]['Failures'] == []
+
+    # a zero budget is rejected, rather than sampling nothing
+    with pytest.raises(SystemExit):
+        main(['sample', manifest_path, tar_path, '--budget-mb', '0'])
+
+
+@pytest.mark.parametrize('etag_check', ['list', 'head'])
+def test_delete_files(s3, files, source_bucket, archive_url, manifest_path, tar_path, boto_calls, etag_check):
     from s3mothball.s3mothball import delete_files, write_tar  # ensure mock is in place before importing functions to test
 
     # write tar
@@ -140,12 +898,13 @@ def test_delete_files(s3, files, source_bucket, archive_url, manifest_path, tar_
     # write extra files
     mismatched_etag_key = 'folders/some_folder/mismatched.txt'
     deleted_etag_key = 'folders/some_folder/deleted.txt'
-    keys_to_keep = {'folders/some_folder/keep.txt', mismatched_etag_key}
+    changed_etag_key = 'folders/some_folder/changed.txt'
+    keys_to_keep = {'folders/some_folder/keep.txt', mismatched_etag_key, changed_etag_key}
     keys_to_delete = set(f['key'] for f in files)
     for key in keys_to_keep:
         write_file(s3, source_bucket, key, 'contents')
 
-    # write mismatched file to manifest
+    # write mismatched, deleted, and changed files to manifest
     manifest = list(read_dicts_from_csv(manifest_path))
     write_dicts_to_csv(manifest_path, manifest + [
         {
@@ -157,29 +916,59 @@ def test_delete_files(s3, files, source_bucket, archive_url, manifest_path, tar_
             **manifest[-1],
             'Key': deleted_etag_key,
         },
+        {
+            **manifest[-1],
+            'Key': changed_etag_key,
+        },
     ])
+    check_calls = {'ListObjects': 1} if etag_check == 'list' else {'HeadObject': len(keys_to_delete) + 2}
 
     # dry run delete
     boto_calls.clear()
-    buckets = delete_files(manifest_path)
+    buckets = delete_files(manifest_path, etag_check=etag_check)
     assert buckets[source_bucket]['deleted'] == []
     assert buckets[source_bucket]['errors'] == []
-    assert set(buckets[source_bucket]['keys']) == keys_to_delete | {deleted_etag_key}
+    assert set(buckets[source_bucket]['keys']) == keys_to_delete | {deleted_etag_key, changed_etag_key}
     assert buckets[source_bucket]['mismatched'] == [mismatched_etag_key]
-    assert boto_calls == {'GetObject': 2}  # should be 1 -- https://github.com/RaRe-Technologies/smart_open/issues/494
+    assert buckets[source_bucket]['changed'] == [changed_etag_key]
+    assert buckets[source_bucket]['missing'] == [deleted_etag_key]
+    assert boto_calls == {'GetObject': 2, **check_calls}  # should be 1 -- https://github.com/RaRe-Technologies/smart_open/issues/494
     assert set(o.key for o in list_objects('s3://%s/' % source_bucket)) == keys_to_delete | keys_to_keep
 
-    # real delete
+    # real delete, from more than one manifest
+    other_manifest_path = manifest_path + '.other.csv'
+    manifest = list(read_dicts_from_csv(manifest_path))
+    write_dicts_to_csv(manifest_path, manifest[:2])
+    write_dicts_to_csv(other_manifest_path, manifest[2:])
     boto_calls.clear()
-    buckets = delete_files(manifest_path, dry_run=False)
+    buckets = delete_files([manifest_path, other_manifest_path], dry_run=False, etag_check=etag_check)
     assert set(buckets[source_bucket]['deleted']) == keys_to_delete
-    assert set(buckets[source_bucket]['errors']) == {deleted_etag_key}
-    assert set(buckets[source_bucket]['keys']) == keys_to_delete | {deleted_etag_key}
+    assert buckets[source_bucket]['errors'] == []
+    assert set(buckets[source_bucket]['keys']) == keys_to_delete | {deleted_etag_key, changed_etag_key}
     assert buckets[source_bucket]['mismatched'] == [mismatched_etag_key]
-    assert boto_calls == {'GetObject': 2, 'DeleteObjects': 1}  # should be 1 -- https://github.com/RaRe-Technologies/smart_open/issues/494
+    assert buckets[source_bucket]['changed'] == [changed_etag_key]
+    assert buckets[source_bucket]['missing'] == [deleted_etag_key]
+    assert boto_calls['DeleteObjects'] == 1  # keys from both manifests share a batch
     assert set(o.key for o in list_objects('s3://%s/' % source_bucket)) == keys_to_keep
 
 
+def test_delete_batch_retries_throttled_keys(monkeypatch):
+    from s3mothball import s3mothball
+
+    monkeypatch.setattr(s3mothball, 'sleep', lambda seconds: None)
+    calls = []
+    class Client:
+        def delete_objects(self, Bucket, Delete):
+            keys = [o['Key'] for o in Delete['Objects']]
+            calls.append(keys)
+            if len(calls) == 1:
+                return {'Deleted': [{'Key': 'a'}], 'Errors': [{'Key': 'b', 'Code': 'SlowDown'}, {'Key': 'c', 'Code': 'AccessDenied'}]}
+            return {'Deleted': [{'Key': k} for k in keys]}
+
+    assert s3mothball.delete_batch(Client(), 'bucket', ['a', 'b', 'c']) == ('bucket', ['a', 'b'], ['c'])
+    assert calls == [['a', 'b', 'c'], ['b']]
+
+
 def test_open_archived_file(s3, files, source_bucket, archive_url, manifest_path, tar_path, boto_calls):
     from s3mothball.s3mothball import open_archived_file, write_tar  # ensure mock is in place before importing functions to test
 
@@ -191,4 +980,75 @@ def test_open_archived_file(s3, files, source_bucket, archive_url, manifest_path
         boto_calls.clear()
         with open_archived_file(manifest_path, tar_path, "s3://%s/%s" % (file['bucket'], file['key'])) as f:
             assert f.read() == file['contents']
-        assert boto_calls == {'GetObject': 4}  # should be 2 -- https://github.com/RaRe-Technologies/smart_open/issues/494
+        assert boto_calls == {'GetObject': 4}  # manifest index, manifest header, manifest block, file contents
+
+    # an index that no longer matches its manifest is ignored, and the whole manifest is scanned
+    manifest = list(read_dicts_from_csv(manifest_path))
+    write_dicts_to_csv(manifest_path, [{'Note': 'rewritten', **row} for row in manifest])
+    for file in files:
+        with open_archived_file(manifest_path, tar_path, "s3://%s/%s" % (file['bucket'], file['key'])) as f:
+            assert f.read() == file['contents']
+
+    # rewriting the manifest without an index removes the old one
+    write_tar(archive_url, manifest_path, tar_path, strip_prefix=strip_prefix, index=False, overwrite=True)
+    assert not exists(manifest_index_path(manifest_path))
+    for file in files:
+        with open_archived_file(manifest_path, tar_path, "s3://%s/%s" % (file['bucket'], file['key'])) as f:
+            assert f.read() == file['contents']
+
+
+def test_extract_files(s3, files, source_bucket, archive_url, manifest_path, tar_path, boto_calls, tmp_path, capsys):
+    from s3mothball.commands import main
+    from s3mothball.s3mothball import extract_files, write_tar  # ensure mock is in place before importing functions to test
+
+    # write tar
+    write_tar(archive_url, manifest_path, tar_path)
+
+    # adjacent files are fetched with one range request
+    boto_calls.clear()
+    paths = extract_files(manifest_path, tar_path, str(tmp_path), prefix=archive_url)
+    assert sorted(paths) == sorted(str(tmp_path / f['key']) for f in files)
+    for file in files:
+        assert (tmp_path / file['key']).read_bytes() == file['contents']
+    assert boto_calls['GetObject'] == 2  # manifest and one range of the tar
+
+    # distant files are fetched separately
+    boto_calls.clear()
+    out_dir = tmp_path / 'by_url'
+    file_paths = ["s3://%s/%s" % (f['bucket'], f['key']) for f in files]
+    extract_files(manifest_path, tar_path, str(out_dir), file_paths, max_gap=0)
+    for file in files:
+        assert (out_dir / file['key']).read_bytes() == file['contents']
+    assert boto_calls['GetObject'] == 3
+
+    # missing files are reported before fetching
+    with pytest.raises(FileNotFoundError, match=r"Files not found in manifest: s3://source/missing.txt"):
+        extract_files(manifest_path, tar_path, str(out_dir), ["s3://%s/missing.txt" % source_bucket])
+
+    # the command line requires a selection, rather than reporting success after extracting nothing
+    with pytest.raises(SystemExit):
+        main(['extract', manifest_path, tar_path, '--out-dir', str(tmp_path / 'none')])
+    assert 'at least one file_path' in capsys.readouterr().err
+    main(['extract', manifest_path, tar_path, '--out-dir', str(tmp_path / 'all'), '--prefix', archive_url])
+    assert 'Extracted %s files' % len(files) in capsys.readouterr().out
+
+
+def test_restore_files(s3, files, source_bucket, archive_url, manifest_path, tar_path, boto_calls, monkeypatch):
+    import moto.s3.models
+    from s3mothball.s3mothball import write_tar, restore_files  # ensure mock is in place before importing functions to test
+
+    monkeypatch.setattr(moto.s3.models, 'UPLOAD_PART_MIN_SIZE', 1)  # allow tiny copy parts
+
+    files += [write_file(s3, source_bucket, 'folders/some_folder/empty.txt', '')]
+    write_tar(archive_url, manifest_path, tar_path, sha256=True)
+    for f in files[1:]:
+        s3.delete_object(Bucket=source_bucket, Key=f['key'])
+
+    # missing files are copied server-side from the tar, and existing files are skipped
+    boto_calls.clear()
+    results = restore_files(manifest_path, tar_path, prefix=archive_url, part_size=5)
+    assert sorted(results['restored']) == sorted('s3://%s/%s' % (source_bucket, f['key']) for f in files[1:])
+    assert results['existing'] == ['s3://%s/%s' % (source_bucket, files[0]['key'])]
+    assert boto_calls['UploadPartCopy'] == 2 and boto_calls['PutObject'] == 1
+    for f in files:
+        assert s3.get_object(Bucket=source_bucket, Key=f['key'])['Body'].read() == f['contents']